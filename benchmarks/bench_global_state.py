@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the per-call overhead of the global :func:`clog.log_line` with a
+direct call to :meth:`clog.loggers.ScribeLogger.log_line`.
+
+No scribe server is needed: the logger points to a closed port with a long
+retry interval, so after the first failed connection every call only pays for
+the clog bookkeeping.
+
+    python benchmarks/bench_global_state.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from clog import config, global_state
+from testing.sandbox import find_open_port
+
+NUMBER = 200000
+
+
+def _ignore_status(is_error, msg):
+    pass
+
+
+def main():
+    port = find_open_port()
+    config.configure_from_dict({
+        'scribe_disable': False,
+        'scribe_host': '127.0.0.1',
+        'scribe_port': port,
+        'scribe_retry_interval': 3600,
+    })
+    global_state.check_create_default_loggers()
+    scribe_logger = global_state.loggers[0]
+    scribe_logger.report_status = _ignore_status
+
+    direct = min(timeit.repeat(
+        lambda: scribe_logger.log_line('bench', b'line'),
+        number=NUMBER, repeat=3,
+    ))
+    through_global = min(timeit.repeat(
+        lambda: global_state.log_line('bench', b'line'),
+        number=NUMBER, repeat=3,
+    ))
+    for name, total in (('ScribeLogger.log_line', direct), ('clog.log_line', through_global)):
+        print('%-24s %8.1f ns/call' % (name, total / NUMBER * 1e9))
+    print('%-24s %8.1f ns/call' % ('global overhead', (through_global - direct) / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measure the per-call cost of :meth:`clog.metrics_reporter.MetricsReporter.sampled_request`,
+against the previous implementation, a generator based context manager
+taking a lock on every call.
+
+    python benchmarks/bench_metrics_reporter.py
+"""
+from __future__ import print_function
+
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+
+from clog.metrics_reporter import FakeMetric
+from clog.metrics_reporter import MetricsReporter
+
+NUMBER = 500000
+SAMPLE_RATE = 1000
+
+
+class LockingReporter(object):
+    """The previous implementation of sampled_request"""
+
+    def __init__(self, sample_rate):
+        self._sample_counter = 0
+        self._sample_rate = sample_rate
+        self._total_log_line_sent = FakeMetric()
+        self._sample_log_line_latency = FakeMetric()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def sampled_request(self, count=1):
+        with self._lock:
+            self._sample_counter += count
+            sample_request = self._sample_rate and self._sample_counter >= self._sample_rate
+        if sample_request:
+            start_time = time.time()
+            yield
+            duration = 1000000 * (time.time() - start_time)
+            with self._lock:
+                self._total_log_line_sent.count(value=self._sample_counter)
+                self._sample_log_line_latency.record(value=duration)
+                self._sample_counter = 0
+        else:
+            yield
+
+
+def bench(reporter):
+    def call():
+        with reporter.sampled_request():
+            pass
+    return min(timeit.repeat(call, number=NUMBER, repeat=3)) / NUMBER * 1e9
+
+
+def main():
+    for name, reporter in (
+        ('contextmanager + lock', LockingReporter(SAMPLE_RATE)),
+        ('MetricsReporter', MetricsReporter('bench', SAMPLE_RATE)),
+    ):
+        print('%-24s %8.1f ns/call' % (name, bench(reporter)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measure the throughput of :class:`clog.readers.CLogStreamReader` over a day
+of gzip chunks, read in this process line by line and in batches, and with
+pools of processes.
+
+    python benchmarks/bench_readers.py [chunks] [lines per chunk]
+"""
+from __future__ import print_function
+
+import datetime
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from clog.readers import CLogStreamReader
+
+STREAM = 'bench'
+DATE = datetime.date(2009, 1, 1)
+LINE = b'x' * 200 + b'\n'
+
+
+def write_chunks(stream_dir, chunks, lines):
+    os.mkdir(os.path.join(stream_dir, STREAM))
+    for chunk in range(chunks):
+        path = os.path.join(stream_dir, STREAM, '%s-2009-01-01_%05d.gz' % (STREAM, chunk))
+        with gzip.open(path, 'wb') as chunk_file:
+            chunk_file.write(LINE * lines)
+
+
+def bench(stream_dir, processes, batches=False):
+    reader = CLogStreamReader(STREAM, stream_dir, DATE, processes=processes)
+    start = time.time()
+    size = 0
+    if batches:
+        for batch in reader.iter_batches():
+            size += len(batch) * len(LINE)
+    else:
+        for line in reader:
+            size += len(line)
+    elapsed = time.time() - start
+    print('%2d processes%s %8.1f MB/s' % (processes, ' batches' if batches else '', size / elapsed / 1e6))
+
+
+def main():
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    stream_dir = tempfile.mkdtemp()
+    try:
+        write_chunks(stream_dir, chunks, lines)
+        bench(stream_dir, 1, batches=True)
+        processes = 1
+        while processes <= multiprocessing.cpu_count():
+            bench(stream_dir, processes)
+            processes *= 2
+    finally:
+        shutil.rmtree(stream_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the cost for a uwsgi worker of :func:`clog.uwsgi_plugin.uwsgi_log_line`
+with mule messages and with the shared memory rings.
+
+uwsgi is replaced by a fake module whose mule queue is a datagram socketpair,
+like the queue of uwsgi. A forked process plays the mule and drains the
+queue or the rings while the worker logs, and the lines the rings have no
+room for go through the queue.
+
+    python benchmarks/bench_uwsgi_transport.py
+"""
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import time
+
+NUMBER = 100000
+LINE = b'x' * 200
+
+
+class FakeUwsgi(object):
+    numproc = 1
+
+    def __init__(self):
+        self.worker_socket, self.mule_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def mule_msg(self, message, mule=None):
+        self.worker_socket.send(message)
+        return True
+
+    @staticmethod
+    def mule_msg_recv_size():
+        return 65536
+
+    @staticmethod
+    def worker_id():
+        return 1
+
+
+class FakeUwsgiDecorators(object):
+    @staticmethod
+    def mule_msg_dispatcher(message):
+        pass
+
+
+def run_mule(drain):
+    pid = os.fork()
+    if not pid:
+        received = 0
+        while received < NUMBER:
+            received += drain()
+        os._exit(0)
+    return pid
+
+
+def bench(uwsgi_plugin, name, drain):
+    pid = run_mule(drain)
+    start = time.time()
+    for _ in range(NUMBER):
+        uwsgi_plugin.uwsgi_log_line('bench', LINE)
+    elapsed = time.time() - start
+    os.waitpid(pid, 0)
+    print('%-12s %8.1f ns/line in the worker' % (name, elapsed / NUMBER * 1e9))
+
+
+def main():
+    fake_uwsgi = FakeUwsgi()
+    sys.modules['uwsgi'] = fake_uwsgi
+    sys.modules['uwsgidecorators'] = FakeUwsgiDecorators
+    from clog import uwsgi_plugin
+
+    def drain_socket():
+        fake_uwsgi.mule_socket.recv(65536)
+        return 1
+
+    bench(uwsgi_plugin, 'mule_msg', drain_socket)
+
+    uwsgi_plugin.uwsgi_setup_shm_transport()
+    transport = uwsgi_plugin._shm_transport
+
+    def drain_rings():
+        transport.wait(0.01)
+        received = len(transport.drain())
+        # lines which did not fit in the ring fall back to the mule queue
+        fake_uwsgi.mule_socket.setblocking(False)
+        try:
+            while True:
+                fake_uwsgi.mule_socket.recv(65536)
+                received += 1
+        except socket.error:
+            return received
+
+    bench(uwsgi_plugin, 'shm rings', drain_rings)
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,23 @@ machine readable, and opertional data to scribe. There is also a global
 configuration (see :mod:`clog.config`). Use of the global is discouraged.
 
 
+Stream Statistics
+-----------------
+
+:func:`clog.stats` returns the lines and bytes logged to the heaviest
+streams, by :func:`clog.log_line` and by each global logger, with bounded
+memory whatever the number of streams.
+
+
+Latency Histograms
+------------------
+
+:func:`clog.latency_snapshot` returns the p50, p99 and p999 latencies of the
+sampled writes of the loggers, per backend and stream priority class, from
+in-process histograms which need no external metrics system.
+:func:`clog.reset_latency_histograms` starts them over.
+
+
 Reading Scribe Logs
 -------------------
 
@@ -44,11 +61,12 @@ from a server.
 from __future__ import absolute_import
 
 from clog.loggers import ScribeLogger, ScribeIsNotForkSafeError
-from clog.global_state import log_line, reset_default_loggers
+from clog.global_state import log_line, log_lines, reset_default_loggers, shutdown, stats
+from clog.metrics_reporter import latency_snapshot, reset_latency_histograms
 
 uwsgi_plugin_enabled = False
 try:
-    from clog.uwsgi_plugin import uwsgi_patch_global_state, uwsgi_log_line
+    from clog.uwsgi_plugin import uwsgi_patch_global_state, uwsgi_log_line, uwsgi_log_lines
     uwsgi_plugin_enabled = True
 except ImportError:
     pass
@@ -57,9 +75,15 @@ _pyflakes_ignore = [
     ScribeLogger,
     ScribeIsNotForkSafeError,
     log_line,
+    log_lines,
     reset_default_loggers,
+    shutdown,
+    stats,
+    latency_snapshot,
+    reset_latency_histograms,
 ] + ([
     uwsgi_patch_global_state,
     uwsgi_log_line,
+    uwsgi_log_lines,
 ] if uwsgi_plugin_enabled else [])
 
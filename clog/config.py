@@ -47,6 +47,16 @@ settings are supported:
         blocking behavior is on when this parameter is left unset or set to 0;
         both the values None and 0 are treated as "infinite".
 
+    **report_status_rate_limit**
+        maximum number of errors and status messages reported per second by
+        the loggers. When set, identical messages are only reported once per
+        `report_status_window_seconds`, with a summary of their repetitions
+        at the end of the window. 0 disables the rate limit (default 0)
+
+    **report_status_window_seconds**
+        length of the deduplication window of `report_status_rate_limit`
+        (default 10)
+
     **clog_enable_file_logging**
         flag to enable logging to local files. (Default False)
 
@@ -54,6 +64,137 @@ settings are supported:
         flag to enable logging to stdout. Each log line is prefixed with the
         stream name. (Default False)
 
+    **stream_sinks**
+        (list of single item dicts `{pattern: [sink, ...]}`) send the streams
+        matching `pattern` only to the listed sinks (`file`, `scribe` or
+        `stdout`) among the enabled ones, instead of to all of them.
+        `pattern` can be a stream name, a prefix like `tmp_*` or a glob.
+        Streams without a matching pattern go to every enabled sink
+        (default [])
+
+    **stream_priorities**
+        (list of single item dicts `{pattern: class}`) priority class of the
+        streams matching `pattern`, one of `critical`, `high`, `normal` or
+        `low`. Buffered lines of higher classes are sent first and evicted
+        last. Other streams are `normal` (default [])
+
+    **priority_class_max_bytes**
+        (list of single item dicts `{class: max_bytes}`) maximum size of the
+        buffered lines of a priority class (default [])
+
+    **stream_sample_rates**
+        (list of single item dicts `{pattern: rate}`) keep only a `rate`
+        fraction, between 0 and 1, of the lines of the streams matching
+        `pattern` (default [])
+
+    **rate_limit_lines_per_second**
+        maximum number of lines per second sent by :func:`clog.log_line`
+        for all streams together, 0 for no limit (default 0)
+
+    **rate_limit_bytes_per_second**
+        maximum number of bytes per second sent by :func:`clog.log_line`
+        for all streams together, 0 for no limit (default 0)
+
+    **stream_rate_limits**
+        (list of single item dicts `{pattern: limits}`) per stream limits,
+        where `limits` is a dict with `lines_per_second` and/or
+        `bytes_per_second`. `pattern` can be a stream name, a prefix like
+        `tmp_*` or a glob (default [])
+
+    **rate_limit_critical_streams**
+        (list of stream patterns) streams which may use the share of the
+        global limits reserved by `rate_limit_reserved_share` (default [])
+
+    **rate_limit_reserved_share**
+        share of the global limits that only critical streams can use
+        (default 0)
+
+    **rate_limit_overflow_policy**
+        what to do with the lines over the limits: `drop` them, `sample`
+        them (keeping `rate_limit_sample_rate` of them) or `spool` them to
+        send them later (default drop)
+
+    **rate_limit_sample_rate**
+        share of the lines over the limits kept by the `sample` policy
+        (default 0.01)
+
+    **rate_limit_max_spooled_lines**
+        maximum number of lines kept by the `spool` policy (default 10000)
+
+    **uwsgi_mules**
+        with the uwsgi plugin, list of the mule ids the lines are spread
+        over, instead of the shared mule queue (default []). Without it, the
+        fragments of the lines too large for a mule message all go to mule 1
+
+    **uwsgi_sharding**
+        how lines are spread over `uwsgi_mules`: `hash` sends each stream to
+        one mule and keeps its lines in order, `round_robin` balances the
+        mules evenly (default hash)
+
+    **uwsgi_coalesce_delay**
+        with the uwsgi plugin, maximum number of seconds a worker keeps
+        lines to pack them into a single mule message, 0 to send a message
+        per line (default 0)
+
+    **uwsgi_mule_batch_lines**
+        with the uwsgi plugin, number of lines of a stream the mule
+        accumulates before sending them in one batch, 0 or 1 to send every
+        line on its own (default 0)
+
+    **uwsgi_mule_batch_bytes**
+        number of bytes of a stream which also triggers sending the mule
+        batch (default 1048576)
+
+    **uwsgi_mule_batch_delay**
+        maximum number of seconds a line waits in the mule batch
+        (default 0.1)
+
+    **metrics_sample_rate**
+        number of lines per request whose latency is emitted as a metric,
+        0 to not emit latency metrics (default 0)
+
+    **latency_histogram_sample_rate**
+        when `metrics_sample_rate` is 0, number of lines per request whose
+        latency is kept in the in-process histograms of
+        :func:`clog.latency_snapshot`, 0 to disable them (default 100)
+
+    **metrics_backend**
+        where :class:`clog.metrics_reporter.MetricsReporter` sends the
+        metrics: `meteorite` (yelp_meteorite when installed), `statsd`,
+        `prometheus` (a text file for the node exporter) or `none`
+        (default meteorite)
+
+    **metrics_flush_interval**
+        seconds the `statsd` and `prometheus` metrics backends aggregate the
+        metrics before sending them (default 10)
+
+    **statsd_host**
+        host of the statsd server of the `statsd` metrics backend
+        (default 127.0.0.1)
+
+    **statsd_port**
+        UDP port of the statsd server of the `statsd` metrics backend
+        (default 8125)
+
+    **prometheus_textfile_path**
+        file written by the `prometheus` metrics backend, ending with
+        `.prom`, each process writes its own file with its pid before
+        `.prom` (default '')
+
+    **stream_stats_capacity**
+        number of streams whose lines and bytes are counted by each logger
+        and by :func:`clog.log_line`, the heaviest ones are kept
+        (default 100)
+
+    **stream_stats_report_interval**
+        seconds between two reports as metrics of the stream counts of
+        :func:`clog.log_line`, which then start over. 0 to not report them
+        (default 0)
+
+    **shutdown_timeout**
+        seconds :func:`clog.shutdown` waits for the global loggers to flush
+        when the interpreter exits (default 5)
+
     **localS3**
         If True, will fetch s3 files directly rather than talking to a service.
 """
@@ -104,6 +245,101 @@ preferred_backend_map = clog_namespace.get_list('preferred_backend_map',
     "    - stream_name: backend_name"
 )
 
+stream_sinks = clog_namespace.get_list('stream_sinks',
+    default=[],
+    help="Routing of streams to sinks for clog.log_line. The routes must be "
+    "represented as a list using the format\n"
+    "    - stream_pattern: [sink_name, ...]\n"
+    "where sink_name is 'file', 'scribe' or 'stdout' and stream_pattern is a "
+    "stream name, a prefix like 'tmp_*' or a glob. Streams which match no "
+    "pattern are sent to every enabled sink."
+)
+
+stream_priorities = clog_namespace.get_list('stream_priorities',
+    default=[],
+    help="Priority classes of streams in the buffers of the loggers. The "
+    "classes must be represented as a list using the format\n"
+    "    - stream_pattern: priority_class\n"
+    "where priority_class is 'critical', 'high', 'normal' or 'low'.")
+
+priority_class_max_bytes = clog_namespace.get_list('priority_class_max_bytes',
+    default=[],
+    help="Maximum size of the buffered lines of each priority class, as a "
+    "list using the format\n"
+    "    - priority_class: max_bytes")
+
+stream_sample_rates = clog_namespace.get_list('stream_sample_rates',
+    default=[],
+    help="Sample rates of streams for clog.log_line. The rates must be "
+    "represented as a list using the format\n"
+    "    - stream_pattern: rate\n"
+    "where rate is the fraction of lines kept, between 0 and 1.")
+
+rate_limit_lines_per_second = clog_namespace.get_int('rate_limit_lines_per_second',
+    default=0,
+    help="Maximum lines per second sent by clog.log_line for all streams, 0 for no limit.")
+
+rate_limit_bytes_per_second = clog_namespace.get_int('rate_limit_bytes_per_second',
+    default=0,
+    help="Maximum bytes per second sent by clog.log_line for all streams, 0 for no limit.")
+
+stream_rate_limits = clog_namespace.get_list('stream_rate_limits',
+    default=[],
+    help="Per stream rate limits for clog.log_line. The limits must be "
+    "represented as a list using the format\n"
+    "    - stream_pattern: {lines_per_second: N, bytes_per_second: M}")
+
+rate_limit_critical_streams = clog_namespace.get_list('rate_limit_critical_streams',
+    default=[],
+    help="Patterns of the streams which can use the reserved share of the global rate limits.")
+
+rate_limit_reserved_share = clog_namespace.get_float('rate_limit_reserved_share',
+    default=0.0,
+    help="Share of the global rate limits reserved to critical streams.")
+
+rate_limit_overflow_policy = clog_namespace.get_string('rate_limit_overflow_policy',
+    default='drop',
+    help="What to do with lines over the rate limits: 'drop', 'sample' or 'spool'.")
+
+rate_limit_sample_rate = clog_namespace.get_float('rate_limit_sample_rate',
+    default=0.01,
+    help="Share of the lines over the rate limits kept by the 'sample' policy.")
+
+rate_limit_max_spooled_lines = clog_namespace.get_int('rate_limit_max_spooled_lines',
+    default=10000,
+    help="Maximum number of lines kept by the 'spool' policy.")
+
+uwsgi_mules = clog_namespace.get_list('uwsgi_mules',
+    default=[],
+    help="Ids of the uwsgi mules clog lines are spread over.")
+
+uwsgi_sharding = clog_namespace.get_string('uwsgi_sharding',
+    default='hash',
+    help="How lines are spread over uwsgi_mules: 'hash' of the stream or 'round_robin'.")
+
+uwsgi_coalesce_delay = clog_namespace.get_float('uwsgi_coalesce_delay',
+    default=0.0,
+    help="Maximum number of seconds a uwsgi worker keeps lines to pack them "
+    "into a single mule message. 0 disables packing.")
+
+uwsgi_mule_batch_lines = clog_namespace.get_int('uwsgi_mule_batch_lines',
+    default=0,
+    help="Number of lines of a stream the uwsgi mule batches before sending "
+    "them. 0 or 1 disables batching.")
+
+uwsgi_mule_batch_bytes = clog_namespace.get_int('uwsgi_mule_batch_bytes',
+    default=1024 * 1024,
+    help="Number of bytes of a stream which triggers sending the uwsgi mule batch.")
+
+uwsgi_mule_batch_delay = clog_namespace.get_float('uwsgi_mule_batch_delay',
+    default=0.1,
+    help="Maximum number of seconds a line waits in the uwsgi mule batch.")
+
+shutdown_timeout = clog_namespace.get_float('shutdown_timeout',
+    default=5.0,
+    help="Seconds to wait for the global loggers to flush their buffered lines "
+    "at exit. Lines which are not flushed in time are abandoned.")
+
 monk_client_id = clog_namespace.get_string('monk_client_id',
     default="clog",
     help="Identification for user writing to monk")
@@ -153,6 +389,16 @@ scribe_errors_to_syslog = clog_namespace.get_bool('scribe_errors_to_syslog',
     default=False,
     help="If True, send Scribe errors to syslog, otherwise to stderr")
 
+report_status_rate_limit = clog_namespace.get_int('report_status_rate_limit',
+    default=0,
+    help="Maximum number of error and status messages reported per second, "
+    "identical messages being only reported once per window. 0 disables it.")
+
+report_status_window_seconds = clog_namespace.get_int('report_status_window_seconds',
+    default=10,
+    help="Seconds during which identical error and status messages are only "
+    "counted, when report_status_rate_limit is set.")
+
 syslog_host_address = clog_namespace.get_string('syslog_host_address',
     default='127.0.0.1',
     help="Address of the syslog host, if needed")
@@ -177,6 +423,39 @@ metrics_sample_rate = clog_namespace.get_int('metrics_sample_rate',
     default=0,
     help='Number of messages to sample to emit one latency metric.')
 
+metrics_backend = clog_namespace.get_string('metrics_backend',
+    default='meteorite',
+    help='Where to send the metrics: meteorite, statsd, prometheus or none.')
+
+metrics_flush_interval = clog_namespace.get_float('metrics_flush_interval',
+    default=10,
+    help='Seconds the statsd and prometheus metrics backends aggregate metrics.')
+
+statsd_host = clog_namespace.get_string('statsd_host',
+    default='127.0.0.1',
+    help='Host of the statsd server of the statsd metrics backend.')
+
+statsd_port = clog_namespace.get_int('statsd_port',
+    default=8125,
+    help='UDP port of the statsd server of the statsd metrics backend.')
+
+prometheus_textfile_path = clog_namespace.get_string('prometheus_textfile_path',
+    default='',
+    help='File written by the prometheus metrics backend.')
+
+stream_stats_capacity = clog_namespace.get_int('stream_stats_capacity',
+    default=100,
+    help='Number of streams whose lines and bytes are counted.')
+
+stream_stats_report_interval = clog_namespace.get_float('stream_stats_report_interval',
+    default=0,
+    help='Seconds between two reports of the stream counts as metrics, 0 to disable them.')
+
+latency_histogram_sample_rate = clog_namespace.get_int('latency_histogram_sample_rate',
+    default=100,
+    help='Number of messages to sample to record one latency in the histograms '
+         'when metrics_sample_rate is 0.')
+
 is_logging_configured = False
 
 
@@ -16,71 +16,244 @@
 Log lines to scribe using the default global logger.
 """
 
+import atexit
+import threading
+import time
+
 from clog import config
 from clog.loggers import FileLogger, monk_dependency_installed,\
     ScribeMonkLogger, MonkLogger, ScribeLogger, StdoutLogger
+from clog.loggers import flush_default_reporters
+from clog.metrics_backends import flush_metrics_backend
+from clog.metrics_reporter import flush_sampled_counts
+from clog.priority import create_class_max_bytes, create_stream_priorities_map
+from clog.rate_limit import StreamRateLimiter
+from clog.sampling import StreamSampler
+from clog.stream_stats import create_stream_stats
+from clog.utils import config_list_to_items, StreamPatternMap
 from clog.zipkin_plugin import use_zipkin, ZipkinTracing
 
+SINK_FILE = 'file'
+SINK_SCRIBE = 'scribe'
+SINK_STDOUT = 'stdout'
+SINK_NAMES = (SINK_FILE, SINK_SCRIBE, SINK_STDOUT)
+
+# maximum number of streams whose dispatch tuple is cached at once
+MAX_CACHED_STREAM_ROUTES = 10000
+
 # global logger, used by module-level functions
 loggers = None
 
+# StreamRoutes for the global loggers, rebuilt together with them. log_line
+# only reads this name, so it needs no lock once set.
+_stream_routes = None
+
+# lines and bytes logged to each stream with log_line and log_lines, kept
+# when the loggers are rebuilt
+_stream_stats = None
+
+# guards the one-time creation of the global loggers
+_loggers_lock = threading.Lock()
+
 class LoggingNotConfiguredError(Exception):
     pass
 
 
+class StreamRoutes(dict):
+    """Cache of the tuple of log_line methods each stream is dispatched to.
+
+    :param sinks: list of (sink name, logger) pairs
+    :param stream_sinks: a :class:`clog.utils.StreamPatternMap` of stream
+        patterns to lists of sink names
+    :param rate_limiter: optional :class:`clog.rate_limit.StreamRateLimiter`
+        applied before dispatching lines
+    :param sampler: optional :class:`clog.sampling.StreamSampler` applied
+        before anything else
+
+    The lines are counted without locking by the
+    :class:`clog.stream_stats.ThreadStreamStats` of the module, shared by the
+    successive routes. The loggers of the sinks do not count them again.
+    """
+
+    def __init__(self, sinks, stream_sinks, rate_limiter=None, sampler=None):
+        super(StreamRoutes, self).__init__()
+        self.sinks = sinks
+        self.stream_sinks = stream_sinks
+        self.rate_limiter = rate_limiter
+        self.sampler = sampler
+        self.stream_stats = get_stream_stats()
+        self.all_loggers = tuple(logger for _, logger in sinks)
+
+    def loggers_for(self, stream):
+        """Return the tuple of loggers `stream` is sent to"""
+        sink_names = self.stream_sinks.get(stream)
+        if sink_names is None:
+            return self.all_loggers
+        return tuple(logger for name, logger in self.sinks if name in sink_names)
+
+    def __missing__(self, stream):
+        if len(self) >= MAX_CACHED_STREAM_ROUTES:
+            self.clear()
+        log_line_funcs = tuple(logger.log_line for logger in self.loggers_for(stream))
+        self[stream] = log_line_funcs
+        return log_line_funcs
+
+
 def create_preferred_backend_map():
     """PyStaticConfig doesn't support having a map in the configuration,
     so we represent a map as a list, and we use this function to generate
     an actual python dictionary from it."""
-    preferred_backend_map = {}
-    for mapping in config.preferred_backend_map:
-        key, value = list(mapping.items())[0]
-        preferred_backend_map[key] = value
-    return preferred_backend_map
+    return dict(config_list_to_items(config.preferred_backend_map))
+
+
+def create_stream_sinks_map():
+    """Build the :class:`clog.utils.StreamPatternMap` of stream patterns to
+    sink names from `config.stream_sinks`."""
+    items = config_list_to_items(config.stream_sinks)
+    for pattern, sink_names in items:
+        unknown_sinks = set(sink_names) - set(SINK_NAMES)
+        if unknown_sinks:
+            raise ValueError('Unknown sinks %s for streams %r in stream_sinks' % (
+                ', '.join(sorted(unknown_sinks)), pattern))
+    return StreamPatternMap(items)
+
+
+def create_rate_limiter():
+    """Build the :class:`clog.rate_limit.StreamRateLimiter` of the global
+    loggers from the configuration, or return None if no limit is set."""
+    stream_limits = StreamPatternMap(config_list_to_items(config.stream_rate_limits))
+    if not (config.rate_limit_lines_per_second or config.rate_limit_bytes_per_second
+            or stream_limits):
+        return None
+    return StreamRateLimiter(
+        lines_per_second=config.rate_limit_lines_per_second,
+        bytes_per_second=config.rate_limit_bytes_per_second,
+        stream_limits=stream_limits,
+        critical_streams=StreamPatternMap(
+            (pattern, True) for pattern in config.rate_limit_critical_streams),
+        reserved_share=config.rate_limit_reserved_share,
+        overflow_policy=config.rate_limit_overflow_policy,
+        sample_rate=config.rate_limit_sample_rate,
+        max_spooled_lines=config.rate_limit_max_spooled_lines,
+        stream_priorities=create_stream_priorities_map(),
+        class_max_bytes=create_class_max_bytes(),
+    )
+
+
+def create_sampler():
+    """Build the :class:`clog.sampling.StreamSampler` of the global loggers
+    from `config.stream_sample_rates`, or return None if no stream is
+    sampled."""
+    items = config_list_to_items(config.stream_sample_rates)
+    if not items:
+        return None
+    for pattern, rate in items:
+        if not 0 <= rate <= 1:
+            raise ValueError('Invalid sample rate %r for streams %r in stream_sample_rates' % (
+                rate, pattern))
+    return StreamSampler(StreamPatternMap(items))
+
+
+def get_stream_stats():
+    """Return the :class:`clog.stream_stats.StreamStats` of :func:`log_line`
+    and :func:`log_lines`, built from the configuration on first use"""
+    global _stream_stats
+    if _stream_stats is None:
+        _stream_stats = create_stream_stats(report=True, per_thread=True)
+    return _stream_stats
+
+
+def stats(count=None):
+    """Return a snapshot of the state of the global loggers, cheap enough
+    for health checks: a dict with
+
+    - `configured`: whether the global loggers are created
+    - `global`: the lines and bytes logged to the heaviest streams by
+      :func:`log_line` and :func:`log_lines`, as returned by
+      :meth:`clog.stream_stats.StreamStats.snapshot`
+    - `sinks`: the `stats()` of each global logger by sink name, see for
+      instance :meth:`clog.loggers.ScribeLogger.stats`. Their `streams` are
+      None, the lines of each stream are only counted in `global`
+
+    :param count: maximum number of streams of each snapshot
+    """
+    sinks = {}
+    stream_routes = _stream_routes
+    if stream_routes is not None:
+        for name, logger in stream_routes.sinks:
+            logger_stats = getattr(logger, 'stats', None)
+            if logger_stats is not None:
+                sinks[name] = logger_stats(count)
+    return {
+        'configured': stream_routes is not None,
+        'global': get_stream_stats().snapshot(count),
+        'sinks': sinks,
+    }
 
 
 def check_create_default_loggers():
     """Set up global loggers, if necessary."""
-    global loggers
+    if _stream_routes is None:
+        _create_default_loggers()
 
-    # important to specifically compare to None, since empty list means something different
-    if loggers is None:
 
-        # initialize list of loggers
-        loggers = []
+def _create_default_loggers():
+    """Create the global loggers under a lock, so that concurrent first
+    writes do not open duplicate connections, and return their
+    :class:`StreamRoutes`.
+    """
+    global loggers, _stream_routes
+
+    with _loggers_lock:
+        # another thread may have finished the setup while we were waiting
+        if _stream_routes is not None:
+            return _stream_routes
+
+        sinks = []
+        stream_sinks = create_stream_sinks_map()
+        rate_limiter = create_rate_limiter()
+        sampler = create_sampler()
 
         # possibly add logger that writes to local files (for dev)
         if config.clog_enable_file_logging:
             if config.log_dir is None:
                 raise ValueError('log_dir not set; set it or disable clog_enable_file_logging')
-            loggers.append(FileLogger())
+            sinks.append((SINK_FILE, FileLogger(count_streams=False)))
 
         if not config.scribe_disable:
             scribe_logger = ScribeLogger(
                 config.scribe_host,
                 config.scribe_port,
-                config.scribe_retry_interval
+                config.scribe_retry_interval,
+                count_streams=False,
             )
             if not config.monk_disable and monk_dependency_installed:
                 scribe_monk_logger = ScribeMonkLogger(
                     config,
                     scribe_logger,
-                    MonkLogger(config.monk_client_id),
+                    MonkLogger(config.monk_client_id, count_streams=False),
                     preferred_backend_map=create_preferred_backend_map()
                 )
-                loggers.append(scribe_monk_logger)
+                sinks.append((SINK_SCRIBE, scribe_monk_logger))
             else:
-                loggers.append(scribe_logger)
+                sinks.append((SINK_SCRIBE, scribe_logger))
 
         if config.clog_enable_stdout_logging:
-            loggers.append(StdoutLogger())
+            sinks.append((SINK_STDOUT, StdoutLogger(count_streams=False)))
 
         if use_zipkin():
-            loggers = list(map(ZipkinTracing, loggers))
+            sinks = [(name, ZipkinTracing(logger)) for name, logger in sinks]
+
+        # publish the loggers before raising, an empty list means that
+        # further writes are silently dropped
+        loggers = [logger for _, logger in sinks]
+        _stream_routes = StreamRoutes(sinks, stream_sinks, rate_limiter, sampler)
 
         if not loggers and not config.is_logging_configured:
             raise LoggingNotConfiguredError
 
+        return _stream_routes
+
 
 def reset_default_loggers():
     """
@@ -91,22 +264,181 @@ def reset_default_loggers():
     this must be the last thing done before the fork or, better yet, the first
     thing after the fork.
     """
-    global loggers
+    global loggers, _stream_routes
+
+    with _loggers_lock:
+        old_loggers = loggers
+        _stream_routes = None
+        loggers = None
 
-    if loggers:
-        for logger in loggers:
+    if old_loggers:
+        for logger in old_loggers:
             logger.close()
-    loggers = None
 
 
-def log_line(stream, line):
+def shutdown(timeout=None):
+    """Flush and close the global :mod:`clog` loggers, waiting at most
+    `timeout` seconds in total. The loggers are flushed in parallel, so a
+    slow backend does not eat into the time of the others. Like
+    :func:`reset_default_loggers`, further writes rebuild the loggers.
+
+    The lines of the rate limiter spool which fit in its limits are sent
+    first, the others are counted as `abandoned` by the sinks of their
+    stream.
+
+    :param timeout: seconds to wait for the flushes, None to wait until they
+        are done
+
+    :returns: a dict mapping each sink name to a dict with the number of
+        lines `flushed` and `abandoned`, and whether the flush `timed_out`. The
+        counts of a flush which did not return in time are unknown and None.
+    """
+    global loggers, _stream_routes
+
+    with _loggers_lock:
+        stream_routes = _stream_routes
+        _stream_routes = None
+        loggers = None
+
+    if stream_routes is None:
+        flush_default_reporters()
+        flush_sampled_counts()
+        flush_metrics_backend()
+        return {}
+
+    deadline = None if timeout is None else time.time() + timeout
+    spool_abandoned = _abandon_spool(stream_routes)
+    flushes = [_LoggerFlush(name, logger, timeout) for name, logger in stream_routes.sinks]
+    for flush in flushes:
+        flush.start()
+
+    report = {}
+    for flush in flushes:
+        flush.join(None if deadline is None else max(0, deadline - time.time()))
+        if flush.is_alive():
+            report[flush.sink_name] = {'flushed': None, 'abandoned': None, 'timed_out': True}
+            continue
+        flushed, abandoned = flush.result
+        if abandoned is not None:
+            abandoned += spool_abandoned.get(flush.sink_name, 0)
+        report[flush.sink_name] = {'flushed': flushed, 'abandoned': abandoned, 'timed_out': False}
+        flush.logger.close()
+    flush_default_reporters()
+    flush_sampled_counts()
+    flush_metrics_backend()
+    return report
+
+
+def _abandon_spool(stream_routes):
+    """Send the spooled lines of the rate limiter which fit in its limits,
+    and return a dict of sink names to their number of other spooled lines,
+    which are dropped"""
+    rate_limiter = stream_routes.rate_limiter
+    if rate_limiter is None or not rate_limiter.spool:
+        return {}
+    for stream, line in rate_limiter.drain_spool(force=True):
+        for logger_log_line in stream_routes[stream]:
+            logger_log_line(stream, line)
+    sink_names = dict((id(logger), name) for name, logger in stream_routes.sinks)
+    abandoned = {}
+    for stream, _ in rate_limiter.clear_spool():
+        for logger in stream_routes.loggers_for(stream):
+            sink_name = sink_names[id(logger)]
+            abandoned[sink_name] = abandoned.get(sink_name, 0) + 1
+    return abandoned
+
+
+class _LoggerFlush(threading.Thread):
+    """Thread calling `flush(timeout)` on a logger. The result is a
+    (flushed, abandoned) tuple of line counts, both None if the flush failed.
+    """
+
+    def __init__(self, sink_name, logger, timeout):
+        super(_LoggerFlush, self).__init__(name='clog-flush-%s' % sink_name)
+        self.daemon = True
+        self.sink_name = sink_name
+        self.logger = logger
+        self.timeout = timeout
+        self.result = (None, None)
+
+    def run(self):
+        self.result = self.logger.flush(self.timeout)
+
+
+def _shutdown_at_exit():
+    if _stream_routes is not None:
+        shutdown(config.shutdown_timeout)
+
+
+atexit.register(_shutdown_at_exit)
+
+
+def log_line(stream, line, sample_key=None):
     """Log a single line to the global logger(s). If the line contains
     any newline characters each line will be logged as a separate message.
     If this is a problem for your log you should encode your log messages.
 
+    The line is only sent to the sinks selected for the stream by
+    `config.stream_sinks`, or to all of them if the stream has no route.
+    Streams listed in `config.stream_sample_rates` only keep a fraction of
+    their lines, and lines over the rate limits set in :mod:`clog.config`
+    are dropped, sampled or spooled.
+
     :param stream: name of the scribe stream to send this log
     :param line: contents of the log message
+    :param sample_key: optional key, like a request id, such that the lines
+        logged with the same key to sampled streams are kept or dropped
+        together
+    """
+    stream_routes = _stream_routes
+    if stream_routes is None:
+        stream_routes = _create_default_loggers()
+    stream_routes.stream_stats.add(stream, 1, len(line))
+    sampler = stream_routes.sampler
+    if sampler is not None and not sampler.keep(stream, sample_key):
+        return
+    rate_limiter = stream_routes.rate_limiter
+    if rate_limiter is not None and not rate_limiter.admit(stream, line):
+        return
+    for logger_log_line in stream_routes[stream]:
+        logger_log_line(stream, line)
+    if rate_limiter is not None and rate_limiter.spool:
+        _log_spooled_lines(stream_routes, rate_limiter)
+
+
+def _log_spooled_lines(stream_routes, rate_limiter):
+    for stream, line in rate_limiter.drain_spool():
+        for logger_log_line in stream_routes[stream]:
+            logger_log_line(stream, line)
+
+
+def log_lines(stream, lines, sample_key=None):
+    """Log several lines to the same stream with the global logger(s). Each
+    logger sends them with its bulk operation, which is cheaper than calling
+    :func:`log_line` for every line.
+
+    :param stream: name of the scribe stream to send these logs
+    :param lines: iterable of log messages
+    :param sample_key: optional key deciding whether all the lines are kept
+        if the stream is sampled, otherwise each line is sampled on its own
     """
-    check_create_default_loggers()
-    for logger in loggers:
-        logger.log_line(stream, line)
+    stream_routes = _stream_routes
+    if stream_routes is None:
+        stream_routes = _create_default_loggers()
+    if not isinstance(lines, (list, tuple)):
+        lines = list(lines)
+    stream_routes.stream_stats.add(stream, len(lines), sum(len(line) for line in lines))
+    sampler = stream_routes.sampler
+    if sampler is not None and sampler.rate_for(stream) < 1.0:
+        if sample_key is None:
+            lines = [line for line in lines if sampler.keep(stream)]
+        elif not sampler.keep(stream, sample_key):
+            return
+    rate_limiter = stream_routes.rate_limiter
+    stream_loggers = stream_routes.loggers_for(stream)
+    if rate_limiter is not None:
+        lines = [line for line in lines if rate_limiter.admit(stream, line)]
+    for logger in stream_loggers:
+        logger.log_lines(stream, lines)
+    if rate_limiter is not None and rate_limiter.spool:
+        _log_spooled_lines(stream_routes, rate_limiter)
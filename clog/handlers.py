@@ -19,9 +19,19 @@ logging to a scribe stream.
 """
 
 import logging
+import os
+import socket
+import threading
+import time
+from operator import attrgetter
 
+import simplejson as json
+from six.moves import queue
+
+from clog import config
 from clog.loggers import MonkLogger
 from clog.loggers import ScribeLogger
+from clog.metrics_reporter import MetricsReporter
 from clog.utils import scribify
 from clog.zipkin_plugin import use_zipkin, ZipkinTracing
 from clog import global_state
@@ -29,8 +39,46 @@ from clog import global_state
 
 DEFAULT_FORMAT = '%(process)s\t%(asctime)s\t%(name)-12s %(levelname)-8s: %(message)s'
 
+# Default record attributes written by JsonFormatter
+DEFAULT_JSON_FIELDS = ('created', 'levelname', 'name', 'message')
+
+# What asynchronous handlers do with a record when their queue is full
+QUEUE_FULL_DROP = 'drop'
+QUEUE_FULL_BLOCK = 'block'
+
+# Sentinel telling the listener thread of an asynchronous handler to stop
+_STOP_LISTENER = object()
 
-class CLogHandler(logging.Handler):
+
+class BatchEmitMixin(object):
+    """Mixin for handlers with a `stream` and a `logger` which adds
+    :meth:`emit_batch`, to send many records with a single call to the
+    logger's `log_lines`.
+    """
+
+    def emit_batch(self, records):
+        """Format and send several records at once. Records which fail to
+        format are passed to `handleError` and skipped.
+        """
+        msgs = []
+        for record in records:
+            try:
+                msgs.append(self.format(record))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.handleError(record)
+        if not msgs:
+            return
+        try:
+            self.logger.log_lines(self.stream, msgs)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(records[-1])
+
+
+class CLogHandler(BatchEmitMixin, logging.Handler):
     """
     .. deprecated:: 0.1.6
 
@@ -60,7 +108,7 @@ class CLogHandler(logging.Handler):
             self.handleError(record)
 
 
-class ScribeHandler(logging.Handler):
+class ScribeHandler(BatchEmitMixin, logging.Handler):
     """Handler for sending python standard logging messages to a scribe
     stream.
 
@@ -94,7 +142,7 @@ class ScribeHandler(logging.Handler):
             self.handleError(record)
 
 
-class MonkHandler(logging.Handler):
+class MonkHandler(BatchEmitMixin, logging.Handler):
     """Handler for sending python standard logging messages to a monk
         stream.
 
@@ -126,6 +174,252 @@ class MonkHandler(logging.Handler):
             self.handleError(record)
 
 
+class JsonFormatter(logging.Formatter):
+    """Formatter writing records as JSON objects, encoded in UTF-8 bytes so
+    that loggers can send them without encoding them again.
+
+    The static fields are encoded once and reused for every record, they are
+    only rebuilt when the process id changes after a fork.
+
+    .. code-block:: python
+
+        handler = clog.handlers.ScribeHandler('localhost', 3600, 'stream')
+        handler.setFormatter(clog.handlers.JsonFormatter(
+            fields=('created', 'levelname', 'message'),
+            static_fields={'service': 'my_service'},
+        ))
+
+    :param fields: names of the record attributes to write. `message` is the
+        formatted log message and `asctime` the creation time formatted with
+        `datefmt`. The formatted exception is added as `exc_text` for records
+        with exception info.
+    :param static_fields: dict of fields with the same value for every record
+    :param include_host: add the hostname as the `host` static field
+    :param include_pid: add the process id as the `pid` static field
+    :param datefmt: date format used for `asctime`
+    """
+
+    def __init__(self, fields=DEFAULT_JSON_FIELDS, static_fields=None,
+                 include_host=True, include_pid=True, datefmt=None):
+        logging.Formatter.__init__(self, datefmt=datefmt)
+        self.fields = tuple(fields)
+        self.static_fields = dict(static_fields or {})
+        self.include_host = include_host
+        self.include_pid = include_pid
+        self._getters = tuple((field, self._getter(field)) for field in self.fields)
+        self._pid = None
+        self._static_head = None
+        self._static_json = None
+
+    def _getter(self, field):
+        if field == 'message':
+            return logging.LogRecord.getMessage
+        if field == 'asctime':
+            return lambda record: self.formatTime(record, self.datefmt)
+        return attrgetter(field)
+
+    def _encode_static_fields(self):
+        static_fields = dict(self.static_fields)
+        if self.include_host:
+            static_fields['host'] = socket.gethostname()
+        if self.include_pid:
+            static_fields['pid'] = self._pid
+        self._static_json = _dump_json(static_fields)
+        # the dynamic fields are appended to this opening of the object
+        self._static_head = self._static_json[:-1] + (b',' if static_fields else b'')
+
+    def format(self, record):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._encode_static_fields()
+
+        values = {}
+        for field, getter in self._getters:
+            values[field] = getter(record)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            values['exc_text'] = record.exc_text
+
+        if not values:
+            return self._static_json
+        return self._static_head + _dump_json(values)[1:]
+
+
+def _dump_json(obj):
+    """Encode an object to compact JSON in UTF-8 bytes"""
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=repr).encode('UTF-8')
+
+
+class AsyncHandlerMixin(object):
+    """Mixin making a handler with :meth:`BatchEmitMixin.emit_batch`
+    asynchronous: `emit` only puts the record in a bounded queue, and a
+    listener thread formats and sends the queued records in batches.
+
+    The threads do not survive a fork, so the first record logged in a
+    forked child starts a new listener with an empty queue, the records
+    queued before the fork being sent by the parent.
+    """
+
+    def _start_listener(self, backend, max_queue_size, queue_full_policy, batch_size):
+        if queue_full_policy not in (QUEUE_FULL_DROP, QUEUE_FULL_BLOCK):
+            raise ValueError('Unknown queue_full_policy %r' % (queue_full_policy,))
+        self.max_queue_size = max_queue_size
+        self.queue_full_policy = queue_full_policy
+        self.batch_size = batch_size
+        self.metrics = MetricsReporter(backend=backend)
+        self._listener_name = 'clog-%s-%s' % (backend, self.stream)
+        self._spawn_listener()
+
+    def _spawn_listener(self):
+        self._pid = os.getpid()
+        self.queue = queue.Queue(self.max_queue_size)
+        self.dropped_records = 0
+        self.sent_records = 0
+        self._reported_dropped_records = 0
+        # deadline of the last flush with the default timeout, which close
+        # shares, see :meth:`close`
+        self._shutdown_deadline = None
+        self._listener = threading.Thread(target=self._listen, name=self._listener_name)
+        self._listener.daemon = True
+        self._listener.start()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # emit is called with the handler lock held
+            self._spawn_listener()
+        # new records get a whole timeout to be sent on close
+        self._shutdown_deadline = None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.queue_full_policy == QUEUE_FULL_BLOCK:
+                self.queue.put(record)
+            else:
+                # emit is called with the handler lock held
+                self.dropped_records += 1
+
+    def _listen(self):
+        while True:
+            records = [self.queue.get()]
+            while records[-1] is not _STOP_LISTENER and len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = records[-1] is _STOP_LISTENER
+            batch = records[:-1] if stop else records
+            try:
+                if batch:
+                    self.emit_batch(batch)
+                    self.sent_records += len(batch)
+                self._report_queue_metrics()
+            finally:
+                for _ in records:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _report_queue_metrics(self):
+        self.metrics.queue_depth(self.queue.qsize())
+        dropped_records = self.dropped_records
+        if dropped_records != self._reported_dropped_records:
+            self.metrics.queue_dropped(dropped_records - self._reported_dropped_records)
+            self._reported_dropped_records = dropped_records
+
+    def flush(self, timeout=None):
+        """Wait until the queued records are sent, at most `timeout` seconds
+        (default `config.shutdown_timeout`).
+
+        :returns: a (flushed, abandoned) tuple of record counts
+        """
+        if self._pid != os.getpid():
+            # nothing was logged by this process since the fork
+            return 0, 0
+        if timeout is None:
+            deadline = self._shutdown_deadline = time.time() + config.shutdown_timeout
+        else:
+            deadline = time.time() + timeout
+        sent_records = self.sent_records
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and time.time() < deadline:
+                self.queue.all_tasks_done.wait(deadline - time.time())
+            abandoned = self.queue.unfinished_tasks
+        return self.sent_records - sent_records, abandoned
+
+    def close(self, timeout=None):
+        """Send the queued records, at most for `timeout` seconds, and stop
+        the listener thread.
+
+        `logging.shutdown` calls :meth:`flush` then :meth:`close`, so by
+        default close only waits for what is left of the
+        `config.shutdown_timeout` of a previous :meth:`flush` with the
+        default timeout, when no record was logged since, and for a whole
+        `config.shutdown_timeout` otherwise.
+        """
+        if self._pid == os.getpid() and self._listener.is_alive():
+            if timeout is None and self._shutdown_deadline is not None:
+                timeout = max(0, self._shutdown_deadline - time.time())
+            elif timeout is None:
+                timeout = config.shutdown_timeout
+            deadline = time.time() + timeout
+            try:
+                self.queue.put(_STOP_LISTENER, timeout=timeout)
+            except queue.Full:
+                pass
+            self._listener.join(max(0, deadline - time.time()))
+        super(AsyncHandlerMixin, self).close()
+
+
+class AsyncScribeHandler(AsyncHandlerMixin, ScribeHandler):
+    """Asynchronous version of :class:`ScribeHandler`. Logging a record only
+    puts it in a queue, so a slow scribe server does not block the threads
+    which log. A listener thread formats and sends the queued records in
+    batches.
+
+    .. code-block:: python
+
+        import clog.handlers, logging
+        log = logging.getLogger(name)
+        log.addHandler(clog.handlers.AsyncScribeHandler('localhost', 3600, 'stream'))
+
+    :param host: hostname of scribe server
+    :param port: port number of scribe server
+    :param stream: name of the scribe stream logs will be sent to
+    :param retry_interval: default 0, number of seconds to wait between retries
+    :param max_queue_size: maximum number of queued records
+    :param queue_full_policy: QUEUE_FULL_DROP to drop records when the queue
+        is full, or QUEUE_FULL_BLOCK to wait for room in the queue
+    :param batch_size: maximum number of records sent at once
+    """
+
+    def __init__(self, host, port, stream, retry_interval=0, max_queue_size=10000,
+                 queue_full_policy=QUEUE_FULL_DROP, batch_size=100):
+        ScribeHandler.__init__(self, host, port, stream, retry_interval)
+        self._start_listener('async_scribe', max_queue_size, queue_full_policy, batch_size)
+
+
+class AsyncMonkHandler(AsyncHandlerMixin, MonkHandler):
+    """Asynchronous version of :class:`MonkHandler`, see
+    :class:`AsyncScribeHandler`.
+
+    :param client_id: client id to identify the user logging
+    :param stream: name of the monk stream logs will be sent to
+    :param host: hostname of monk server
+    :param port: port number of monk server
+    :param max_queue_size: maximum number of queued records
+    :param queue_full_policy: QUEUE_FULL_DROP to drop records when the queue
+        is full, or QUEUE_FULL_BLOCK to wait for room in the queue
+    :param batch_size: maximum number of records sent at once
+    """
+
+    def __init__(self, client_id, stream, host=None, port=None, max_queue_size=10000,
+                 queue_full_policy=QUEUE_FULL_DROP, batch_size=100):
+        MonkHandler.__init__(self, client_id, stream, host, port)
+        self._start_listener('async_monk', max_queue_size, queue_full_policy, batch_size)
+
+
 def add_logger_to_scribe(logger, log_level=logging.INFO, fmt=DEFAULT_FORMAT, clogger_object=None):
     """Sets up a logger to log to scribe.
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fixed memory histograms of integer values, like latencies in microseconds,
+with log-linear buckets in the manner of HdrHistogram.
+
+Values below `2 ** sub_bucket_bits` have a bucket each. Above, every power of
+two range is split in `2 ** (sub_bucket_bits - 1)` buckets of equal width,
+so a value is known with a relative error below `2 ** (1 - sub_bucket_bits)`
+(under 1.6% with the default 7 bits) whatever its magnitude.
+"""
+from __future__ import division
+
+import math
+
+DEFAULT_SUB_BUCKET_BITS = 7
+# about 19 hours in microseconds
+DEFAULT_MAX_VALUE = 2 ** 36 - 1
+
+# Percentiles of the snapshots, and their names
+SNAPSHOT_PERCENTILES = (('p50', 50.0), ('p99', 99.0), ('p999', 99.9))
+
+
+class LatencyHistogram(object):
+    """Histogram of the integer values between 0 and `max_value`, larger
+    values are counted as `max_value`. It is not thread safe.
+
+    :param max_value: largest value told apart from the others
+    :param sub_bucket_bits: precision of the buckets, see the module
+        documentation
+    """
+
+    def __init__(self, max_value=DEFAULT_MAX_VALUE, sub_bucket_bits=DEFAULT_SUB_BUCKET_BITS):
+        if sub_bucket_bits < 1:
+            raise ValueError('sub_bucket_bits must be at least 1')
+        self.max_value = int(max_value)
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 2 ** sub_bucket_bits
+        self.half_count = self.sub_bucket_count // 2
+        self.counts = [0] * (self._index(self.max_value) + 1)
+        self.reset()
+
+    def reset(self):
+        """Forget all the values"""
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.total_count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.half_count + (value >> shift) - self.half_count
+
+    def _highest_value(self, index):
+        """Largest value counted in the bucket `index`"""
+        if index < self.sub_bucket_count:
+            return index
+        shift, sub_bucket = divmod(index - self.sub_bucket_count, self.half_count)
+        return ((sub_bucket + self.half_count + 1) << (shift + 1)) - 1
+
+    def record(self, value, count=1):
+        """Count `value` `count` times"""
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self._index(value)] += count
+        self.total_count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values of a histogram with the same parameters"""
+        if (other.max_value, other.sub_bucket_bits) != (self.max_value, self.sub_bucket_bits):
+            raise ValueError('Cannot merge histograms with different buckets')
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total_count += other.total_count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """Return the value below which `percentile` percent of the values
+        fall, within the precision of the buckets, or None without values"""
+        if not self.total_count:
+            return None
+        rank = max(int(math.ceil(percentile / 100 * self.total_count)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        """Return a dict of the number of values, their min, max and mean,
+        and the p50, p99 and p999 percentiles"""
+        snapshot = {
+            'count': self.total_count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.total_count if self.total_count else None,
+        }
+        for name, percentile in SNAPSHOT_PERCENTILES:
+            snapshot[name] = self.percentile(percentile)
+        return snapshot
@@ -31,7 +31,6 @@ import socket
 import threading
 import time
 import traceback
-from collections import deque
 from logging.handlers import SysLogHandler
 from logging.handlers import SYSLOG_UDP_PORT
 
@@ -50,6 +49,8 @@ except ImportError:
 
 from clog import config
 from clog.metrics_reporter import MetricsReporter
+from clog.priority import create_priority_buffer
+from clog.stream_stats import create_stream_stats
 from clog.utils import scribify
 
 import thriftpy.transport.socket
@@ -129,23 +130,237 @@ def report_to_stderr(is_error, msg):
 def get_default_reporter(use_syslog=None):
     """Returns the default reporter based on the value of the argument
 
+    If `config.report_status_rate_limit` is set, the reporter is wrapped in
+    a :class:`RateLimitedReporter` shared by all the loggers.
+
     :param report_to_syslog: Whether to use syslog or stderr. Defaults to the value
         of `config.scribe_errors_to_syslog`
     """
     use_syslog = use_syslog if use_syslog is not None else config.scribe_errors_to_syslog
-    return report_to_syslog if use_syslog else report_to_stderr
+    reporter = report_to_syslog if use_syslog else report_to_stderr
+    if not config.report_status_rate_limit:
+        return reporter
+
+    settings = (reporter, int(config.report_status_window_seconds), int(config.report_status_rate_limit))
+    if settings not in _rate_limited_reporters:
+        _rate_limited_reporters[settings] = RateLimitedReporter(*settings)
+    return _rate_limited_reporters[settings]
+
+
+# RateLimitedReporter instances returned by get_default_reporter, by settings
+_rate_limited_reporters = {}
+
+
+def flush_default_reporters():
+    """Report the pending summaries of the reporters of
+    :func:`get_default_reporter`"""
+    for reporter in list(_rate_limited_reporters.values()):
+        reporter.flush()
+
 
+class RateLimitedReporter(object):
+    """Wrapper around a reporter function `report_status(is_error, msg)`
+    which keeps an outage from flooding it.
 
-def create_oversize_message_report(stream, line, preview_size=1000, traceback_size=5000):
+    A message is only passed on the first time it is seen in a window of
+    `window` seconds, its repetitions are just counted. When the window ends,
+    a summary with the number of repetitions of each message is reported,
+    by the next report or by a timer when nothing is reported after the
+    window, and by :meth:`flush`. On top of that, at most `max_per_second`
+    reports are passed on every second, the others are counted in the next
+    summary.
+
+    :param reporter: the wrapped reporter function
+    :param window: length in seconds of the deduplication window
+    :param max_per_second: maximum number of reports passed on per second
+    :param max_messages: maximum number of distinct messages counted in a
+        window, further messages are counted together
+    """
+
+    OTHER_MESSAGES = 'other messages'
+
+    def __init__(self, reporter, window=10, max_per_second=10, max_messages=1000):
+        self.reporter = reporter
+        self.window = window
+        self.max_per_second = max_per_second
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._counts = {}
+        self._second = int(self._window_start)
+        self._reports_in_second = 0
+        self._rate_limited = 0
+        # timer reporting the summary of a window nothing is reported after
+        self._timer = None
+
+    def __call__(self, is_error, msg):
+        now = time.time()
+        with self._lock:
+            summaries = self._end_window(now) if now - self._window_start >= self.window else ()
+
+            key = (is_error, msg)
+            if key not in self._counts and len(self._counts) >= self.max_messages:
+                key = (is_error, self.OTHER_MESSAGES)
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+            report = count == 0 and self._take_report(now)
+            if not report:
+                self._start_timer(now)
+
+        for summary in summaries:
+            self.reporter(*summary)
+        if report:
+            self.reporter(is_error, msg)
+
+    def flush(self):
+        """Report the summary of the current window now, and start a new
+        window"""
+        with self._lock:
+            summaries = self._end_window(time.time())
+        for summary in summaries:
+            self.reporter(*summary)
+
+    def _start_timer(self, now):
+        # the timers do not survive a fork, hence is_alive
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(
+            max(0, self._window_start + self.window - now), self._end_window_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _end_window_on_timer(self):
+        now = time.time()
+        with self._lock:
+            self._timer = None
+            if now - self._window_start < self.window:
+                # a report ended the window of the timer first
+                if self._rate_limited or any(count > 1 for count in self._counts.values()):
+                    self._start_timer(now)
+                return
+            summaries = self._end_window(now)
+        for summary in summaries:
+            self.reporter(*summary)
+
+    def _take_report(self, now):
+        """Whether one more report fits in the per second limit"""
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._reports_in_second = 0
+        if self._reports_in_second >= self.max_per_second:
+            self._rate_limited += 1
+            return False
+        self._reports_in_second += 1
+        return True
+
+    def _end_window(self, now):
+        """Start a new window and return the (is_error, msg) summaries of the
+        previous one.
+        """
+        elapsed = int(round(now - self._window_start))
+        summaries = []
+        for (is_error, msg), count in sorted(self._counts.items()):
+            if count > 1 and self._take_report(now):
+                summaries.append((
+                    is_error,
+                    '%d failures of type %r in last %ds' % (count, msg, elapsed),
+                ))
+        if self._rate_limited and self._take_report(now):
+            summaries.append((
+                True,
+                '%d reports dropped by the rate limit in last %ds' % (self._rate_limited, elapsed),
+            ))
+            self._rate_limited = 0
+        self._window_start = now
+        self._counts = {}
+        return summaries
+
+
+def create_oversize_message_report(stream, line, preview_size=1000, traceback_size=5000,
+                                   suppressed_count=0):
     message_report = {
         'stream': stream,
         'line_size': len(line),
         'line_preview': line[:preview_size],
         'traceback': ''.join(traceback.format_stack())[:traceback_size],
     }
+    if suppressed_count:
+        message_report['suppressed_count'] = suppressed_count
     return json.dumps(message_report).encode('UTF-8')
 
 
+def _call_site_key():
+    """Return a cheap key identifying the first caller outside of clog and
+    logging: its code object and current line number.
+    """
+    frame = sys._getframe(1)
+    while frame.f_back is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.split('.', 1)[0] not in ('clog', 'logging'):
+            break
+        frame = frame.f_back
+    return frame.f_code, frame.f_lineno
+
+
+def _stream_snapshot(stream_stats, count):
+    """Return the snapshot of the `stream_stats` of a logger, None when the
+    logger does not count its streams"""
+    if stream_stats is None:
+        return None
+    return stream_stats.snapshot(count)
+
+
+class OversizeLineReporter(object):
+    """Samples the reports of oversize lines by call site, so that a caller
+    logging large lines in a loop does not flood WHO_CLOG_LARGE_LINE_STREAM.
+
+    A call site is identified by the code object and line number of the
+    caller. Only the first oversize line of a call site in a window of
+    `window` seconds gets a full report with a traceback, the others are
+    just counted and the count is added to the next report of the site.
+
+    :param window: length in seconds of the sampling window
+    :param max_call_sites: maximum number of call sites tracked at once
+    """
+
+    def __init__(self, window=60, max_call_sites=1000):
+        self.window = window
+        self.max_call_sites = max_call_sites
+        # call site key -> [window start, lines suppressed in window, total lines]
+        self._call_sites = {}
+
+    def report(self, stream, line):
+        """Count an oversize line and return the JSON report to log for it,
+        or None if its call site was already reported in the current window.
+        """
+        key = _call_site_key()
+        now = time.time()
+        call_site = self._call_sites.get(key)
+        if call_site is not None:
+            call_site[2] += 1
+            if now - call_site[0] < self.window:
+                call_site[1] += 1
+                return None
+            suppressed_count = call_site[1]
+            call_site[0:2] = [now, 0]
+        else:
+            if len(self._call_sites) >= self.max_call_sites:
+                self._call_sites.clear()
+            self._call_sites[key] = [now, 0, 1]
+            suppressed_count = 0
+        return create_oversize_message_report(stream, line, suppressed_count=suppressed_count)
+
+    def call_site_counts(self):
+        """Return a dict of (filename, line number) call sites to the number
+        of oversize lines they logged.
+        """
+        return dict(
+            ((code.co_filename, lineno), call_site[2])
+            for (code, lineno), call_site in self._call_sites.items()
+        )
+
+
 class ScribeIsNotForkSafeError(Exception):
     pass
 
@@ -167,9 +382,14 @@ class ScribeLogger(object):
         and the second argument is the actual message.
     :param logging_timeout: milliseconds to time out scribe logging; "0" means
         blocking (no timeout)
+    :param rate_limiter: optional :class:`clog.rate_limit.StreamRateLimiter`
+        deciding which lines are sent
+    :param count_streams: whether the lines and bytes of each stream are
+        counted, False when the caller already counts them
     """
 
-    def __init__(self, host, port, retry_interval, report_status=None, logging_timeout=None):
+    def __init__(self, host, port, retry_interval, report_status=None, logging_timeout=None,
+                 rate_limiter=None, count_streams=True):
         # set up thrift and scribe objects
         timeout = logging_timeout if logging_timeout is not None else config.scribe_logging_timeout
         self.socket = thriftpy.transport.socket.TSocket(six.text_type(host), int(port))
@@ -185,6 +405,7 @@ class ScribeLogger(object):
         self.last_connect_time = 0 # last time we got disconnected or failed to reconnect
 
         self.retry_interval = retry_interval
+        self.rate_limiter = rate_limiter
         self.report_status = report_status or get_default_reporter()
         self.__lock = threading.RLock()
         self._birth_pid = os.getpid()
@@ -193,6 +414,15 @@ class ScribeLogger(object):
             sample_rate=config.metrics_sample_rate,
             backend="scribe"
         )
+        self.oversize_reporter = OversizeLineReporter()
+        self.stream_stats = create_stream_stats() if count_streams else None
+
+        # counters of stats()
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.failures = 0
+        self.connect_failures = 0
+        self.io_seconds = 0.0
 
     def _maybe_reconnect(self):
         """Try (re)connecting to the server if it's been long enough since our
@@ -208,24 +438,43 @@ class ScribeLogger(object):
                 self.connected = True
             except TTransportException:
                 self.last_connect_time = now
+                self.connect_failures += 1
+                self.metrics.reconnect(False)
                 self.report_status(True, 'yelp_clog failed to connect to scribe server')
+            else:
+                self.metrics.reconnect(True)
 
     def _log_line_no_size_limit(self, stream, line):
         """Log a single line without size limit. It should not include any newline characters.
            Since this method is called in log_line, the line should be in utf-8 format and
            less than MAX_SCRIBE_LINE_SIZE_IN_BYTES already.
         """
-        with self.__lock, self.metrics.sampled_request():
+        return self._log_lines_no_size_limit(stream, [line])
+
+    def _log_lines_no_size_limit(self, stream, lines):
+        """Log several lines to a stream with a single scribe call. The same
+           restrictions as for `_log_line_no_size_limit` apply to every line.
+        """
+        with self.__lock, self.metrics.sampled_request(len(lines), stream):
             if os.getpid() != self._birth_pid:
                 raise ScribeIsNotForkSafeError
             if not self.connected:
                 self._maybe_reconnect()
 
             if self.connected:
-                log_entry = scribe_thrift.LogEntry(category=scribify(stream), message=line + b'\n')
+                category = scribify(stream)
+                log_entries = [
+                    scribe_thrift.LogEntry(category=category, message=line + b'\n')
+                    for line in lines
+                ]
+                start_time = time.time()
                 try:
-                    return self.client.Log(messages=[log_entry])
+                    result = self.client.Log(messages=log_entries)
+                    self.lines_sent += len(lines)
+                    self.bytes_sent += sum(len(line) for line in lines)
+                    return result
                 except Exception as e:
+                    self.failures += 1
                     try:
                         self.report_status(
                             True,
@@ -238,6 +487,8 @@ class ScribeLogger(object):
 
                     # Don't reconnect if report_status raises an exception
                     self._maybe_reconnect()
+                finally:
+                    self.io_seconds += time.time() - start_time
 
     def log_line(self, stream, line):
         """Log a single line. It should not include any newline characters.
@@ -245,6 +496,28 @@ class ScribeLogger(object):
            If the line size is over 5 MB, a message consisting origin stream information
            will be recorded at WHO_CLOG_LARGE_LINE_STREAM (in json format).
         """
+        if self.rate_limiter is not None:
+            if not self.rate_limiter.admit(stream, line):
+                return
+            if self.stream_stats is not None:
+                self.stream_stats.add(stream, 1, len(line))
+            self._log_line_with_size_limit(stream, line)
+            self._log_spooled_lines()
+        else:
+            if self.stream_stats is not None:
+                self.stream_stats.add(stream, 1, len(line))
+            self._log_line_with_size_limit(stream, line)
+
+    def _log_spooled_lines(self):
+        """Send the lines of the rate limiter spool which now fit in its
+        limits"""
+        if self.rate_limiter.spool:
+            for spooled_stream, spooled_line in self.rate_limiter.drain_spool():
+                if self.stream_stats is not None:
+                    self.stream_stats.add(spooled_stream, 1, len(spooled_line))
+                self._log_line_with_size_limit(spooled_stream, spooled_line)
+
+    def _log_line_with_size_limit(self, stream, line):
         # log unicodes as their utf-8 encoded representation
         if isinstance(line, six.text_type):
             line = line.encode('UTF-8')
@@ -254,15 +527,7 @@ class ScribeLogger(object):
             self._log_line_no_size_limit(stream, line)
         elif len(line) <= MAX_SCRIBE_LINE_SIZE_IN_BYTES:
             self._log_line_no_size_limit(stream, line)
-
-            # log the origin of the stream with traceback to WHO_CLOG_LARGE_LINE_STREAM category
-            oversize_message_report = create_oversize_message_report(stream, line)
-            self._log_line_no_size_limit(WHO_CLOG_LARGE_LINE_STREAM, oversize_message_report)
-            self.report_status(
-                False,
-                'The log line size is larger than %r bytes (monitored in \'%s\')'
-                % (WARNING_SCRIBE_LINE_SIZE_IN_BYTES, WHO_CLOG_LARGE_LINE_STREAM)
-            )
+            self._report_oversize_line(stream, line)
         else:
             # raise an exception if too large
             self.report_status(
@@ -273,21 +538,134 @@ class ScribeLogger(object):
             raise LogLineIsTooLongError('The max log line size allowed is %r bytes'
                 % MAX_SCRIBE_LINE_SIZE_IN_BYTES)
 
+    def _report_oversize_line(self, stream, line):
+        # log the origin of the stream with traceback to WHO_CLOG_LARGE_LINE_STREAM category,
+        # once per call site and sampling window
+        oversize_message_report = self.oversize_reporter.report(stream, line)
+        if oversize_message_report is None:
+            return
+        self._log_line_no_size_limit(WHO_CLOG_LARGE_LINE_STREAM, oversize_message_report)
+        self.report_status(
+            False,
+            'The log line size is larger than %r bytes (monitored in \'%s\')'
+            % (WARNING_SCRIBE_LINE_SIZE_IN_BYTES, WHO_CLOG_LARGE_LINE_STREAM)
+        )
+
+    def log_lines(self, stream, lines):
+        """Log several lines to the same stream. The lines are sent with as few
+           scribe calls as possible, each carrying at most
+           MAX_SCRIBE_LINE_SIZE_IN_BYTES of data.
+           Size limits are applied to each line as in `log_line`: oversize lines
+           are reported, and lines over 50 MB are dropped and cause a
+           LogLineIsTooLongError to be raised once all the other lines are sent.
+        """
+        if self.rate_limiter is not None:
+            lines = [line for line in lines if self.rate_limiter.admit(stream, line)]
+
+        batch = []
+        batch_bytes = 0
+        oversize_lines = []
+        dropped_lines = 0
+        total_lines = 0
+        total_bytes = 0
+        for line in lines:
+            if isinstance(line, six.text_type):
+                line = line.encode('UTF-8')
+            total_lines += 1
+            total_bytes += len(line)
+
+            if len(line) > MAX_SCRIBE_LINE_SIZE_IN_BYTES:
+                dropped_lines += 1
+                continue
+            if len(line) > WARNING_SCRIBE_LINE_SIZE_IN_BYTES:
+                oversize_lines.append(line)
+
+            if batch and batch_bytes + len(line) > MAX_SCRIBE_LINE_SIZE_IN_BYTES:
+                self._log_lines_no_size_limit(stream, batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(line)
+            batch_bytes += len(line)
+
+        if batch:
+            self._log_lines_no_size_limit(stream, batch)
+        if total_lines and self.stream_stats is not None:
+            self.stream_stats.add(stream, total_lines, total_bytes)
+
+        for line in oversize_lines:
+            self._report_oversize_line(stream, line)
+
+        if self.rate_limiter is not None:
+            self._log_spooled_lines()
+
+        if dropped_lines:
+            self.report_status(
+                True,
+                '%d log lines are dropped (line size larger than %r bytes)'
+                % (dropped_lines, MAX_SCRIBE_LINE_SIZE_IN_BYTES)
+            )
+            raise LogLineIsTooLongError('The max log line size allowed is %r bytes'
+                % MAX_SCRIBE_LINE_SIZE_IN_BYTES)
+
+    def flush(self, timeout=None):
+        """Lines are sent synchronously, so only the lines of the rate
+        limiter spool which fit in its limits are sent, the others are
+        abandoned.
+
+        :returns: a (flushed, abandoned) tuple of line counts
+        """
+        if self.rate_limiter is None:
+            return 0, 0
+        flushed = 0
+        for spooled_stream, spooled_line in self.rate_limiter.drain_spool(force=True):
+            if self.stream_stats is not None:
+                self.stream_stats.add(spooled_stream, 1, len(spooled_line))
+            self._log_line_with_size_limit(spooled_stream, spooled_line)
+            flushed += 1
+        return flushed, len(self.rate_limiter.clear_spool())
+
+    def stats(self, count=None):
+        """Return a dict of the state of the logger: whether it is
+        `connected`, the `last_connect_time` it got disconnected or failed to
+        connect, the `lines_sent` and `bytes_sent`, the `failures` to send,
+        the `connect_failures`, the `io_seconds` spent sending, the number
+        of `spooled_lines` of its rate limiter, and the lines and bytes of
+        its heaviest `streams`, None without `count_streams`
+
+        :param count: maximum number of streams
+        """
+        return {
+            'connected': self.connected,
+            'last_connect_time': self.last_connect_time,
+            'lines_sent': self.lines_sent,
+            'bytes_sent': self.bytes_sent,
+            'failures': self.failures,
+            'connect_failures': self.connect_failures,
+            'io_seconds': self.io_seconds,
+            'spooled_lines': len(self.rate_limiter.spool) if self.rate_limiter is not None else 0,
+            'streams': _stream_snapshot(self.stream_stats, count),
+        }
+
     def close(self):
         self.transport.close()
         self.connected = False
 
 
 class MonkLogger(object):
-    """Wrapper around MonkProducer"""
+    """Wrapper around MonkProducer
 
-    def __init__(self, client_id, host=None, port=None):
+    :param count_streams: whether the lines and bytes of each stream are
+        counted, False when the caller already counts them
+    """
+
+    def __init__(self, client_id, host=None, port=None, count_streams=True):
         self.stream_prefix = config.monk_stream_prefix
         self.report_status = get_default_reporter()
         self.metrics = MetricsReporter(
             sample_rate=config.metrics_sample_rate,
             backend="monk"
         )
+        self.oversize_reporter = OversizeLineReporter()
         jitter_s = random.random() * (config.monk_timeout_backoff_jitter_ms / 1000.0)
         self.timeout_backoff_s = (config.monk_timeout_backoff_ms / 1000.0) + jitter_s
         self.last_disconnect = time.time() - self.timeout_backoff_s
@@ -301,71 +679,178 @@ class MonkLogger(object):
 
         self.use_buffer = config.monk_use_memory_buffer.value
         self.maximum_buffer_bytes = config.monk_memory_buffer_max_bytes.value
-        self.buffer = deque()
+        self.buffer = create_priority_buffer()
         self.buffer_bytes = 0
+        self.stream_stats = create_stream_stats() if count_streams else None
+
+        # counters of stats()
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.failures = 0
+        self.io_seconds = 0.0
 
     def log_line(self, stream, line):
         # For backward-compatibility with the ScribeLogger
         stream = scribify(stream)
+        if self.stream_stats is not None:
+            self.stream_stats.add(stream, 1, len(line))
         if len(line) <= MAX_MONK_LINE_SIZE_IN_BYTES:
             self._log_line_no_size_limit(stream, line)
         else:
-            # log the origin of the stream with traceback to WHO_CLOG_LARGE_LINE_STREAM
-            oversize_message_report = create_oversize_message_report(stream, line)
+            self._report_oversize_line(stream, line)
+
+    def _report_oversize_line(self, stream, line):
+        # log the origin of the stream with traceback to WHO_CLOG_LARGE_LINE_STREAM,
+        # once per call site and sampling window
+        oversize_message_report = self.oversize_reporter.report(stream, line)
+        if oversize_message_report is not None:
             self._log_line_no_size_limit(WHO_CLOG_LARGE_LINE_STREAM, oversize_message_report)
             self.report_status(
                 False,
                 'The log line size is larger than %r bytes (monitored in \'%s\')'
                 % (MAX_MONK_LINE_SIZE_IN_BYTES, WHO_CLOG_LARGE_LINE_STREAM)
             )
-            self.metrics.monk_exception()
+        self.metrics.monk_exception()
+
+    def log_lines(self, stream, lines):
+        """Log several lines to the same stream with a single producer call.
+        Lines over MAX_MONK_LINE_SIZE_IN_BYTES are dropped and reported, as in
+        `log_line`.
+        """
+        stream = scribify(stream)
+        valid_lines = []
+        total_lines = 0
+        total_bytes = 0
+        for line in lines:
+            total_lines += 1
+            total_bytes += len(line)
+            if len(line) <= MAX_MONK_LINE_SIZE_IN_BYTES:
+                valid_lines.append(line)
+            else:
+                self._report_oversize_line(stream, line)
+        if total_lines and self.stream_stats is not None:
+            self.stream_stats.add(stream, total_lines, total_bytes)
+
+        if valid_lines:
+            self._log_lines_no_size_limit(stream, valid_lines)
 
     def _log_line_no_size_limit(self, stream, line, can_flush_buffer=True):
+        return self._log_lines_no_size_limit(stream, [line], can_flush_buffer)
+
+    def _log_lines_no_size_limit(self, stream, lines, can_flush_buffer=True):
         now = time.time()
         if now - self.last_disconnect < self.timeout_backoff_s:
-            self._add_to_buffer(stream, line)
-            return
+            for line in lines:
+                self._add_to_buffer(stream, line)
+            return False
         elif can_flush_buffer and self.use_buffer and len(self.buffer) > 0:
             self._flush_buffer()
             self.report_status(False, 'Flushed buffer ({} left)'.format(len(self.buffer)))
 
-        with self.metrics.sampled_request():
+        if self._send_messages(stream, lines):
+            return True
+
+        self.last_disconnect = now
+        if self.use_buffer:
+            self.report_status(False, 'Start buffering')
+            for line in lines:
+                self._add_to_buffer(stream, line)
+        return False
+
+    def _send_messages(self, stream, lines):
+        """Send lines to Monk, returns whether it succeeded"""
+        with self.metrics.sampled_request(len(lines), stream):
+            start_time = time.time()
             try:
                 self.producer.send_messages(
                     self.stream_prefix + stream,
-                    [line],
+                    lines,
                     None
                 )
+                self.lines_sent += len(lines)
+                self.bytes_sent += sum(len(line) for line in lines)
+                return True
             except Exception as e:
+                self.failures += 1
                 if isinstance(e, socket.timeout):
                     self.report_status(True, 'Monk took too long to respond')
                     self.metrics.monk_timeout()
                 else:
                     self.report_status(True, 'Exception while sending to monk: %s' % str(e))
                     self.metrics.monk_exception()
-
-                self.last_disconnect = now
-                if self.use_buffer:
-                    self.report_status(False, 'Start buffering')
-                    self._add_to_buffer(stream, line)
+                return False
+            finally:
+                self.io_seconds += time.time() - start_time
 
     def _add_to_buffer(self, stream, line):
         if not self.use_buffer:
             return
 
+        # evict the least important lines first, but never a more important
+        # line than the new one
+        priority = self.buffer.priority_of(stream)
         while self.buffer_bytes + len(line) > self.maximum_buffer_bytes and len(self.buffer) > 0:
-            _, old_line = self.buffer.popleft()
+            if self.buffer.lowest_priority() < priority:
+                return
+            _, old_line = self.buffer.evict()
             self.buffer_bytes -= len(old_line)
 
-        self.buffer.append((stream, line))
+        for _, old_line in self.buffer.append((stream, line)):
+            self.buffer_bytes -= len(old_line)
         self.buffer_bytes += len(line)
+        self.metrics.buffer_bytes(self.buffer_bytes)
 
     def _flush_buffer(self):
-        for _ in six.moves.range(len(self.buffer)):
-            stream, line = self.buffer.popleft()
-            self.buffer_bytes -= len(line)
+        # lines which fail again are buffered again, send each line once
+        buffered_lines = list(self.buffer)
+        self.buffer.clear()
+        self.buffer_bytes = 0
+        self.metrics.buffer_bytes(0)
+        for stream, line in buffered_lines:
             self._log_line_no_size_limit(stream, line, can_flush_buffer=False)
 
+    def flush(self, timeout=None):
+        """Send the buffered lines, even during a timeout backoff, until the
+        buffer is empty, Monk fails or `timeout` seconds have passed.
+
+        :returns: a (flushed, abandoned) tuple of line counts
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        flushed = 0
+        while len(self.buffer) > 0 and (deadline is None or time.time() < deadline):
+            stream, line = self.buffer[0]
+            if not self._send_messages(stream, [line]):
+                self.last_disconnect = time.time()
+                break
+            self.buffer.popleft()
+            self.buffer_bytes -= len(line)
+            flushed += 1
+        return flushed, len(self.buffer)
+
+    def stats(self, count=None):
+        """Return a dict of the state of the logger: whether it is
+        `connected`, that is not backing off after a failure, the
+        `last_disconnect` time, the `lines_sent` and `bytes_sent`, the
+        `failures` to send, the `io_seconds` spent sending, the
+        `buffer_lines` and `buffer_bytes` waiting to be sent and the
+        `buffer_max_bytes`, and the lines and bytes of its heaviest
+        `streams`, None without `count_streams`
+
+        :param count: maximum number of streams
+        """
+        return {
+            'connected': time.time() - self.last_disconnect >= self.timeout_backoff_s,
+            'last_disconnect': self.last_disconnect,
+            'lines_sent': self.lines_sent,
+            'bytes_sent': self.bytes_sent,
+            'failures': self.failures,
+            'io_seconds': self.io_seconds,
+            'buffer_lines': len(self.buffer),
+            'buffer_bytes': self.buffer_bytes,
+            'buffer_max_bytes': self.maximum_buffer_bytes,
+            'streams': _stream_snapshot(self.stream_stats, count),
+        }
+
     def close(self):
         self._flush_buffer()
         self.producer.close()
@@ -389,18 +874,107 @@ class ScribeMonkLogger(object):
         if backend in ('scribe', 'dual'):
             self.scribe_logger.log_line(stream, line)
 
+    def log_lines(self, stream, lines):
+        backend = self.preferred_backend_map.get(stream, config.preferred_backend)
+        if backend == 'dual':
+            lines = list(lines)
+        if backend in ('monk', 'dual'):
+            self.monk_logger.log_lines(stream, lines)
+        if backend in ('scribe', 'dual'):
+            self.scribe_logger.log_lines(stream, lines)
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        scribe_flushed, scribe_abandoned = self.scribe_logger.flush(timeout)
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        monk_flushed, monk_abandoned = self.monk_logger.flush(remaining)
+        return scribe_flushed + monk_flushed, scribe_abandoned + monk_abandoned
+
+    def stats(self, count=None):
+        """Return a dict of the `stats()` of the `scribe` and `monk` loggers"""
+        return {
+            'scribe': self.scribe_logger.stats(count),
+            'monk': self.monk_logger.stats(count),
+        }
+
     def close(self):
         self.scribe_logger.close()
         self.monk_logger.close()
 
 
 class FileLogger(object):
-    """Implementation that logs to local files under a directory"""
+    """Implementation that logs to local files under a directory
 
-    def __init__(self):
+    :param count_streams: whether the lines and bytes of each stream are
+        counted, False when the caller already counts them
+    """
+
+    def __init__(self, count_streams=True):
         self.stream_files = {}
+        self.stream_stats = create_stream_stats() if count_streams else None
+        # counters of stats()
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.io_seconds = 0.0
 
     def log_line(self, stream, line):
+        if isinstance(line, six.text_type):
+            line = line.encode('UTF-8')
+        if self.stream_stats is not None:
+            self.stream_stats.add(stream, 1, len(line))
+        self._write(stream, line + b'\n', 1)
+
+    def log_lines(self, stream, lines):
+        """Log several lines to the same stream with a single write"""
+        lines = [
+            line.encode('UTF-8') if isinstance(line, six.text_type) else line
+            for line in lines
+        ]
+        if lines:
+            if self.stream_stats is not None:
+                self.stream_stats.add(stream, len(lines), sum(len(line) for line in lines))
+            self._write(stream, b'\n'.join(lines) + b'\n', len(lines))
+
+    def _write(self, stream, data, lines):
+        stream_file = self._get_file(stream)
+        start_time = time.time()
+        try:
+            stream_file.write(data)
+        finally:
+            self.io_seconds += time.time() - start_time
+        self.lines_sent += lines
+        self.bytes_sent += len(data)
+
+    def flush(self, timeout=None):
+        """Flush the files, lines are not buffered by the logger itself.
+
+        :returns: a (flushed, abandoned) tuple of line counts
+        """
+        for stream_file in self.stream_files.values():
+            stream_file.flush()
+        return 0, 0
+
+    def stats(self, count=None):
+        """Return a dict of the state of the logger: the number of
+        `open_files`, the `lines_sent` and `bytes_sent` to them, the
+        `io_seconds` spent writing, and the lines and bytes of its heaviest
+        `streams`, None without `count_streams`
+
+        :param count: maximum number of streams
+        """
+        return {
+            'open_files': len(self.stream_files),
+            'lines_sent': self.lines_sent,
+            'bytes_sent': self.bytes_sent,
+            'io_seconds': self.io_seconds,
+            'streams': _stream_snapshot(self.stream_stats, count),
+        }
+
+    def close(self):
+        for name in self.stream_files:
+            self.stream_files[name].close()
+
+    def _get_file(self, stream):
         # N.B. we don't scribify() the stream name here, so if you have unusual
         # characters in the stream name the local file name could be different
         # from the scribe name.
@@ -417,14 +991,7 @@ class FileLogger(object):
                     file=sys.stderr,
                 )
                 raise
-
-        if isinstance(line, six.text_type):
-            line = line.encode('UTF-8')
-        self.stream_files[stream].write(line + b'\n')
-
-    def close(self):
-        for name in self.stream_files:
-            self.stream_files[name].close()
+        return self.stream_files[stream]
 
     def _create_file(self, stream):
         return open(os.path.join(config.log_dir, stream + '.log'), 'ab', 0)
@@ -465,21 +1032,69 @@ class MockLogger(object):
         assert isinstance(line, (bytes, six.text_type)), type(line)
         self.lines.setdefault(stream, []).append(line)
 
+    def log_lines(self, stream, lines):
+        for line in lines:
+            self.log_line(stream, line)
+
     def clear_lines(self, stream):
         del self.lines.setdefault(stream, [])[:]
 
     def list_lines(self, stream):
         return self.lines.setdefault(stream, [])
 
+    def flush(self, timeout=None):
+        return 0, 0
+
+    def stats(self, count=None):
+        return {'lines_sent': sum(len(lines) for lines in self.lines.values())}
+
     def close(self):
         pass
 
 
 class StdoutLogger(object):
-    """Implementation that logs to stdout with stream name as a prefix."""
+    """Implementation that logs to stdout with stream name as a prefix.
+
+    :param count_streams: whether the lines and bytes of each stream are
+        counted, False when the caller already counts them
+    """
+
+    def __init__(self, count_streams=True):
+        self.stream_stats = create_stream_stats() if count_streams else None
+        # counters of stats()
+        self.lines_sent = 0
+        self.bytes_sent = 0
 
     def log_line(self, stream, line):
+        if self.stream_stats is not None:
+            self.stream_stats.add(stream, 1, len(line))
+        self.lines_sent += 1
+        self.bytes_sent += len(line)
         sys.stdout.write('{0}:{1}\n'.format(stream, line))
 
+    def log_lines(self, stream, lines):
+        lines = list(lines)
+        if lines:
+            size = sum(len(line) for line in lines)
+            if self.stream_stats is not None:
+                self.stream_stats.add(stream, len(lines), size)
+            self.lines_sent += len(lines)
+            self.bytes_sent += size
+        sys.stdout.write(''.join('{0}:{1}\n'.format(stream, line) for line in lines))
+
+    def flush(self, timeout=None):
+        sys.stdout.flush()
+        return 0, 0
+
+    def stats(self, count=None):
+        """Return a dict of the `lines_sent` and `bytes_sent` by the logger,
+        and the lines and bytes of its heaviest `streams`, None without
+        `count_streams`"""
+        return {
+            'lines_sent': self.lines_sent,
+            'bytes_sent': self.bytes_sent,
+            'streams': _stream_snapshot(self.stream_stats, count),
+        }
+
     def close(self):
         sys.stdout.flush()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Backends of the metrics of :class:`clog.metrics_reporter.MetricsReporter`,
+chosen by `config.metrics_backend`:
+
+    **meteorite**
+        the metrics of `yelp_meteorite` when it is installed, none otherwise
+
+    **statsd**
+        :class:`StatsdBackend` sends them over UDP to
+        `config.statsd_host`:`config.statsd_port`
+
+    **prometheus**
+        :class:`PrometheusTextfileBackend` writes them to a file per process
+        next to `config.prometheus_textfile_path`, for the textfile collector
+        of the node exporter
+
+    **none**
+        no metrics
+
+The backends aggregate the metrics in memory and only send them every
+`config.metrics_flush_interval` seconds, checked whenever a metric changes,
+instead of making a system call per metric.
+"""
+import errno
+import os
+import re
+import socket
+import threading
+import time
+
+import six
+
+from clog import config
+
+METRICS_BACKEND_METEORITE = 'meteorite'
+METRICS_BACKEND_STATSD = 'statsd'
+METRICS_BACKEND_PROMETHEUS = 'prometheus'
+METRICS_BACKEND_NONE = 'none'
+METRICS_BACKENDS = (
+    METRICS_BACKEND_METEORITE,
+    METRICS_BACKEND_STATSD,
+    METRICS_BACKEND_PROMETHEUS,
+    METRICS_BACKEND_NONE,
+)
+
+# Largest statsd packet, to avoid IP fragmentation on a 1500 bytes MTU
+DEFAULT_STATSD_PACKET_SIZE = 1432
+# Maximum number of values of a timer kept between two statsd flushes
+MAX_TIMER_VALUES = 1000
+
+
+class Metric(object):
+    """Counter, gauge or timer of a :class:`MetricsBackend`, with the
+    methods of the `yelp_meteorite` metrics"""
+
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def count(self, value=1):
+        self.backend.add_count(self.key, value)
+
+    def set(self, value):
+        self.backend.set_gauge(self.key, value)
+
+    def record(self, value):
+        self.backend.add_timing(self.key, value)
+
+
+class MetricsBackend(object):
+    """Aggregate the metrics and send them every `flush_interval` seconds.
+
+    The metrics are identified by a key of their name and their sorted
+    dimensions. Subclasses implement :meth:`send`.
+
+    :param flush_interval: minimum number of seconds between two sends
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+        # serializes the sends, which are made outside of self._lock
+        self._send_lock = threading.Lock()
+        self._next_flush = time.time() + flush_interval
+
+    def _key(self, name, dimensions):
+        return (name, tuple(sorted((dimensions or {}).items())))
+
+    def create_counter(self, name, dimensions=None):
+        key = self._key(name, dimensions)
+        with self._lock:
+            self.counters.setdefault(key, 0)
+        return Metric(self, key)
+
+    def create_gauge(self, name, dimensions=None):
+        return Metric(self, self._key(name, dimensions))
+
+    def create_timer(self, name, dimensions=None):
+        return Metric(self, self._key(name, dimensions))
+
+    def add_count(self, key, value):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def set_gauge(self, key, value):
+        with self._lock:
+            self.gauges[key] = value
+        self._maybe_flush()
+
+    def add_timing(self, key, value):
+        with self._lock:
+            self.timers.setdefault(key, []).append(value)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        now = time.time()
+        if now < self._next_flush:
+            return
+        with self._lock:
+            # only the first of the threads seeing the deadline flushes
+            if now < self._next_flush:
+                return
+            self._next_flush = now + self.flush_interval
+        self._flush()
+
+    def flush(self):
+        """Send the metrics now"""
+        with self._lock:
+            self._next_flush = time.time() + self.flush_interval
+        self._flush()
+
+    def _flush(self):
+        # the metrics are taken under the send lock so that the sends are
+        # made in the order of their snapshots
+        with self._send_lock:
+            with self._lock:
+                counters = dict(self.counters)
+                gauges = dict(self.gauges)
+                timers = self.timers
+                self.timers = {}
+                self._reset_counters()
+            self.send(counters, gauges, timers)
+
+    def _reset_counters(self):
+        pass
+
+    def send(self, counters, gauges, timers):
+        """Send dicts of metric keys to counter values, gauge values and
+        lists of timer values"""
+        raise NotImplementedError
+
+
+class StatsdBackend(MetricsBackend):
+    """Send the metrics to a statsd server, packing as many as possible in
+    each UDP packet. The dimensions are sent as DogStatsD tags, which
+    Telegraf and the Datadog agent understand, and the timer values are sent
+    unchanged, in the unit of their metric name.
+
+    The counters are sent as the increments since the previous flush, and
+    at most `MAX_TIMER_VALUES` values of each timer are kept between two
+    flushes.
+
+    :param host: host of the statsd server
+    :param port: UDP port of the statsd server
+    :param flush_interval: minimum number of seconds between two sends
+    :param max_packet_size: maximum size in bytes of a packet
+    """
+
+    def __init__(self, host, port, flush_interval, max_packet_size=DEFAULT_STATSD_PACKET_SIZE):
+        super(StatsdBackend, self).__init__(flush_interval)
+        self.address = (host, port)
+        self.max_packet_size = max_packet_size
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def add_timing(self, key, value):
+        with self._lock:
+            values = self.timers.setdefault(key, [])
+            if len(values) < MAX_TIMER_VALUES:
+                values.append(value)
+        self._maybe_flush()
+
+    def _reset_counters(self):
+        self.counters = {}
+
+    def send(self, counters, gauges, timers):
+        lines = []
+        for key, value in counters.items():
+            if value:
+                lines.append(self._format(key, value, 'c'))
+        for key, value in gauges.items():
+            lines.append(self._format(key, value, 'g'))
+        for key, values in timers.items():
+            lines.extend(self._format(key, value, 'ms') for value in values)
+        for packet in self._packets(lines):
+            try:
+                self.socket.sendto(packet, self.address)
+            except socket.error:
+                # metrics are best effort
+                pass
+
+    def _format(self, key, value, metric_type):
+        name, dimensions = key
+        line = '%s:%s|%s' % (name, _format_value(value), metric_type)
+        if dimensions:
+            line += '|#' + ','.join('%s:%s' % dimension for dimension in dimensions)
+        return line.encode('UTF-8')
+
+    def _packets(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + 1 + len(line) > self.max_packet_size:
+                yield b'\n'.join(packet)
+                packet = []
+                size = 0
+            size += len(line) + (1 if packet else 0)
+            packet.append(line)
+        if packet:
+            yield b'\n'.join(packet)
+
+
+class PrometheusTextfileBackend(MetricsBackend):
+    """Write the metrics to a file in the Prometheus text exposition format,
+    replaced atomically on every flush, for the textfile collector of the
+    node exporter.
+
+    Each process writes its own file, `path` with the pid of the process
+    before `.prom`, and its metrics have a `pid` label, so that the workers
+    and mules of uwsgi neither overwrite the files of each other nor write
+    the same series. The files of the processes which are gone are removed
+    on every flush.
+
+    Counters are written as totals since the start of the process, gauges
+    as their last value, and timers as summaries with the `_sum` and
+    `_count` of their values since the start of the process. The dots of
+    the names become underscores.
+
+    :param path: path of the file, ending with `.prom`
+    :param flush_interval: minimum number of seconds between two writes
+    """
+
+    def __init__(self, path, flush_interval):
+        super(PrometheusTextfileBackend, self).__init__(flush_interval)
+        self.path = path
+        # timer key -> [sum, count]
+        self.summaries = {}
+
+    def process_path(self, pid):
+        """Path of the file of the process `pid`"""
+        base = self.path[:-len('.prom')] if self.path.endswith('.prom') else self.path
+        return '%s.%d.prom' % (base, pid)
+
+    def send(self, counters, gauges, timers):
+        for key, values in timers.items():
+            summary = self.summaries.setdefault(key, [0, 0])
+            summary[0] += sum(values)
+            summary[1] += len(values)
+
+        # read on every send, the backend may have been created before a fork
+        pid = os.getpid()
+        lines = []
+        self._add_family(lines, 'counter', counters.items(), pid)
+        self._add_family(lines, 'gauge', gauges.items(), pid)
+        summary_values = []
+        for (name, dimensions), (total, count) in self.summaries.items():
+            summary_values.append(((name + '_sum', dimensions), total))
+            summary_values.append(((name + '_count', dimensions), count))
+        self._add_family(lines, 'summary', summary_values, pid, suffixes=('_sum', '_count'))
+
+        path = self.process_path(pid)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'w') as temp_file:
+                temp_file.write(''.join(lines))
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            # metrics are best effort, the next flush writes them again
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        self._remove_dead_process_files()
+
+    def _remove_dead_process_files(self):
+        directory, name = os.path.split(self.process_path(0))
+        prefix = name[:-len('0.prom')]
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            return
+        for name in names:
+            pid = name[len(prefix):-len('.prom')]
+            if not (name.startswith(prefix) and name.endswith('.prom') and pid.isdigit()):
+                continue
+            if _process_exists(int(pid)):
+                continue
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _add_family(self, lines, metric_type, values, pid, suffixes=('',)):
+        families = {}
+        for (name, dimensions), value in values:
+            family = name
+            for suffix in suffixes:
+                if suffix and name.endswith(suffix):
+                    family = name[:-len(suffix)]
+            families.setdefault(_prometheus_name(family), []).append(
+                (_prometheus_name(name), dimensions, value))
+        for family in sorted(families):
+            lines.append('# TYPE %s %s\n' % (family, metric_type))
+            for name, dimensions, value in sorted(families[family]):
+                labels = ''.join(
+                    '%s="%s",' % (_prometheus_name(label), _escape_label(label_value))
+                    for label, label_value in dimensions
+                )
+                lines.append('%s{%spid="%d"} %s\n' % (name, labels, pid, _format_value(value)))
+
+
+class NullMetricsBackend(MetricsBackend):
+    """Backend dropping all the metrics"""
+
+    def __init__(self):
+        super(NullMetricsBackend, self).__init__(flush_interval=float('inf'))
+
+    def create_counter(self, name, dimensions=None):
+        return Metric(self, None)
+
+    def add_count(self, key, value):
+        pass
+
+    def set_gauge(self, key, value):
+        pass
+
+    def add_timing(self, key, value):
+        pass
+
+    def send(self, counters, gauges, timers):
+        pass
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _prometheus_name(name):
+    return re.sub('[^a-zA-Z0-9_:]', '_', name)
+
+
+def _escape_label(value):
+    if not isinstance(value, six.string_types):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def create_metrics_backend():
+    """Build the backend of `config.metrics_backend`, None for `meteorite`"""
+    name = config.metrics_backend
+    if name not in METRICS_BACKENDS:
+        raise ValueError('Unknown metrics backend %r' % (name,))
+    flush_interval = float(config.metrics_flush_interval)
+    if name == METRICS_BACKEND_STATSD:
+        return StatsdBackend(str(config.statsd_host), int(config.statsd_port), flush_interval)
+    if name == METRICS_BACKEND_PROMETHEUS:
+        if not config.prometheus_textfile_path:
+            raise ValueError('The prometheus metrics backend needs prometheus_textfile_path')
+        return PrometheusTextfileBackend(str(config.prometheus_textfile_path), flush_interval)
+    if name == METRICS_BACKEND_NONE:
+        return NullMetricsBackend()
+    return None
+
+
+_NOT_CREATED = object()
+_metrics_backend = _NOT_CREATED
+
+
+def get_metrics_backend():
+    """Return the backend of the configuration, built on first use, None
+    for `meteorite`"""
+    global _metrics_backend
+    if _metrics_backend is _NOT_CREATED:
+        _metrics_backend = create_metrics_backend()
+    return _metrics_backend
+
+
+def reset_metrics_backend():
+    """Flush the current backend, the next metrics use the backend of the
+    configuration at that time"""
+    global _metrics_backend
+    flush_metrics_backend()
+    _metrics_backend = _NOT_CREATED
+
+
+def flush_metrics_backend():
+    """Send the metrics of the current backend now, if it was built"""
+    if _metrics_backend not in (None, _NOT_CREATED):
+        _metrics_backend.flush()
@@ -14,13 +14,20 @@
 # limitations under the License.
 
 
-from contextlib import contextmanager
-
 import threading
 import time
+import weakref
+
+from clog import config
+from clog.histogram import LatencyHistogram
+from clog.metrics_backends import get_metrics_backend
+from clog.priority import create_stream_priorities_map
+from clog.priority import PRIORITY_CLASSES
+from clog.priority import PRIORITY_NORMAL
 
 try:
     from yelp_meteorite import create_counter
+    from yelp_meteorite import create_gauge
     from yelp_meteorite import create_timer
 except ImportError:
     # We'll handle the NameErrors and return a FakeMetric within a try/except
@@ -35,6 +42,9 @@ class FakeMetric(object):
     def record(self, *args, **kwargs):
         pass
 
+    def set(self, *args, **kwargs):
+        pass
+
 
 METRICS_PREFIX = 'yelp_clog.'
 METRICS_SAMPLE_PREFIX = METRICS_PREFIX + 'sample.'
@@ -43,12 +53,37 @@ LOG_LINE_SENT = 'log_line.sent'
 LOG_LINE_LATENCY = 'log_line.latency_microseconds'
 LOG_LINE_MONK_EXCEPTION = 'log_line.monk_exception'
 LOG_LINE_MONK_TIMEOUT = 'log_line.monk_timeout'
+LOG_LINE_QUEUE_DROPPED = 'log_line.queue_dropped'
+LOG_LINE_QUEUE_DEPTH = 'log_line.queue_depth'
+LOG_LINE_SHED = 'log_line.shed'
+LOG_LINE_SAMPLED_OUT = 'log_line.sampled_out'
+LOG_LINE_SAMPLE_RATE = 'log_line.effective_sample_rate'
+LOG_LINE_RECONNECT = 'log_line.reconnect'
+LOG_LINE_RECONNECT_FAILURE = 'log_line.reconnect_failure'
+LOG_LINE_BUFFER_BYTES = 'log_line.buffer_bytes'
+LOG_LINE_MULE_LATENCY = 'log_line.mule_latency_microseconds'
+LOG_LINE_MULE_FALLBACK = 'log_line.mule_fallback'
+LOG_LINE_MULE_DECODE_FAILURE = 'log_line.mule_decode_failure'
+STREAM_LINES = 'stream.lines'
+STREAM_BYTES = 'stream.bytes'
+
+# Seconds between two reports of the lines counted by all the threads
+COUNTS_FOLD_INTERVAL = 60
+
+# Streams get their own throughput counters up to this number, the lines of
+# the others are counted together under OTHER_STREAMS
+MAX_STREAM_METRICS = 1000
+OTHER_STREAMS = '__other__'
 
 
 def _create_or_fake_counter(*args, **kwargs):
-    """Create a Counter metric if yelp_meteorite is loaded (passing args), otherwise return a fake
+    """Create a Counter metric with the backend of `config.metrics_backend`, or if yelp_meteorite
+    is loaded (passing args), otherwise return a fake
     :return: Counter metric object
     """
+    backend = get_metrics_backend()
+    if backend is not None:
+        return backend.create_counter(*args, **kwargs)
     try:
         return create_counter(*args, **kwargs)
     except NameError:
@@ -56,26 +91,190 @@ def _create_or_fake_counter(*args, **kwargs):
 
 
 def _create_or_fake_timer(*args, **kwargs):
-    """Create a Timer metric if yelp_meteorite is loaded (passing args), otherwise return a fake
+    """Create a Timer metric with the backend of `config.metrics_backend`, or if yelp_meteorite
+    is loaded (passing args), otherwise return a fake
     :return: Timer metric object
     """
+    backend = get_metrics_backend()
+    if backend is not None:
+        return backend.create_timer(*args, **kwargs)
     try:
         return create_timer(*args, **kwargs)
     except NameError:
         return FakeMetric()
 
 
+def _create_or_fake_gauge(*args, **kwargs):
+    """Create a Gauge metric with the backend of `config.metrics_backend`, or if yelp_meteorite
+    is loaded (passing args), otherwise return a fake
+    :return: Gauge metric object
+    """
+    backend = get_metrics_backend()
+    if backend is not None:
+        return backend.create_gauge(*args, **kwargs)
+    try:
+        return create_gauge(*args, **kwargs)
+    except NameError:
+        return FakeMetric()
+
+
 def _convert_to_microseconds(seconds):
     return 1000000 * seconds
 
 
+try:
+    _perf_counter_ns = time.perf_counter_ns
+except AttributeError:
+    # Python < 3.7
+    _perf_counter = getattr(time, 'perf_counter', time.time)
+
+    def _perf_counter_ns():
+        return int(_perf_counter() * 1000000000)
+
+
+class _NotSampledRequest(object):
+    """Context of the requests which are not part of the sample"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOT_SAMPLED_REQUEST = _NotSampledRequest()
+
+
+class _ThreadCounts(object):
+    """Lines counted by a thread. Only the thread increments `lines`, and
+    `reported`, the lines already emitted, is only changed with the lock of
+    the reporter, so other threads can fold the counts without losing any.
+    """
+
+    __slots__ = ('lines', 'reported', 'exit_ref')
+
+    def __init__(self):
+        self.lines = 0
+        self.reported = 0
+        self.exit_ref = None
+
+
+class _ThreadExitGuard(object):
+    """Kept only in the thread local storage of a thread, so that it is
+    collected when the thread exits"""
+
+    __slots__ = ('__weakref__',)
+
+
+class _SampledRequest(object):
+    """Context of a request which is part of the sample, records the lines
+    counted by the thread and the latency of the request when it succeeds"""
+
+    __slots__ = ('reporter', 'counts', 'stream', 'start_ns')
+
+    def __init__(self, reporter, counts, stream):
+        self.reporter = reporter
+        self.counts = counts
+        self.stream = stream
+        self.start_ns = None
+
+    def __enter__(self):
+        self.start_ns = _perf_counter_ns()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            duration = (_perf_counter_ns() - self.start_ns) / 1000.0
+            self.reporter._record_sample(self.counts, self.stream, duration)
+        return False
+
+
+# Every MetricsReporter, for latency_snapshot
+_reporters = weakref.WeakSet()
+_reporters_lock = threading.Lock()
+
+
+def latency_snapshot(reset=False):
+    """Return the latency percentiles of the sampled requests of the
+    loggers, in microseconds, as a dict of backends to dicts of stream
+    priority classes to :meth:`clog.histogram.LatencyHistogram.snapshot`
+
+    :param reset: forget the latencies once they are in the snapshot
+    """
+    histograms = {}
+    with _reporters_lock:
+        reporters = list(_reporters)
+    for reporter in reporters:
+        backend_histograms = histograms.setdefault(
+            reporter._backend,
+            dict((priority_class, LatencyHistogram()) for priority_class in PRIORITY_CLASSES),
+        )
+        with reporter._lock:
+            for priority_class, histogram in reporter._latency_histograms.items():
+                backend_histograms[priority_class].merge(histogram)
+                if reset:
+                    histogram.reset()
+    return dict(
+        (backend, dict(
+            (priority_class, histogram.snapshot())
+            for priority_class, histogram in backend_histograms.items()
+        ))
+        for backend, backend_histograms in histograms.items()
+    )
+
+
+def flush_sampled_counts():
+    """Report the lines counted by the threads of every MetricsReporter
+    since their last sampled request"""
+    with _reporters_lock:
+        reporters = list(_reporters)
+    for reporter in reporters:
+        reporter.flush_counts()
+
+
+def _reload_sample_rates():
+    """Read the sample rates of every MetricsReporter again after a
+    configuration reload"""
+    with _reporters_lock:
+        reporters = list(_reporters)
+    for reporter in reporters:
+        reporter._read_sample_rates()
+
+
+config.reloader.add('clog.metrics_reporter', _reload_sample_rates)
+
+
+def reset_latency_histograms():
+    """Forget the latencies of the sampled requests of the loggers"""
+    with _reporters_lock:
+        reporters = list(_reporters)
+    for reporter in reporters:
+        with reporter._lock:
+            for histogram in reporter._latency_histograms.values():
+                histogram.reset()
+
+
 class MetricsReporter(object):
     """Basic metrics reporter that reports on a sampled fraction of requests.
+
+    The latencies of the sampled requests are also kept in a
+    :class:`clog.histogram.LatencyHistogram` per priority class of the
+    streams, see :func:`latency_snapshot`. When `sample_rate` is 0, requests
+    are still sampled every `histogram_sample_rate` lines for the
+    histograms only.
+
+    :param backend: name of the backend dimension of the metrics
+    :param sample_rate: number of lines per sampled request, 0 to not emit
+        latency metrics
+    :param histogram_sample_rate: number of lines per request sampled for the
+        histograms when `sample_rate` is 0, 0 to disable the histograms then,
+        `config.latency_histogram_sample_rate` by default
     """
 
-    def __init__(self, backend, sample_rate=0):
+    def __init__(self, backend, sample_rate=0, histogram_sample_rate=None):
         default_dimensions = { 'backend': backend }
-        self._sample_counter = 0
+        self._backend = backend
+        # lines counted by each thread since its last sampled request
+        self._thread_counts = threading.local()
         self._sample_log_line_latency = _create_or_fake_timer(
             METRICS_SAMPLE_PREFIX + LOG_LINE_LATENCY,
             default_dimensions
@@ -92,26 +291,147 @@ class MetricsReporter(object):
             METRICS_TOTAL_PREFIX + LOG_LINE_MONK_TIMEOUT,
             default_dimensions
         )
-        self._sample_rate = sample_rate
+        self._queue_dropped_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_QUEUE_DROPPED,
+            default_dimensions
+        )
+        self._queue_depth_gauge = _create_or_fake_gauge(
+            METRICS_PREFIX + LOG_LINE_QUEUE_DEPTH,
+            default_dimensions
+        )
+        self._shed_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_SHED,
+            default_dimensions
+        )
+        self._reconnect_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_RECONNECT,
+            default_dimensions
+        )
+        self._reconnect_failure_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_RECONNECT_FAILURE,
+            default_dimensions
+        )
+        self._buffer_bytes_gauge = _create_or_fake_gauge(
+            METRICS_PREFIX + LOG_LINE_BUFFER_BYTES,
+            default_dimensions
+        )
+        self._mule_latency_timer = _create_or_fake_timer(
+            METRICS_PREFIX + LOG_LINE_MULE_LATENCY,
+            default_dimensions
+        )
+        self._mule_fallback_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_MULE_FALLBACK,
+            default_dimensions
+        )
+        self._mule_decode_failure_counter = _create_or_fake_counter(
+            METRICS_TOTAL_PREFIX + LOG_LINE_MULE_DECODE_FAILURE,
+            default_dimensions
+        )
+        # stream -> (lines counter, bytes counter)
+        self._stream_counters = {}
+        # stream -> (sampled out counter, effective sample rate gauge)
+        self._stream_sampling_metrics = {}
+        # the configured rates, read again on a configuration reload
+        self._sample_rate_setting = sample_rate
+        if histogram_sample_rate is None:
+            histogram_sample_rate = config.latency_histogram_sample_rate
+        self._histogram_sample_rate_setting = histogram_sample_rate
+        self._read_sample_rates()
+        self._stream_priorities = create_stream_priorities_map()
+        self._latency_histograms = dict(
+            (priority_class, LatencyHistogram()) for priority_class in PRIORITY_CLASSES
+        )
         self._lock = threading.RLock()
+        # counts of the live threads, and when they are next folded
+        self._all_thread_counts = set()
+        self._next_fold = time.time() + COUNTS_FOLD_INTERVAL
+        with _reporters_lock:
+            _reporters.add(self)
 
-    @contextmanager
-    def sampled_request(self):
-        """Context manager that records metrics if it's selected as part of the sample, otherwise runs as usual."""
-        sample_request = False
-        with self._lock:
-            self._sample_counter += 1
-            sample_request = self._sample_rate and self._sample_counter % self._sample_rate == 0
-        if sample_request:
-            start_time = time.time()
-            yield  # Do the actual work
-            duration = _convert_to_microseconds(time.time() - start_time)
-            with self._lock:
-                self._total_log_line_sent.count(value=self._sample_counter);
-                self._sample_log_line_latency.record(value=duration)
-                self._sample_counter = 0
+    def _read_sample_rates(self):
+        """Read the sample rates into plain ints, the configuration proxies
+        are too slow for every line"""
+        self._sample_rate = int(self._sample_rate_setting)
+        self._histogram_sample_rate = int(self._histogram_sample_rate_setting)
+        self._request_sample_rate = self._sample_rate or self._histogram_sample_rate
+
+    @property
+    def _sample_counter(self):
+        """Number of lines counted by the current thread since its last
+        sampled request"""
+        counts = getattr(self._thread_counts, 'counts', None)
+        return counts.lines - counts.reported if counts is not None else 0
+
+    def sampled_request(self, count=1, stream=None):
+        """Context manager that records metrics if it's selected as part of the sample, otherwise runs as usual.
+
+        Each thread counts its lines without locking, a request is sampled
+        once its thread has counted `sample_rate` lines, and it reports them
+        along with its latency. The lines of all the threads are also
+        reported every COUNTS_FOLD_INTERVAL seconds with the samples, when a
+        thread exits and by :meth:`flush_counts`, so that the lines of the
+        threads which rarely log are counted too.
+
+        :param count: number of lines sent by the request
+        :param stream: stream of the lines, for the latency histogram of its
+            priority class, None when the request has several streams
+        """
+        try:
+            counts = self._thread_counts.counts
+        except AttributeError:
+            counts = self._register_thread()
+        counts.lines += count
+        sample_rate = self._request_sample_rate
+        if sample_rate and counts.lines - counts.reported >= sample_rate:
+            return _SampledRequest(self, counts, stream)
+        return _NOT_SAMPLED_REQUEST
+
+    def _register_thread(self):
+        counts = _ThreadCounts()
+        guard = _ThreadExitGuard()
+        reporter_ref = weakref.ref(self)
+
+        def thread_exited(_):
+            reporter = reporter_ref()
+            if reporter is not None:
+                reporter._fold_counts(counts, exited=True)
+
+        counts.exit_ref = weakref.ref(guard, thread_exited)
+        self._thread_counts.counts = counts
+        self._thread_counts.guard = guard
+        with self._lock:
+            self._all_thread_counts.add(counts)
+        return counts
+
+    def _fold_counts(self, counts, exited=False):
+        """Report the lines of a thread which were not reported yet"""
+        with self._lock:
+            lines = counts.lines
+            if self._sample_rate and lines > counts.reported:
+                self._total_log_line_sent.count(value=lines - counts.reported)
+            counts.reported = lines
+            if exited:
+                self._all_thread_counts.discard(counts)
+
+    def flush_counts(self):
+        """Report the lines counted by every thread since their last report"""
+        with self._lock:
+            self._next_fold = time.time() + COUNTS_FOLD_INTERVAL
+            for counts in list(self._all_thread_counts):
+                self._fold_counts(counts)
+
+    def _record_sample(self, counts, stream, duration):
+        if stream is None:
+            priority_class = PRIORITY_NORMAL
         else:
-            yield  # Do the actual work
+            priority_class = self._stream_priorities.get(stream, PRIORITY_NORMAL)
+        with self._lock:
+            self._fold_counts(counts)
+            if self._sample_rate:
+                self._sample_log_line_latency.record(value=duration)
+            self._latency_histograms[priority_class].record(duration)
+            if time.time() >= self._next_fold:
+                self.flush_counts()
 
     def monk_exception(self):
         """Increases the monk exception counter by 1"""
@@ -122,3 +442,104 @@ class MetricsReporter(object):
         """Increases the monk timeout counter by 1"""
         with self._lock:
             self._monk_timeout_counter.count(1)
+
+    def queue_dropped(self, count):
+        """Increases the counter of lines dropped by a full queue by count"""
+        with self._lock:
+            self._queue_dropped_counter.count(count)
+
+    def queue_depth(self, depth):
+        """Records the current number of lines in a queue"""
+        with self._lock:
+            self._queue_depth_gauge.set(depth)
+
+    def lines_shed(self, count):
+        """Increases the counter of lines dropped by a rate limit by count"""
+        with self._lock:
+            self._shed_counter.count(count)
+
+    def lines_sampled(self, stream, kept, dropped):
+        """Increases the counter of lines of a stream dropped by sampling by
+        dropped and records the fraction of its sampled lines which were kept
+        """
+        with self._lock:
+            sampled_out_counter, sample_rate_gauge = self._get_stream_metrics(
+                self._stream_sampling_metrics, stream, self._new_stream_sampling_metrics)
+            sampled_out_counter.count(dropped)
+            sample_rate_gauge.set(float(kept) / (kept + dropped))
+
+    def reconnect(self, succeeded):
+        """Increases the counter of connection attempts by 1, and the
+        counter of failed attempts if it did not succeed"""
+        with self._lock:
+            self._reconnect_counter.count(1)
+            if not succeeded:
+                self._reconnect_failure_counter.count(1)
+
+    def buffer_bytes(self, size):
+        """Records the current number of bytes in a buffer of lines"""
+        with self._lock:
+            self._buffer_bytes_gauge.set(size)
+
+    def mule_latency(self, seconds):
+        """Records the time between the enqueueing of a message by a uwsgi
+        worker and the write of its lines by a mule"""
+        with self._lock:
+            self._mule_latency_timer.record(value=_convert_to_microseconds(max(seconds, 0)))
+
+    def mule_fallback(self, count):
+        """Increases the counter of lines logged synchronously by a uwsgi
+        worker because the mule queue refused them by count"""
+        with self._lock:
+            self._mule_fallback_counter.count(count)
+
+    def mule_decode_failure(self):
+        """Increases the counter of mule messages which could not be decoded
+        by 1"""
+        with self._lock:
+            self._mule_decode_failure_counter.count(1)
+
+    def stream_throughput(self, stream, lines, size):
+        """Increases the line and byte counters of a stream
+
+        :param stream: name of the stream
+        :param lines: number of lines
+        :param size: number of bytes of the lines
+        """
+        with self._lock:
+            counters = self._get_stream_metrics(self._stream_counters, stream, self._new_stream_counters)
+            counters[0].count(lines)
+            counters[1].count(size)
+
+    def _get_stream_metrics(self, stream_metrics, stream, new_metrics):
+        """Return the metrics of `stream` in the `stream_metrics` dict,
+        created by `new_metrics(stream name)` on first use, or those of
+        OTHER_STREAMS when MAX_STREAM_METRICS streams have their own"""
+        metrics = stream_metrics.get(stream)
+        if metrics is not None:
+            return metrics
+        if len(stream_metrics) >= MAX_STREAM_METRICS:
+            metrics = stream_metrics.get(OTHER_STREAMS)
+            if metrics is None:
+                metrics = stream_metrics[OTHER_STREAMS] = new_metrics(OTHER_STREAMS)
+            return metrics
+        if isinstance(stream, bytes):
+            metrics = new_metrics(stream.decode('UTF-8', 'replace'))
+        else:
+            metrics = new_metrics(stream)
+        stream_metrics[stream] = metrics
+        return metrics
+
+    def _new_stream_counters(self, stream):
+        dimensions = {'backend': self._backend, 'stream': stream}
+        return (
+            _create_or_fake_counter(METRICS_TOTAL_PREFIX + STREAM_LINES, dimensions),
+            _create_or_fake_counter(METRICS_TOTAL_PREFIX + STREAM_BYTES, dimensions),
+        )
+
+    def _new_stream_sampling_metrics(self, stream):
+        dimensions = {'backend': self._backend, 'stream': stream}
+        return (
+            _create_or_fake_counter(METRICS_TOTAL_PREFIX + LOG_LINE_SAMPLED_OUT, dimensions),
+            _create_or_fake_gauge(METRICS_PREFIX + LOG_LINE_SAMPLE_RATE, dimensions),
+        )
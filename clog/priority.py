@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Priority classes of streams, so that the buffers of the loggers send the
+lines of important streams first and evict the lines of the others first.
+"""
+from collections import deque
+
+from clog import config
+from clog.utils import config_list_to_items, StreamPatternMap
+
+# Priority classes, from the most to the least important
+PRIORITY_CRITICAL = 'critical'
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+PRIORITY_CLASSES = (PRIORITY_CRITICAL, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# maximum number of streams whose priority is cached at once
+MAX_CACHED_PRIORITIES = 10000
+
+
+def create_stream_priorities_map():
+    """Build the :class:`clog.utils.StreamPatternMap` of stream patterns to
+    priority classes from `config.stream_priorities`."""
+    items = config_list_to_items(config.stream_priorities)
+    for pattern, priority_class in items:
+        if priority_class not in PRIORITY_CLASSES:
+            raise ValueError('Unknown priority class %r for streams %r in stream_priorities' % (
+                priority_class, pattern))
+    return StreamPatternMap(items)
+
+
+def create_class_max_bytes():
+    """Return the dict of priority classes to their maximum number of
+    buffered bytes from `config.priority_class_max_bytes`."""
+    class_max_bytes = dict(config_list_to_items(config.priority_class_max_bytes))
+    unknown_classes = set(class_max_bytes) - set(PRIORITY_CLASSES)
+    if unknown_classes:
+        raise ValueError('Unknown priority classes %s in priority_class_max_bytes' % (
+            ', '.join(sorted(unknown_classes)),))
+    return class_max_bytes
+
+
+def create_priority_buffer():
+    """Build a :class:`PriorityBuffer` with the priority classes of the
+    configuration."""
+    return PriorityBuffer(create_stream_priorities_map(), create_class_max_bytes())
+
+
+class PriorityBuffer(object):
+    """Buffer of (stream, line) pairs with a FIFO queue per priority class.
+
+    Lines are taken from the most important non-empty class first, and
+    :meth:`evict` removes the oldest line of the least important one. The
+    buffer itself is not bounded, except by the optional maximum size of
+    each class: adding a line to a full class evicts the oldest lines of
+    that class.
+
+    :param stream_priorities: a :class:`clog.utils.StreamPatternMap` of
+        stream patterns to priority classes, other streams are
+        PRIORITY_NORMAL
+    :param class_max_bytes: optional dict of priority classes to the
+        maximum number of bytes of their lines
+    """
+
+    def __init__(self, stream_priorities=None, class_max_bytes=None):
+        self.stream_priorities = stream_priorities or StreamPatternMap()
+        self.queues = [deque() for _ in PRIORITY_CLASSES]
+        self.queue_bytes = [0] * len(PRIORITY_CLASSES)
+        class_max_bytes = class_max_bytes or {}
+        self.max_queue_bytes = [
+            class_max_bytes.get(priority_class) for priority_class in PRIORITY_CLASSES
+        ]
+        self._priorities = {}
+
+    def priority_of(self, stream):
+        """Return the index in PRIORITY_CLASSES of the class of `stream`,
+        lower is more important"""
+        try:
+            return self._priorities[stream]
+        except KeyError:
+            if len(self._priorities) >= MAX_CACHED_PRIORITIES:
+                self._priorities.clear()
+            priority_class = self.stream_priorities.get(stream, PRIORITY_NORMAL)
+            priority = PRIORITY_CLASSES.index(priority_class)
+            self._priorities[stream] = priority
+            return priority
+
+    def lowest_priority(self):
+        """Return the priority of the least important non-empty class, or
+        None if the buffer is empty"""
+        for priority in range(len(self.queues) - 1, -1, -1):
+            if self.queues[priority]:
+                return priority
+        return None
+
+    def append(self, item):
+        """Add a (stream, line) pair after the other lines of its class.
+
+        :returns: the list of pairs evicted to keep the class under its
+            maximum size
+        """
+        stream, line = item
+        priority = self.priority_of(stream)
+        queue = self.queues[priority]
+        max_bytes = self.max_queue_bytes[priority]
+        evicted = []
+        if max_bytes is not None:
+            while queue and self.queue_bytes[priority] + len(line) > max_bytes:
+                evicted.append(self._pop(priority))
+        queue.append(item)
+        self.queue_bytes[priority] += len(line)
+        return evicted
+
+    def popleft(self):
+        """Remove and return the oldest pair of the most important class"""
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return self._pop(priority)
+        raise IndexError('pop from an empty PriorityBuffer')
+
+    def evict(self):
+        """Remove and return the oldest pair of the least important class"""
+        priority = self.lowest_priority()
+        if priority is None:
+            raise IndexError('evict from an empty PriorityBuffer')
+        return self._pop(priority)
+
+    def _pop(self, priority):
+        item = self.queues[priority].popleft()
+        self.queue_bytes[priority] -= len(item[1])
+        return item
+
+    def remove_if(self, predicate):
+        """Remove the pairs for which `predicate(pair)` is true, calling it
+        on every pair in the order of :meth:`popleft`. The other pairs keep
+        their order."""
+        for priority, queue in enumerate(self.queues):
+            kept = deque()
+            for item in queue:
+                if predicate(item):
+                    self.queue_bytes[priority] -= len(item[1])
+                else:
+                    kept.append(item)
+            self.queues[priority] = kept
+
+    def clear(self):
+        for queue in self.queues:
+            queue.clear()
+        self.queue_bytes = [0] * len(PRIORITY_CLASSES)
+
+    def __getitem__(self, index):
+        for queue in self.queues:
+            if index < len(queue):
+                return queue[index]
+            index -= len(queue)
+        raise IndexError('PriorityBuffer index out of range')
+
+    def __iter__(self):
+        for queue in self.queues:
+            for item in queue:
+                yield item
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def __bool__(self):
+        return any(self.queues)
+
+    __nonzero__ = __bool__
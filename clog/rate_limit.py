@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Token bucket rate limiting of log lines, per stream and for the whole
+process, so that a runaway stream cannot starve the others.
+"""
+import threading
+import time
+
+from clog.metrics_reporter import MetricsReporter
+from clog.priority import PriorityBuffer
+from clog.utils import StreamPatternMap
+
+# What a StreamRateLimiter does with the lines over its limits
+OVERFLOW_DROP = 'drop'
+OVERFLOW_SAMPLE = 'sample'
+OVERFLOW_SPOOL = 'spool'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_SAMPLE, OVERFLOW_SPOOL)
+
+# maximum number of streams whose buckets and shed lines are kept at once
+MAX_TRACKED_STREAMS = 10000
+# shed lines of the streams over MAX_TRACKED_STREAMS
+OTHER_STREAMS = '__other__'
+# minimum number of seconds between two scans of a spool which still has
+# lines after a drain
+SPOOL_DRAIN_INTERVAL = 0.1
+
+
+class TokenBucket(object):
+    """Token bucket refilled with `rate` tokens per second, holding at most
+    `capacity` tokens.
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens, defaults to one second of rate
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+
+    def refill(self, now):
+        if now > self.last_refill:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+    def has(self, amount, reserved=0.0):
+        """Whether `amount` tokens can be taken while leaving `reserved`
+        tokens in the bucket. The bucket must have been refilled."""
+        return self.tokens - amount >= reserved
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class StreamRateLimiter(object):
+    """Lines per second and bytes per second limits, for every stream and for
+    the total of all streams.
+
+    Critical streams can use all of the global limits, while the other
+    streams must leave `reserved_share` of them available, so that a burst
+    of a feature cannot starve important telemetry.
+
+    The lines over the limits are handled according to `overflow_policy`:
+
+    - OVERFLOW_DROP: they are dropped
+    - OVERFLOW_SAMPLE: a `sample_rate` fraction of them is kept anyway
+    - OVERFLOW_SPOOL: they are kept in a bounded spool and sent later, when
+      :meth:`drain_spool` finds room for them. Lines of higher priority
+      classes are sent first, and the oldest lines of the lowest class are
+      dropped when the spool is full. Lines larger than a byte limit can
+      never be sent and are dropped instead.
+
+    The buckets and shed lines of at most MAX_TRACKED_STREAMS streams are
+    kept: the buckets then start over, and the lines shed by the other
+    streams are counted under OTHER_STREAMS.
+
+    The size of text lines is approximated by their number of characters.
+
+    :param lines_per_second: global limit of lines per second, 0 for none
+    :param bytes_per_second: global limit of bytes per second, 0 for none
+    :param stream_limits: a :class:`clog.utils.StreamPatternMap` of stream
+        patterns to dicts with `lines_per_second` and `bytes_per_second`
+    :param critical_streams: a :class:`clog.utils.StreamPatternMap` whose
+        matching streams are critical
+    :param reserved_share: share of the global limits reserved to critical
+        streams
+    :param overflow_policy: one of OVERFLOW_POLICIES
+    :param sample_rate: share of the lines over the limits kept when
+        overflow_policy is OVERFLOW_SAMPLE
+    :param max_spooled_lines: size of the spool
+    :param stream_priorities: a :class:`clog.utils.StreamPatternMap` of
+        stream patterns to :mod:`clog.priority` classes for the spool
+    :param class_max_bytes: optional dict of priority classes to the
+        maximum number of bytes of their spooled lines
+    """
+
+    def __init__(self, lines_per_second=0, bytes_per_second=0, stream_limits=None,
+                 critical_streams=None, reserved_share=0.0, overflow_policy=OVERFLOW_DROP,
+                 sample_rate=0.01, max_spooled_lines=10000, stream_priorities=None,
+                 class_max_bytes=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r' % (overflow_policy,))
+        self.global_buckets = _create_buckets(lines_per_second, bytes_per_second)
+        self.stream_limits = stream_limits or StreamPatternMap()
+        self.critical_streams = critical_streams or StreamPatternMap()
+        self.reserved_share = reserved_share
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.spool = PriorityBuffer(stream_priorities, class_max_bytes)
+        self.max_spooled_lines = int(max_spooled_lines)
+        self.shed_lines = {}
+        self.metrics = MetricsReporter(backend='rate_limit')
+        # stream -> (line bucket, byte bucket, critical)
+        self._stream_buckets = {}
+        self._sample_credit = 0.0
+        self._next_drain = 0.0
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, stream):
+        try:
+            return self._stream_buckets[stream]
+        except KeyError:
+            if len(self._stream_buckets) >= MAX_TRACKED_STREAMS:
+                self._stream_buckets.clear()
+            limits = self.stream_limits.get(stream) or {}
+            buckets = _create_buckets(
+                limits.get('lines_per_second', 0),
+                limits.get('bytes_per_second', 0),
+            ) + (self.critical_streams.get(stream, False),)
+            self._stream_buckets[stream] = buckets
+            return buckets
+
+    def _try_take(self, stream, size, now):
+        """Take the tokens of a line from the buckets if they all have
+        enough, returns whether they did."""
+        stream_line_bucket, stream_byte_bucket, critical = self._buckets_for(stream)
+        global_line_bucket, global_byte_bucket = self.global_buckets
+        reserved_share = 0.0 if critical else self.reserved_share
+
+        checks = (
+            (stream_line_bucket, 1, 0.0),
+            (stream_byte_bucket, size, 0.0),
+            (global_line_bucket, 1, reserved_share),
+            (global_byte_bucket, size, reserved_share),
+        )
+        for bucket, amount, share in checks:
+            if bucket is not None:
+                bucket.refill(now)
+                if not bucket.has(amount, share * bucket.capacity):
+                    return False
+        for bucket, amount, _ in checks:
+            if bucket is not None:
+                bucket.take(amount)
+        return True
+
+    def admit(self, stream, line):
+        """Whether a line can be sent now. Lines which are not admitted are
+        either dropped or spooled, depending on the overflow policy."""
+        with self._lock:
+            if self._try_take(stream, len(line), time.time()):
+                return True
+
+            if self.overflow_policy == OVERFLOW_SAMPLE:
+                self._sample_credit += self.sample_rate
+                if self._sample_credit >= 1:
+                    self._sample_credit -= 1
+                    return True
+            elif self.overflow_policy == OVERFLOW_SPOOL:
+                self._spool(stream, line)
+                return False
+
+            self._shed(stream)
+            return False
+
+    def _can_ever_fit(self, stream, size):
+        """Whether the byte buckets can ever hold a line of `size` bytes"""
+        _, stream_byte_bucket, critical = self._buckets_for(stream)
+        if stream_byte_bucket is not None and size > stream_byte_bucket.capacity:
+            return False
+        global_byte_bucket = self.global_buckets[1]
+        if global_byte_bucket is not None:
+            reserved_share = 0.0 if critical else self.reserved_share
+            return size <= global_byte_bucket.capacity * (1 - reserved_share)
+        return True
+
+    def _spool(self, stream, line):
+        if not self._can_ever_fit(stream, len(line)):
+            self._shed(stream)
+            return
+        if len(self.spool) >= self.max_spooled_lines:
+            if self.spool.lowest_priority() < self.spool.priority_of(stream):
+                # only more important lines are spooled
+                self._shed(stream)
+                return
+            evicted_stream, _ = self.spool.evict()
+            self._shed(evicted_stream)
+        for evicted_stream, _ in self.spool.append((stream, line)):
+            self._shed(evicted_stream)
+
+    def drain_spool(self, force=False):
+        """Remove from the spool and return the (stream, line) pairs which now
+        fit in the limits, oldest first.
+
+        Each stream is drained on its own, until one of its lines does not
+        fit, so a stream over its limits does not hold back the others. As
+        this scans the spool, a spool which still has lines is scanned again
+        at most every SPOOL_DRAIN_INTERVAL seconds.
+
+        :param force: scan the spool even if it was scanned less than
+            SPOOL_DRAIN_INTERVAL seconds ago
+        """
+        lines = []
+        with self._lock:
+            now = time.time()
+            if now < self._next_drain and not force:
+                return lines
+            blocked_streams = set()
+
+            def drain(item):
+                stream, line = item
+                if stream in blocked_streams:
+                    return False
+                if self._try_take(stream, len(line), now):
+                    lines.append(item)
+                    return True
+                blocked_streams.add(stream)
+                return False
+
+            self.spool.remove_if(drain)
+            if self.spool:
+                self._next_drain = now + SPOOL_DRAIN_INTERVAL
+        return lines
+
+    def clear_spool(self):
+        """Remove and return all the spooled (stream, line) pairs, in the
+        order they would be drained"""
+        with self._lock:
+            lines = list(self.spool)
+            self.spool.clear()
+        return lines
+
+    def _shed(self, stream):
+        if stream not in self.shed_lines and len(self.shed_lines) >= MAX_TRACKED_STREAMS:
+            stream = OTHER_STREAMS
+        self.shed_lines[stream] = self.shed_lines.get(stream, 0) + 1
+        self.metrics.lines_shed(1)
+
+
+def _create_buckets(lines_per_second, bytes_per_second):
+    return (
+        TokenBucket(lines_per_second) if lines_per_second else None,
+        TokenBucket(bytes_per_second) if bytes_per_second else None,
+    )
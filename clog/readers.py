@@ -19,9 +19,12 @@ from __future__ import print_function
 
 from clog.scribe_net import ScribeS3, ScribeReader
 
+from collections import deque
 from io import BytesIO
+from io import StringIO
 import errno
 import logging
+import multiprocessing
 import os
 import os.path
 import random
@@ -44,6 +47,9 @@ _chunkfile_pat = re.compile(r'^(?P<stream>[a-z][-a-z0-9_]+)-(?P<year>\d{4})-(?P<
 
 COMPRESSED_HEADER_FMT = "<Q"
 
+# Number of decompressed bytes read at once from the chunk files
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
 SETTINGS_FILE = '/nail/srv/configs/yelp_clog.json'
 
 
@@ -78,13 +84,28 @@ class CLogStreamReader(object):
     :param date: the date of the logs
     :param fail_on_missing: Fail if there are no log files for the specified
         stream and date
+    :param processes: number of processes decompressing and splitting the
+        chunks in parallel, the lines are still yielded in the order of the
+        chunks. With 1, the default, the chunks are read in this process.
+        The processes are stopped when the iteration ends, or when its
+        iterator is closed if it is stopped early
+    :param read_ahead: maximum number of chunks decompressed ahead of the
+        one being yielded when `processes` is above 1, which bounds the
+        memory used to `read_ahead` decompressed chunks. Defaults to
+        `processes`
+    :param block_size: number of decompressed bytes read at once from the
+        chunks and split into lines
     """
 
-    def __init__(self, stream_name, stream_dir, date, fail_on_missing=False):
+    def __init__(self, stream_name, stream_dir, date, fail_on_missing=False, processes=1, read_ahead=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
         self.stream_dir = stream_dir
         self.stream_name = stream_name
         self.date = date
         self.fail_on_missing = fail_on_missing
+        self.processes = processes
+        self.read_ahead = read_ahead or processes
+        self.block_size = block_size
 
     def __repr__(self):
         return '%s(%r, %r, %r)' % (self.__class__.__name__, self.stream_name, self.stream_dir, self.date)
@@ -112,21 +133,136 @@ class CLogStreamReader(object):
 
         return sorted(result)
 
+    def _stream_iterator(self):
+        if self.processes > 1:
+            return ParallelCLogStreamIterator(self, self.processes, self.read_ahead, self.block_size)
+        return CLogStreamIterator(self, block_size=self.block_size)
+
     def __iter__(self):
-        return iter(CLogStreamIterator(self))
+        return iter(self._stream_iterator())
+
+    def iter_batches(self):
+        """Iterate over lists of consecutive lines of the stream, cheaper
+        than iterating over the lines one by one"""
+        return self._stream_iterator().iter_batches()
+
+
+def _open_chunk(chunk_filename):
+    """Open a chunk file, or its compressed version if it was compressed
+    since it was listed"""
+    try:
+        return open_compressed_file(chunk_filename, mode='r')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # maybe the file was compressed during iteration (see #9735)
+        for ext in ('.gz', '.bz2'):
+            compressed_name = chunk_filename + ext
+            if os.path.exists(compressed_name):
+                return open_compressed_file(compressed_name, mode='r')
+        raise
+
+
+def _split_lines(block):
+    """Split a block in lines ending with their newline, except the last one
+    if the block does not end with a newline. Only newlines split lines, as
+    when iterating over a file."""
+    if isinstance(block, bytes):
+        return BytesIO(block).readlines()
+    return StringIO(block, newline='\n').readlines()
+
+
+def read_line_batches(chunk, block_size=DEFAULT_BLOCK_SIZE):
+    """Iterate over lists of the lines of a file object, read in blocks of
+    `block_size` bytes. A line split between blocks is yielded whole with
+    the next block, and a last line without a newline with the last block.
+
+    :param chunk: file object opened with :func:`clog.utils.open_compressed_file`
+    :param block_size: number of bytes read at once
+    """
+    return _split_line_batches(_read_blocks(chunk, block_size))
+
+
+def _read_blocks(chunk, block_size):
+    while True:
+        block = chunk.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def _split_line_batches(blocks):
+    """Iterate over the lists of lines of consecutive blocks of a file, see
+    :func:`read_line_batches`"""
+    partial = []
+    for block in blocks:
+        lines = _split_lines(block)
+        ends_with_newline = block[-1:] in (b'\n', u'\n')
+        if len(lines) == 1 and not ends_with_newline:
+            # no newline in the block, the partial line goes on
+            partial.append(block)
+            continue
+        if partial:
+            partial.append(lines[0])
+            lines[0] = block[:0].join(partial)
+            partial = []
+        if not ends_with_newline:
+            partial.append(lines.pop())
+        yield lines
+    if partial:
+        yield [partial[0][:0].join(partial)]
+
+
+def _read_chunk_blocks(chunk_filename, block_size):
+    """Return the list of the decompressed blocks of a chunk file, run in
+    the processes of :class:`ParallelCLogStreamIterator`. Blocks are much
+    cheaper to send back to the parent than the lines they hold."""
+    chunk = _open_chunk(chunk_filename)
+    try:
+        return list(_read_blocks(chunk, block_size))
+    finally:
+        chunk.close()
 
 
 class CLogStreamIterator(object):
     """Iterator used by :class:`ClogStreamReader` for  iterating over lines
     of chunks of a stream.
+
+    The chunks are read in blocks of `block_size` bytes, split into lines
+    all at once. `line_num` is the number of the last line yielded in the
+    stream, from 1, and `chunk_line_num` its number in its chunk, from 0.
+
+    An iteration stopped early keeps its current chunk open until it is
+    garbage collected, or until :meth:`close` is called, which the iterator
+    also does as a context manager.
     """
     log = logging.getLogger('yelp_lib.clog.CLogStreamIterator')
 
-    def __init__(self, stream_reader, line_num=-1, current_chunk=None, chunk_line_num=-1):
+    def __init__(self, stream_reader, line_num=-1, current_chunk=None, chunk_line_num=-1,
+                 block_size=DEFAULT_BLOCK_SIZE):
         self.stream_reader = stream_reader
         self.line_num = line_num
         self.chunk_line_num = chunk_line_num
         self.current_chunk = current_chunk
+        self.block_size = block_size
+        self._batches = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the current iteration and release what it holds"""
+        if self._batches is not None:
+            self._batches.close()
+            self._batches = None
+
+    def _open_batches(self):
+        self.close()
+        self._batches = self._chunk_batches()
+        return self._batches
 
     def __iter__(self):
         """Iterate over all the lines for all of the chunk files for this
@@ -136,33 +272,95 @@ class CLogStreamIterator(object):
         byte string, A line in a chunk file;  e.g. an Apache access log line
         """
         self.line_num = 0
+        try:
+            for batch in self._open_batches():
+                for line in batch:
+                    self.line_num += 1
+                    self.chunk_line_num += 1
+                    yield line
+        finally:
+            self.close()
+
+    def iter_batches(self):
+        """Iterate over lists of consecutive lines of a chunk, in the order
+        of :meth:`__iter__`. `line_num` and `chunk_line_num` are those of
+        the last line of the batch."""
+        self.line_num = 0
+        try:
+            for batch in self._open_batches():
+                self.line_num += len(batch)
+                self.chunk_line_num += len(batch)
+                yield batch
+        finally:
+            self.close()
+
+    def _chunk_batches(self):
         for chunk_filename in self.stream_reader.chunk_filenames():
             self.log.debug('opening chunk: %s', (chunk_filename, ))
-
+            self.current_chunk = _open_chunk(chunk_filename)
             try:
-                self.current_chunk = open_compressed_file(chunk_filename, mode='r')
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    # maybe the file was compressed during iteration (see #9735)
-                    for ext in ('.gz', '.bz2'):
-                        compressed_name = chunk_filename + ext
-                        if os.path.exists(compressed_name):
-                            self.current_chunk = open_compressed_file(compressed_name, mode='r')
-                            break
-                    else:
-                        raise
-                else:
-                    raise
-
-            for line in self.current_chunk:
-                self.line_num += 1
-                self.chunk_line_num += 1
-                yield line
-            self.current_chunk.close()
-            self.current_chunk = None
+                for batch in read_line_batches(self.current_chunk, self.block_size):
+                    yield batch
+            finally:
+                self.current_chunk.close()
+                self.current_chunk = None
             self.chunk_line_num = -1
 
 
+class ParallelCLogStreamIterator(CLogStreamIterator):
+    """Iterator used by :class:`CLogStreamReader` to decompress and split the
+    chunks of a stream in a pool of `processes` processes, while yielding
+    their lines in the order of the chunks.
+
+    The processes send back the decompressed blocks of the chunks, which are
+    split into lines in this process: a few large strings are much cheaper
+    to pickle than the many small strings of their lines.
+
+    At most `read_ahead` chunks are submitted to the pool ahead of the chunk
+    being yielded, so only that many decompressed chunks are kept in memory.
+    The pool is terminated when the iteration ends or the iterator is
+    closed, explicitly or as a context manager. An iteration stopped early
+    otherwise keeps the processes of the pool until it is garbage collected.
+
+    :param stream_reader: the :class:`CLogStreamReader` of the chunks
+    :param processes: number of processes of the pool
+    :param read_ahead: maximum number of chunks read ahead
+    :param block_size: number of decompressed bytes read at once
+    """
+    log = logging.getLogger('yelp_lib.clog.ParallelCLogStreamIterator')
+
+    def __init__(self, stream_reader, processes, read_ahead, block_size=DEFAULT_BLOCK_SIZE):
+        super(ParallelCLogStreamIterator, self).__init__(stream_reader, block_size=block_size)
+        self.processes = processes
+        self.read_ahead = max(read_ahead, 1)
+
+    def _chunk_batches(self):
+        chunk_filenames = iter(self.stream_reader.chunk_filenames())
+        pending = deque()
+        pool = multiprocessing.Pool(self.processes)
+
+        def submit_next():
+            for chunk_filename in chunk_filenames:
+                pending.append(pool.apply_async(_read_chunk_blocks, (chunk_filename, self.block_size)))
+                return True
+            return False
+
+        try:
+            while len(pending) < self.read_ahead and submit_next():
+                pass
+            while pending:
+                blocks = pending.popleft().get()
+                # refill before yielding, to keep the pool busy meanwhile
+                submit_next()
+                for batch in _split_line_batches(blocks):
+                    yield batch
+                self.chunk_line_num = -1
+                del blocks
+        finally:
+            pool.terminate()
+            pool.join()
+
+
 class StreamTailerSetupError(Exception):
 
     def __init__(self, host, port, message):
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per stream sampling of log lines, so that verbose streams can be kept at a
+fraction of their volume without sampling code at every call site.
+"""
+import random
+import threading
+import zlib
+
+import six
+
+from clog.metrics_reporter import MetricsReporter
+from clog.metrics_reporter import OTHER_STREAMS
+
+# maximum number of streams whose sample rate is cached at once
+MAX_CACHED_SAMPLE_RATES = 10000
+
+# number of sampled lines of a stream between two reports of its effective
+# sample rate
+REPORT_INTERVAL = 1000
+
+# maximum number of streams whose sampled lines are counted on their own, the
+# lines of the others are counted together under OTHER_STREAMS
+MAX_COUNTED_STREAMS = 10000
+
+_HASH_RANGE = 2 ** 32
+
+# sample_key of the lines already kept by a sampler, for instance in another
+# process, which must not be sampled again
+ALREADY_SAMPLED = object()
+
+
+class StreamSampler(object):
+    """Decide which lines of sampled streams are kept.
+
+    A line logged with a `sample_key` is kept if the hash of the key falls in
+    the first `rate` fraction of the hash range, so all the lines sharing a
+    key (like a request id) are kept or dropped together, in every stream
+    sampled at the same rate and in every process. Lines without a key are
+    kept at random.
+
+    The fraction of lines kept of each sampled stream is reported through
+    :class:`clog.metrics_reporter.MetricsReporter` every REPORT_INTERVAL
+    sampled lines of the stream.
+
+    :param sample_rates: a :class:`clog.utils.StreamPatternMap` of stream
+        patterns to the fraction of their lines kept, between 0 and 1
+    """
+
+    def __init__(self, sample_rates):
+        self.sample_rates = sample_rates
+        self.metrics = MetricsReporter(backend='sampling')
+        self._stream_rates = {}
+        # stream -> [kept, dropped] lines since the last report of the stream
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def rate_for(self, stream):
+        """Return the fraction of the lines of `stream` which are kept"""
+        try:
+            return self._stream_rates[stream]
+        except KeyError:
+            if len(self._stream_rates) >= MAX_CACHED_SAMPLE_RATES:
+                self._stream_rates.clear()
+            rate = float(self.sample_rates.get(stream, 1.0))
+            self._stream_rates[stream] = rate
+            return rate
+
+    def keep(self, stream, sample_key=None):
+        """Whether a line of `stream` logged with `sample_key` is kept"""
+        rate = self.rate_for(stream)
+        if rate >= 1.0 or sample_key is ALREADY_SAMPLED:
+            return True
+        if sample_key is None:
+            kept = random.random() < rate
+        else:
+            kept = key_hash(sample_key) < rate * _HASH_RANGE
+        self._count(stream, kept)
+        return kept
+
+    def _count(self, stream, kept):
+        with self._lock:
+            counts = self._counts.get(stream)
+            if counts is None:
+                if len(self._counts) >= MAX_COUNTED_STREAMS:
+                    stream = OTHER_STREAMS
+                counts = self._counts.setdefault(stream, [0, 0])
+            counts[0 if kept else 1] += 1
+            if counts[0] + counts[1] < REPORT_INTERVAL:
+                return
+            kept_count, dropped_count = counts
+            del self._counts[stream]
+        self.metrics.lines_sampled(stream, kept_count, dropped_count)
+
+
+def key_hash(sample_key):
+    """Return a hash of `sample_key` between 0 and 2 ** 32 which is the same
+    in every process, unlike :func:`hash`."""
+    if isinstance(sample_key, six.text_type):
+        sample_key = sample_key.encode('UTF-8')
+    elif not isinstance(sample_key, bytes):
+        sample_key = str(sample_key).encode('UTF-8')
+    return zlib.crc32(sample_key) & 0xffffffff
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Single producer, single consumer ring buffers in anonymous shared memory,
+used to pass messages from forked processes to a consumer process without a
+system call per message.
+
+The memory must be mapped before forking. Each producer process writes to
+its own ring, and only the consumer reads them. The threads of a producer
+process take turns through a lock. A ring keeps two 64 bit counters, the
+total bytes written (head) and read (tail): the producer only writes the
+head, after the message, and the consumer only writes the tail, after
+reading. This relies on the stores of a process being seen in order by the
+others, which Python cannot enforce with memory barriers, so
+:class:`ShmTransport` is only available on x86, where it holds.
+"""
+import errno
+import fcntl
+import mmap
+import os
+import platform
+import select
+import struct
+import threading
+
+COUNTER = struct.Struct('Q')
+COUNTER_SZ = COUNTER.size
+RING_HEADER_SZ = 2 * COUNTER_SZ
+LENGTH = struct.Struct('I')
+LENGTH_SZ = LENGTH.size
+
+# Machines whose stores are seen in order by the other processors
+STORE_ORDERED_MACHINES = ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+
+
+def stores_are_ordered():
+    """Whether this machine keeps the order of the stores the rings rely on"""
+    return platform.machine().lower() in STORE_ORDERED_MACHINES
+
+
+class ShmRing(object):
+    """Ring of length prefixed messages in `capacity` bytes of `buf`,
+    starting at `offset`.
+
+    :param buf: shared buffer, like an anonymous :class:`mmap.mmap`
+    :param offset: offset of the ring in `buf`, a multiple of 8
+    :param capacity: number of bytes for the messages and their lengths
+    """
+
+    def __init__(self, buf, offset, capacity):
+        self.buf = buf
+        self.head_offset = offset
+        self.tail_offset = offset + COUNTER_SZ
+        self.data_offset = offset + RING_HEADER_SZ
+        self.capacity = capacity
+
+    def _counter(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def put(self, data):
+        """Append a message, from the producer.
+
+        :returns: None if the ring has no room for it, otherwise whether the
+            ring was empty before
+        """
+        head = COUNTER.unpack_from(self.buf, self.head_offset)[0]
+        tail = COUNTER.unpack_from(self.buf, self.tail_offset)[0]
+        record = LENGTH.pack(len(data)) + data
+        if head + len(record) - tail > self.capacity:
+            return None
+        start = head % self.capacity
+        if start + len(record) <= self.capacity:
+            position = self.data_offset + start
+            self.buf[position:position + len(record)] = record
+        else:
+            self._write(head, record)
+        # publish the message once it is written
+        COUNTER.pack_into(self.buf, self.head_offset, head + len(record))
+        return head == tail
+
+    def get_all(self):
+        """Remove and return all the messages, from the consumer"""
+        head = self._counter(self.head_offset)
+        tail = self._counter(self.tail_offset)
+        messages = []
+        while tail < head:
+            length = LENGTH.unpack(self._read(tail, LENGTH_SZ))[0]
+            messages.append(self._read(tail + LENGTH_SZ, length))
+            tail += LENGTH_SZ + length
+        COUNTER.pack_into(self.buf, self.tail_offset, tail)
+        return messages
+
+    def __len__(self):
+        """Number of bytes used by the messages"""
+        return self._counter(self.head_offset) - self._counter(self.tail_offset)
+
+    def _write(self, position, data):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        base = self.data_offset
+        self.buf[base + start:base + start + first] = data[:first]
+        if first < len(data):
+            self.buf[base:base + len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        base = self.data_offset
+        data = self.buf[base + start:base + start + first]
+        if first < length:
+            data += self.buf[base:base + length - first]
+        return data
+
+
+class ShmTransport(object):
+    """A ring per producer in one anonymous shared mapping, and a pipe to
+    wake the consumer up when a ring stops being empty. Create it before
+    forking the producers and the consumer.
+
+    Raises RuntimeError on machines which do not keep the order of stores,
+    see :func:`stores_are_ordered`.
+
+    :param num_slots: number of producers
+    :param slot_capacity: size in bytes of the ring of each producer
+    """
+
+    def __init__(self, num_slots, slot_capacity):
+        if not stores_are_ordered():
+            raise RuntimeError('Shared memory rings need x86 store ordering, not %s' % (platform.machine(),))
+        # keep the rings 8 bytes aligned
+        slot_capacity += -slot_capacity % COUNTER_SZ
+        slot_size = RING_HEADER_SZ + slot_capacity
+        self.buf = mmap.mmap(-1, num_slots * slot_size)
+        self.rings = [
+            ShmRing(self.buf, slot * slot_size, slot_capacity) for slot in range(num_slots)
+        ]
+        # the threads of a producer share its ring
+        self.send_locks = [threading.Lock() for _ in range(num_slots)]
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def send(self, slot, data):
+        """Send a message from the producer of `slot`, returns whether there
+        was room for it. Any thread of the producer can send."""
+        with self.send_locks[slot]:
+            was_empty = self.rings[slot].put(data)
+            if was_empty is None:
+                return False
+            if was_empty:
+                try:
+                    os.write(self.wakeup_write, b'\0')
+                except OSError as e:
+                    # a full pipe already has wakeups pending
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+        return True
+
+    def wait(self, timeout):
+        """Wait at most `timeout` seconds for a wakeup. The consumer must
+        drain the rings after a timeout as well, wakeups are only sent when
+        a ring was seen empty by its producer."""
+        readable, _, _ = select.select([self.wakeup_read], [], [], timeout)
+        if readable:
+            try:
+                os.read(self.wakeup_read, 4096)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def drain(self):
+        """Remove and return the messages of all the rings"""
+        messages = []
+        for ring in self.rings:
+            messages.extend(ring.get_all())
+        return messages
+
+    def close(self):
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        self.buf.close()
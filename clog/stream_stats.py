@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bounded memory accounting of the lines and bytes logged to each stream, to
+find the streams which log the most whatever the number of streams.
+"""
+import heapq
+import itertools
+import threading
+import time
+import weakref
+
+from clog import config
+from clog.metrics_reporter import MetricsReporter
+
+
+# tie breaker of the heap entries, the streams may not be comparable
+_sequence = itertools.count()
+
+
+class StreamStats(object):
+    """Count the lines and bytes of the `capacity` heaviest streams with the
+    space saving algorithm.
+
+    A stream which is not tracked when all the entries are taken replaces
+    the stream with the fewest bytes, and inherits its counts as a possible
+    error. The counts of a tracked stream are therefore never below its true
+    counts, and above them by at most its `error_lines` and `error_bytes`.
+    Any stream with more than `1 / capacity` of the bytes is tracked.
+
+    The lightest stream is found with a min-heap of the byte counts of the
+    streams, which is only updated on replacements: an entry whose count
+    changed since it was pushed is pushed again with its current count, so
+    that adding to a tracked stream stays a dict lookup.
+
+    :param capacity: maximum number of tracked streams
+    :param report_interval: seconds between two reports of the counts of
+        the tracked streams as metrics, after which the counts start over.
+        0 to never report them
+    """
+
+    def __init__(self, capacity, report_interval=0):
+        if capacity < 1:
+            raise ValueError('StreamStats needs a capacity of at least 1')
+        self.capacity = capacity
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._metrics = None
+        self.reset()
+
+    def reset(self):
+        """Forget all the counts"""
+        with self._lock:
+            # stream -> [lines, bytes, error lines, error bytes]
+            self.entries = {}
+            # (bytes when pushed, sequence number, stream) of every entry
+            self._heap = []
+            self.lines = 0
+            self.bytes = 0
+            self._next_report = time.time() + self.report_interval
+
+    def add(self, stream, lines, size):
+        """Count `lines` lines of `size` bytes in total for `stream`"""
+        with self._lock:
+            self._count(stream, lines, size)
+        if self.report_interval and time.time() >= self._next_report:
+            self.report()
+
+    def _count(self, stream, lines, size):
+        entry = self.entries.get(stream)
+        if entry is None:
+            self._new_entry(stream, lines, size)
+        else:
+            entry[0] += lines
+            entry[1] += size
+        self.lines += lines
+        self.bytes += size
+
+    def _new_entry(self, stream, lines, size):
+        entries = self.entries
+        heap = self._heap
+        if len(entries) < self.capacity:
+            entries[stream] = [lines, size, 0, 0]
+            heapq.heappush(heap, (size, next(_sequence), stream))
+            return
+        # the counts only grow, so an entry whose count did not change since
+        # it was pushed is the lightest one
+        while True:
+            lightest_size, _, lightest_stream = heap[0]
+            current_size = entries[lightest_stream][1]
+            if current_size == lightest_size:
+                break
+            heapq.heapreplace(heap, (current_size, next(_sequence), lightest_stream))
+        error_lines, error_bytes, _, _ = entries.pop(lightest_stream)
+        entries[stream] = [error_lines + lines, error_bytes + size, error_lines, error_bytes]
+        heapq.heapreplace(heap, (error_bytes + size, next(_sequence), stream))
+
+    def top(self, count=None):
+        """Return the `count` streams with the most bytes, all the tracked
+        streams by default, as a list of dicts with their `stream`, `lines`,
+        `bytes`, `error_lines` and `error_bytes`, from the heaviest"""
+        with self._lock:
+            entries = list(self.entries.items())
+        entries.sort(key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                'stream': stream,
+                'lines': lines,
+                'bytes': size,
+                'error_lines': error_lines,
+                'error_bytes': error_bytes,
+            }
+            for stream, (lines, size, error_lines, error_bytes) in entries[:count]
+        ]
+
+    def snapshot(self, count=None):
+        """Return a dict of the total `lines` and `bytes` of all the streams
+        and of the `count` heaviest `streams`, see :meth:`top`"""
+        with self._lock:
+            lines = self.lines
+            size = self.bytes
+        return {'lines': lines, 'bytes': size, 'streams': self.top(count)}
+
+    def report(self):
+        """Emit the counts of the tracked streams as metrics, and start over"""
+        if self._metrics is None:
+            self._metrics = MetricsReporter(backend='clog')
+        with self._lock:
+            entries = self.entries
+            self.entries = {}
+            self._heap = []
+            self.lines = 0
+            self.bytes = 0
+            self._next_report = time.time() + self.report_interval
+        for stream, (lines, size, _, _) in entries.items():
+            self._metrics.stream_throughput(stream, lines, size)
+
+
+class _ThreadStreamCounts(object):
+    """Lines and bytes counted by a thread, as a dict of streams to lists of
+    [lines, bytes, folded lines, folded bytes]. Only the thread adds to the
+    lines and bytes, and the folded counts are only changed with the lock of
+    the :class:`ThreadStreamStats`, so other threads can fold the counts
+    without losing any.
+    """
+
+    __slots__ = ('streams', 'exit_ref')
+
+    def __init__(self):
+        self.streams = {}
+        self.exit_ref = None
+
+
+class _ThreadExitGuard(object):
+    """Kept only in the thread local storage of a thread, so that it is
+    collected when the thread exits"""
+
+    __slots__ = ('__weakref__',)
+
+
+class ThreadStreamStats(StreamStats):
+    """:class:`StreamStats` whose threads count their lines without locking,
+    for the lines of every call to :func:`clog.log_line`.
+
+    Each thread counts the lines of its streams on its own, and the counts
+    of all the threads are folded into the heaviest streams when they are
+    read or reported. The counts of a thread are also folded when it exits,
+    and when it counted `capacity` streams since its last fold, which bounds
+    its memory. The replacements of the space saving algorithm therefore
+    happen on the folds rather than on every line.
+
+    :param capacity: maximum number of tracked streams
+    :param report_interval: seconds between two reports of the counts of
+        the tracked streams as metrics, after which the counts start over.
+        0 to never report them
+    """
+
+    def __init__(self, capacity, report_interval=0):
+        self._thread_counts = threading.local()
+        # counts of the live threads
+        self._all_thread_counts = set()
+        super(ThreadStreamStats, self).__init__(capacity, report_interval)
+
+    def add(self, stream, lines, size):
+        """Count `lines` lines of `size` bytes in total for `stream`"""
+        try:
+            counts = self._thread_counts.counts
+        except AttributeError:
+            counts = self._register_thread()
+        entry = counts.streams.get(stream)
+        if entry is None:
+            if len(counts.streams) >= self.capacity:
+                self._fold_counts(counts, clear=True)
+            counts.streams[stream] = [lines, size, 0, 0]
+        else:
+            entry[0] += lines
+            entry[1] += size
+        if self.report_interval and time.time() >= self._next_report:
+            self.report()
+
+    def _register_thread(self):
+        counts = _ThreadStreamCounts()
+        guard = _ThreadExitGuard()
+        stats_ref = weakref.ref(self)
+
+        def thread_exited(_):
+            stats = stats_ref()
+            if stats is not None:
+                stats._fold_counts(counts, exited=True)
+
+        counts.exit_ref = weakref.ref(guard, thread_exited)
+        self._thread_counts.counts = counts
+        self._thread_counts.guard = guard
+        with self._lock:
+            self._all_thread_counts.add(counts)
+        return counts
+
+    def _fold_counts(self, counts, clear=False, exited=False):
+        """Count the lines of a thread which were not folded yet, `clear`
+        is only used by the thread itself"""
+        with self._lock:
+            self._fold_thread_counts(counts)
+            if clear:
+                counts.streams = {}
+            if exited:
+                self._all_thread_counts.discard(counts)
+
+    def _fold_thread_counts(self, counts):
+        # a copy, the thread may count a new stream meanwhile
+        for stream, entry in counts.streams.copy().items():
+            lines = entry[0]
+            size = entry[1]
+            if lines != entry[2] or size != entry[3]:
+                self._count(stream, lines - entry[2], size - entry[3])
+                entry[2] = lines
+                entry[3] = size
+
+    def fold_counts(self):
+        """Fold the lines counted by every thread into the heaviest streams"""
+        with self._lock:
+            for counts in list(self._all_thread_counts):
+                self._fold_thread_counts(counts)
+
+    def reset(self):
+        self.fold_counts()
+        super(ThreadStreamStats, self).reset()
+
+    def top(self, count=None):
+        self.fold_counts()
+        return super(ThreadStreamStats, self).top(count)
+
+    def snapshot(self, count=None):
+        self.fold_counts()
+        return super(ThreadStreamStats, self).snapshot(count)
+
+    def report(self):
+        self.fold_counts()
+        super(ThreadStreamStats, self).report()
+
+
+def create_stream_stats(report=False, per_thread=False):
+    """Build a :class:`StreamStats` from `config.stream_stats_capacity`
+
+    :param report: whether the counts are reported every
+        `config.stream_stats_report_interval` seconds
+    :param per_thread: whether to build a :class:`ThreadStreamStats`
+    """
+    report_interval = float(config.stream_stats_report_interval) if report else 0
+    stats_class = ThreadStreamStats if per_thread else StreamStats
+    return stats_class(int(config.stream_stats_capacity), report_interval)
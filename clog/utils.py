@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import bz2
+import fnmatch
 import gzip
 import re
 
@@ -40,6 +41,66 @@ def scribify(stream_name):
     return text_to_native_str(stream_name)
 
 
+class StreamPatternMap(object):
+    """Map stream names to values using exact names, prefixes and glob
+    patterns.
+
+    A pattern ending with a single `*` and without other wildcards (like
+    `tmp_*`) is a prefix, a pattern with wildcards (`*`, `?` or `[`) elsewhere
+    is a glob, and anything else is an exact stream name. Lookups try exact
+    names first, then the longest matching prefix, then globs in the order
+    they were given.
+
+    :param items: iterable of (pattern, value) pairs
+    """
+
+    def __init__(self, items=()):
+        self.exact = {}
+        self.prefixes = []
+        self.globs = []
+        for pattern, value in items:
+            if pattern.endswith('*') and not _has_wildcard(pattern[:-1]):
+                self.prefixes.append((pattern[:-1], value))
+            elif _has_wildcard(pattern):
+                self.globs.append((re.compile(fnmatch.translate(pattern)), value))
+            else:
+                self.exact[pattern] = value
+        self.prefixes.sort(key=lambda prefix_value: len(prefix_value[0]), reverse=True)
+
+    def __bool__(self):
+        return bool(self.exact or self.prefixes or self.globs)
+
+    __nonzero__ = __bool__
+
+    def get(self, stream, default=None):
+        """Return the value of the best pattern matching `stream`"""
+        if isinstance(stream, bytes):
+            stream = stream.decode('UTF-8')
+        try:
+            return self.exact[stream]
+        except KeyError:
+            pass
+        for prefix, value in self.prefixes:
+            if stream.startswith(prefix):
+                return value
+        for regex, value in self.globs:
+            if regex.match(stream):
+                return value
+        return default
+
+
+def _has_wildcard(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+def config_list_to_items(config_list):
+    """PyStaticConfig doesn't support having a map in the configuration, so
+    maps are represented as a list of single item dicts. Return the
+    (key, value) pairs of such a list, preserving their order.
+    """
+    return [list(mapping.items())[0] for mapping in config_list]
+
+
 def open_compressed_file(filename, mode='r'):
     """Open a file as raw, gzip, or bz2, based on the filename."""
     if filename.endswith('.bz2'):
@@ -1,16 +1,74 @@
 import uwsgi
+import itertools
 import logging
+import os
+import platform
+import threading
+import time
+from collections import OrderedDict
 import clog
+import clog.config
 import clog.global_state
 import clog.handlers
+import clog.sampling
 import struct
+import zlib
 import six
+from clog.metrics_reporter import MetricsReporter
+from clog.shm_ring import ShmTransport
+from clog.shm_ring import stores_are_ordered
 from uwsgidecorators import mule_msg_dispatcher
 
 HEADER_TAG = b'clog'
 ENCODE_FMT = '{}sii'.format(len(HEADER_TAG))
 HEADER_SZ = struct.calcsize(ENCODE_FMT)
 
+# Messages packing several records: the tag, the version of the framing and
+# the number of records, then for each record the lengths of its stream and
+# line followed by the stream and the line
+MULTI_HEADER_TAG = b'clgm'
+MULTI_VERSION = 1
+MULTI_ENCODE_FMT = '{}sBi'.format(len(MULTI_HEADER_TAG))
+MULTI_HEADER_SZ = struct.calcsize(MULTI_ENCODE_FMT)
+RECORD_ENCODE_FMT = 'ii'
+RECORD_HEADER_SZ = struct.calcsize(RECORD_ENCODE_FMT)
+
+# Fragments of the messages larger than max_recv_size: the tag, the pid of
+# the sender, its id for the message, the index of the fragment and the
+# number of fragments, followed by a slice of the message
+FRAGMENT_HEADER_TAG = b'clgf'
+FRAGMENT_ENCODE_FMT = '{}sIQii'.format(len(FRAGMENT_HEADER_TAG))
+FRAGMENT_HEADER_SZ = struct.calcsize(FRAGMENT_ENCODE_FMT)
+
+# Envelope of the messages sent by the workers: the tag and the time the
+# message was enqueued, followed by a single record, multi record or shared
+# memory message. The mule measures from it how long messages wait for it.
+TIMESTAMP_HEADER_TAG = b'clgt'
+TIMESTAMP_ENCODE_FMT = '{}sd'.format(len(TIMESTAMP_HEADER_TAG))
+TIMESTAMP_HEADER_SZ = struct.calcsize(TIMESTAMP_ENCODE_FMT)
+
+# Tags of all the messages of the plugin, the other messages are meant for
+# uwsgidecorators
+MULE_MSG_TAGS = (HEADER_TAG, MULTI_HEADER_TAG, FRAGMENT_HEADER_TAG, TIMESTAMP_HEADER_TAG)
+
+# How MuleSharder spreads the lines over the mules
+SHARDING_HASH = 'hash'
+SHARDING_ROUND_ROBIN = 'round_robin'
+SHARDING_MODES = (SHARDING_HASH, SHARDING_ROUND_ROBIN)
+
+# maximum number of streams whose mule is cached at once
+MAX_CACHED_SHARDS = 10000
+
+# Size of the shared memory ring of each worker, and seconds the mule waits
+# for a wakeup before looking at the rings anyway
+DEFAULT_SHM_SLOT_CAPACITY = 1024 * 1024
+SHM_WAIT_TIMEOUT_S = 1.0
+
+# Limits of the messages a mule is reassembling at once
+MAX_REASSEMBLED_MSGS = 64
+MAX_REASSEMBLED_BYTES = 128 * 1024 * 1024
+REASSEMBLY_TIMEOUT_S = 30
+
 
 def _encode_mule_msg(stream, line):
     if isinstance(stream, six.text_type):
@@ -32,12 +90,165 @@ def _decode_mule_msg(msg):
     return msg[:l1], msg[l1:]
 
 
+def _encode_record(stream, line):
+    if isinstance(stream, six.text_type):
+        stream = stream.encode('UTF-8')
+    if isinstance(line, six.text_type):
+        line = line.encode('UTF-8')
+    return struct.pack(RECORD_ENCODE_FMT, len(stream), len(line)) + stream + line
+
+
+def _encode_multi_mule_msg(records):
+    """Pack records encoded by `_encode_record` into one message"""
+    return struct.pack(MULTI_ENCODE_FMT, MULTI_HEADER_TAG, MULTI_VERSION, len(records)) + b''.join(records)
+
+
+def _decode_mule_msgs(msg):
+    """Return the list of (stream, line) records of a single or multi
+    record message"""
+    if msg[:len(MULTI_HEADER_TAG)] != MULTI_HEADER_TAG:
+        return [_decode_mule_msg(msg)]
+
+    _, version, count = struct.unpack(MULTI_ENCODE_FMT, msg[:MULTI_HEADER_SZ])
+    if version != MULTI_VERSION:
+        raise ValueError("Unsupported multi record version %d" % version)
+
+    records = []
+    offset = MULTI_HEADER_SZ
+    for _ in six.moves.range(count):
+        l1, l2 = struct.unpack(RECORD_ENCODE_FMT, msg[offset:offset + RECORD_HEADER_SZ])
+        offset += RECORD_HEADER_SZ
+        if offset + l1 + l2 > len(msg):
+            raise ValueError("Message does not match specified size")
+        records.append((msg[offset:offset + l1], msg[offset + l1:offset + l1 + l2]))
+        offset += l1 + l2
+    if offset != len(msg):
+        raise ValueError("Message does not match specified size")
+    return records
+
+
+def _stamp_mule_msg(msg, enqueue_time=None):
+    """Wrap a message in an envelope with its enqueue time, now by default"""
+    if enqueue_time is None:
+        enqueue_time = time.time()
+    return struct.pack(TIMESTAMP_ENCODE_FMT, TIMESTAMP_HEADER_TAG, enqueue_time) + msg
+
+
+def _unstamp_mule_msg(msg):
+    """Return the enqueue time of a message and the message without its
+    envelope. The enqueue time is None for the messages of older workers,
+    which are not stamped."""
+    if msg[:len(TIMESTAMP_HEADER_TAG)] != TIMESTAMP_HEADER_TAG:
+        return None, msg
+    _, enqueue_time = struct.unpack(TIMESTAMP_ENCODE_FMT, msg[:TIMESTAMP_HEADER_SZ])
+    return enqueue_time, msg[TIMESTAMP_HEADER_SZ:]
+
+
+def _encode_fragments(data, fragment_size):
+    """Split a message into fragment messages of at most `fragment_size`
+    bytes"""
+    payload_size = fragment_size - FRAGMENT_HEADER_SZ
+    count = (len(data) + payload_size - 1) // payload_size
+    msg_id = next(_fragmented_msg_ids)
+    return [
+        struct.pack(FRAGMENT_ENCODE_FMT, FRAGMENT_HEADER_TAG, os.getpid(), msg_id, index, count)
+        + data[index * payload_size:(index + 1) * payload_size]
+        for index in six.moves.range(count)
+    ]
+
+
+class FragmentReassembler(object):
+    """Reassemble the messages split by `_encode_fragments` in a mule.
+
+    At most `max_msgs` messages and `max_bytes` bytes of fragments are kept
+    at once, the oldest incomplete messages are dropped beyond that or after
+    `timeout` seconds.
+    """
+
+    def __init__(self, max_msgs=MAX_REASSEMBLED_MSGS, max_bytes=MAX_REASSEMBLED_BYTES,
+                 timeout=REASSEMBLY_TIMEOUT_S):
+        self.max_msgs = max_msgs
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # (pid, msg id) -> [first fragment time, fragments, received count]
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+        self.dropped_msgs = 0
+
+    def add(self, msg):
+        """Add a fragment, returns the whole message once all its fragments
+        have been received, None otherwise"""
+        tag, pid, msg_id, index, count = struct.unpack(FRAGMENT_ENCODE_FMT, msg[:FRAGMENT_HEADER_SZ])
+        if tag != FRAGMENT_HEADER_TAG or not 0 <= index < count:
+            raise ValueError("Invalid fragment header")
+        payload = msg[FRAGMENT_HEADER_SZ:]
+        now = time.time()
+        self._drop_expired(now)
+
+        key = (pid, msg_id)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [now, [None] * count, 0]
+        fragments = entry[1]
+        if len(fragments) != count or fragments[index] is not None:
+            raise ValueError("Inconsistent fragment")
+        fragments[index] = payload
+        entry[2] += 1
+        self.pending_bytes += len(payload)
+
+        if entry[2] == count:
+            del self.pending[key]
+            self.pending_bytes -= sum(len(fragment) for fragment in fragments)
+            return b''.join(fragments)
+
+        while len(self.pending) > self.max_msgs or self.pending_bytes > self.max_bytes:
+            self._drop_oldest()
+        return None
+
+    def _drop_expired(self, now):
+        while self.pending:
+            first_fragment_time = next(iter(self.pending.values()))[0]
+            if now - first_fragment_time < self.timeout:
+                break
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        _, (_, fragments, _) = self.pending.popitem(last=False)
+        self.pending_bytes -= sum(len(fragment) for fragment in fragments if fragment is not None)
+        self.dropped_msgs += 1
+
+
 def _mule_msg(stream, line, mule=None):
-    data = _encode_mule_msg(stream, line)
+    data = _stamp_mule_msg(_encode_mule_msg(stream, line))
     # Unfortunately this check has to come after the marshalling
     # unless we just want to make a conservative guess
     if len(data) > max_recv_size:
-        return False
+        # All the fragments must reach the same mule, the shared queue
+        # would spread them
+        return _send_fragments(data, mule or _fragment_mule(stream))
+    return _send_mule_msg(data, mule)
+
+
+def _fragment_mule(stream):
+    """Return the mule receiving the fragments of a line of `stream` sent
+    without a mule: the mule of the stream among `config.uwsgi_mules`, so
+    that the large lines are spread like the others, or
+    DEFAULT_FRAGMENT_MULE when the mules are not configured"""
+    sharder = _get_sharder()
+    if sharder is not None:
+        return sharder.mule_for(stream)
+    return DEFAULT_FRAGMENT_MULE
+
+
+def _send_fragments(data, mule):
+    for fragment in _encode_fragments(data, max_recv_size):
+        # Explicit 'False' check, as in uwsgi_log_line
+        if _send_mule_msg(fragment, mule) == False:
+            return False
+    return True
+
+
+def _send_mule_msg(data, mule=None):
     # Either deliver to a specific mule msg queue
     # or the shared queue which will be handled by
     # the first available mule (yay!)
@@ -47,13 +258,382 @@ def _mule_msg(stream, line, mule=None):
 
 def _plugin_mule_msg_shim(message):
     try:
-        args = _decode_mule_msg(message)
-        return _orig_log_line(*args)
+        decoded = _decode_worker_msg(message)
     except Exception:
+        if message[:len(HEADER_TAG)] in MULE_MSG_TAGS:
+            _get_mule_metrics().mule_decode_failure()
         return mule_msg_dispatcher(message)
+    if decoded is not None:
+        _log_worker_records(*decoded)
+
+
+def _decode_worker_msg(message):
+    """Return the enqueue time and the (stream, line) records of a message
+    of a worker, or None for a fragment of a message which is not complete
+    yet. Raises if the message is not a valid message of the plugin."""
+    if message[:len(FRAGMENT_HEADER_TAG)] == FRAGMENT_HEADER_TAG:
+        message = _reassembler.add(message)
+        if message is None:
+            return None
+    enqueue_time, message = _unstamp_mule_msg(message)
+    return enqueue_time, _decode_mule_msgs(message)
+
+
+def _log_worker_records(enqueue_time, records):
+    """Log the records of a message of a worker, and record its latency
+    once they are written, or once the mule batcher sends them"""
+    mule_batcher = _get_mule_batcher()
+    metrics = _get_mule_metrics()
+    # stream -> [lines, bytes]
+    throughput = {}
+    with metrics.sampled_request(len(records)):
+        for stream, line in records:
+            try:
+                if mule_batcher is not None:
+                    mule_batcher.add(stream, line, enqueue_time)
+                else:
+                    _orig_log_line(stream, line, sample_key=clog.sampling.ALREADY_SAMPLED)
+            except Exception:
+                logging.exception('Failed to log a line of stream %r from a worker', stream)
+            counts = throughput.get(stream)
+            if counts is None:
+                counts = throughput[stream] = [0, 0]
+            counts[0] += 1
+            counts[1] += len(line)
+    if enqueue_time is not None and mule_batcher is None:
+        metrics.mule_latency(time.time() - enqueue_time)
+    for stream, (lines, size) in throughput.items():
+        metrics.stream_throughput(stream, lines, size)
+
+
+def _get_mule_metrics():
+    """Return the MetricsReporter counting the lines handled by this mule,
+    with the mule id in its backend dimension"""
+    global _mule_metrics
+    if _mule_metrics is None:
+        mule_id = getattr(uwsgi, 'mule_id', lambda: 0)()
+        _mule_metrics = MetricsReporter(
+            backend='uwsgi_mule_%d' % mule_id,
+            sample_rate=clog.config.metrics_sample_rate,
+        )
+    return _mule_metrics
+
+
+def _get_worker_metrics():
+    """Return the MetricsReporter of the lines which this worker could not
+    send to a mule"""
+    global _worker_metrics
+    if _worker_metrics is None:
+        _worker_metrics = MetricsReporter(
+            backend='uwsgi_worker',
+            sample_rate=clog.config.metrics_sample_rate,
+        )
+    return _worker_metrics
+
+
+class MuleSharder(object):
+    """Choose the mule of each line among a set of mules.
+
+    With SHARDING_HASH, each stream is always sent to the same mule, chosen
+    by rendezvous hashing of the stream name, so the lines of a stream stay
+    in order and only the streams of a removed mule move. With
+    SHARDING_ROUND_ROBIN, lines go to the mules in turn.
+
+    :param mules: list of mule ids
+    :param mode: one of SHARDING_MODES
+    """
+
+    def __init__(self, mules, mode=SHARDING_HASH):
+        if not mules:
+            raise ValueError('MuleSharder needs at least one mule')
+        if mode not in SHARDING_MODES:
+            raise ValueError('Unknown sharding mode %r' % (mode,))
+        self.mules = list(mules)
+        self.mode = mode
+        self.sent_lines = dict((mule, 0) for mule in self.mules)
+        self._stream_mules = {}
+        self._next_mules = itertools.cycle(self.mules)
+
+    def mule_for(self, stream):
+        if self.mode == SHARDING_ROUND_ROBIN:
+            mule = next(self._next_mules)
+        else:
+            try:
+                mule = self._stream_mules[stream]
+            except KeyError:
+                if len(self._stream_mules) >= MAX_CACHED_SHARDS:
+                    self._stream_mules.clear()
+                mule = self._stream_mules[stream] = self._hash_mule(stream)
+        self.sent_lines[mule] += 1
+        return mule
+
+    def _hash_mule(self, stream):
+        if isinstance(stream, six.text_type):
+            stream = stream.encode('UTF-8')
+        stream_hash = zlib.crc32(stream) & 0xffffffff
+        # the crc32 of the stream and mule pairs alone are too correlated
+        # between the mules, which favors some of them
+        return max(
+            self.mules,
+            key=lambda mule: _mix_hash(stream_hash ^ (zlib.crc32(str(mule).encode('ascii')) & 0xffffffff)),
+        )
+
+
+def _mix_hash(value):
+    """Finalizer of MurmurHash3, spreading the bits of a 32 bits value"""
+    value ^= value >> 16
+    value = (value * 0x85ebca6b) & 0xffffffff
+    value ^= value >> 13
+    value = (value * 0xc2b2ae35) & 0xffffffff
+    return value ^ (value >> 16)
+
+
+def _get_sharder():
+    global _sharder
+    if _sharder is _NOT_CREATED:
+        mules = list(clog.config.uwsgi_mules)
+        if mules:
+            _sharder = MuleSharder(mules, clog.config.uwsgi_sharding)
+        else:
+            _sharder = None
+    return _sharder
+
+
+def _shard(stream, mule):
+    """Return the mule to send a line of `stream` to, an explicit `mule`
+    wins over the sharding"""
+    if mule is None:
+        sharder = _get_sharder()
+        if sharder is not None:
+            return sharder.mule_for(stream)
+    return mule
+
+
+class MuleBatcher(object):
+    """Accumulate the lines received by a mule per stream, and send them
+    with one `log_lines` call per stream instead of one round trip per line.
+
+    A stream is sent when it has `max_lines` lines or `max_bytes` bytes
+    pending, and every stream is sent once the oldest pending line is
+    `max_delay` seconds old. The delay is checked on every message and by a
+    flusher thread, started in the mule on the first line, for the idle
+    periods (the thread needs uwsgi's `enable-threads`).
+
+    :param log_lines: function sending the lines of a stream, like
+        :func:`clog.log_lines`
+    :param max_lines: number of pending lines of a stream triggering a send
+    :param max_bytes: number of pending bytes of a stream triggering a send
+    :param max_delay: maximum time in seconds a line is kept pending
+    :param record_latency: optional function called with the seconds
+        between the enqueue time of each message given to :meth:`add` and
+        the send of its lines
+    """
+
+    def __init__(self, log_lines, max_lines, max_bytes, max_delay, record_latency=None):
+        self.log_lines = log_lines
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.record_latency = record_latency
+        # stream -> [lines, bytes, enqueue times of their messages]
+        self.pending = {}
+        self.oldest_pending = None
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def add(self, stream, line, enqueue_time=None):
+        now = time.time()
+        with self._lock:
+            batch = self.pending.get(stream)
+            if batch is None:
+                batch = self.pending[stream] = [[], 0, []]
+            batch[0].append(line)
+            batch[1] += len(line)
+            # the records of a message are added in a row
+            if enqueue_time is not None and (not batch[2] or batch[2][-1] != enqueue_time):
+                batch[2].append(enqueue_time)
+            if self.oldest_pending is None:
+                self.oldest_pending = now
+            full_batch = None
+            if len(batch[0]) >= self.max_lines or batch[1] >= self.max_bytes:
+                full_batch = self.pending.pop(stream)
+            expired = now - self.oldest_pending >= self.max_delay
+            if self._flusher is None:
+                self._start_flusher()
+
+        if full_batch is not None:
+            self._send(stream, full_batch)
+        if expired:
+            self.flush()
+
+    def flush(self):
+        """Send all the pending lines"""
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+            self.oldest_pending = None
+        for stream, batch in pending.items():
+            self._send(stream, batch)
+
+    def _send(self, stream, batch):
+        lines, _, enqueue_times = batch
+        try:
+            self.log_lines(stream, lines, sample_key=clog.sampling.ALREADY_SAMPLED)
+        finally:
+            if self.record_latency is not None and enqueue_times:
+                now = time.time()
+                for enqueue_time in enqueue_times:
+                    self.record_latency(now - enqueue_time)
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_periodically, name='clog-mule-flush')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.max_delay)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Failed to send the batched lines of the mule')
+
+
+class WorkerCoalescer(object):
+    """Pack the lines logged by a worker into multi record mule messages of
+    at most `max_size` bytes, instead of sending one message per line.
+
+    The records are sent when the next one would not fit, at the end of
+    each request through uwsgi's `after_req_hook`, and once the oldest
+    record is `max_delay` seconds old. As for :class:`MuleBatcher`, the
+    delay is checked on every line and by a flusher thread.
+
+    The records pending in the master when the workers are forked, as when
+    an application preloaded by the master logs, are sent by the master:
+    a forked worker starts with no pending record and its own flusher.
+
+    :param max_size: maximum size in bytes of a message
+    :param max_delay: maximum time in seconds a line is kept pending
+    """
+
+    def __init__(self, max_size, max_delay):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # mule -> [encoded records, size of the message, enqueue time of
+        # the first record]
+        self.pending = {}
+        self.oldest_pending = None
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # called with the lock held, the flusher thread of the parent does
+        # not run in a forked child
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.pending = {}
+            self.oldest_pending = None
+            self._flusher = None
+
+    def add(self, stream, line, mule=None):
+        record = _encode_record(stream, line)
+        if TIMESTAMP_HEADER_SZ + MULTI_HEADER_SZ + len(record) > self.max_size:
+            # too large to be packed, let the single record path handle it,
+            # after the records pending for the mule to keep them in order
+            with self._lock:
+                self._check_fork()
+                pending_message = self.pending.pop(mule, None)
+            if pending_message is not None:
+                self._send(pending_message, mule)
+            _log_line_to_mule(stream, line, mule)
+            return
+
+        now = time.time()
+        full_message = None
+        with self._lock:
+            self._check_fork()
+            message = self.pending.get(mule)
+            if message is not None and message[1] + len(record) > self.max_size:
+                full_message = self.pending.pop(mule)
+                message = None
+            if message is None:
+                message = self.pending[mule] = [[], TIMESTAMP_HEADER_SZ + MULTI_HEADER_SZ, now]
+            message[0].append(record)
+            message[1] += len(record)
+            if self.oldest_pending is None:
+                self.oldest_pending = now
+            expired = now - self.oldest_pending >= self.max_delay
+            if self._flusher is None:
+                self._start_flusher()
+
+        if full_message is not None:
+            self._send(full_message, mule)
+        if expired:
+            self.flush()
+
+    def flush(self):
+        """Send all the pending records"""
+        with self._lock:
+            self._check_fork()
+            pending = self.pending
+            self.pending = {}
+            self.oldest_pending = None
+        for mule, message in pending.items():
+            self._send(message, mule)
+
+    def _send(self, message, mule):
+        records, _, enqueue_time = message
+        data = _encode_multi_mule_msg(records)
+        # Explicit 'False' check, as in uwsgi_log_line
+        if _send_mule_msg(_stamp_mule_msg(data, enqueue_time), mule) == False:
+            _get_worker_metrics().mule_fallback(len(records))
+            for stream, line in _decode_mule_msgs(data):
+                _orig_log_line(stream, line, sample_key=clog.sampling.ALREADY_SAMPLED)
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_periodically, name='clog-worker-flush')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.max_delay)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Failed to send the coalesced lines of the worker')
+
+
+def _get_coalescer():
+    global _coalescer
+    if _coalescer is _NOT_CREATED:
+        if clog.config.uwsgi_coalesce_delay > 0:
+            _coalescer = WorkerCoalescer(max_recv_size, float(clog.config.uwsgi_coalesce_delay))
+        else:
+            _coalescer = None
+    return _coalescer
+
+
+def _get_mule_batcher():
+    global _mule_batcher
+    if _mule_batcher is _NOT_CREATED:
+        if clog.config.uwsgi_mule_batch_lines > 1:
+            _mule_batcher = MuleBatcher(
+                _orig_log_lines,
+                int(clog.config.uwsgi_mule_batch_lines),
+                int(clog.config.uwsgi_mule_batch_bytes),
+                float(clog.config.uwsgi_mule_batch_delay),
+                record_latency=_get_mule_metrics().mule_latency,
+            )
+        else:
+            _mule_batcher = None
+    return _mule_batcher
 
 
 class UwsgiHandler(logging.Handler):
+    """Send the records of a logger to a mule. Pass `mule=None` to use the
+    mules of `config.uwsgi_mules`, or the shared queue without them."""
 
     def __init__(self, stream, mule=1):
         logging.Handler.__init__(self)
@@ -63,32 +643,139 @@ class UwsgiHandler(logging.Handler):
     def emit(self, record):
         try:
             msg = self.format(record)
-            _mule_msg(self.stream, msg, mule=self.mule)
+            _mule_msg(self.stream, msg, mule=_shard(self.stream, self.mule))
         except Exception:
             raise
         except:
             self.handleError(record)
 
 
-def uwsgi_log_line(stream, line, mule=None):
+def _get_sampler():
+    global _sampler
+    if _sampler is _NOT_CREATED:
+        _sampler = clog.global_state.create_sampler()
+    return _sampler
+
+
+def uwsgi_log_line(stream, line, mule=None, sample_key=None):
+    # Sample in the worker, before paying for the encoding and the mule
+    # message. The mule must not sample the kept lines again.
+    sampler = _get_sampler()
+    if sampler is not None and not sampler.keep(stream, sample_key):
+        return
+    if _shm_transport is not None and _shm_send(stream, line):
+        return
+    mule = _shard(stream, mule)
+    coalescer = _get_coalescer()
+    if coalescer is not None:
+        coalescer.add(stream, line, mule)
+    else:
+        _log_line_to_mule(stream, line, mule)
+
+
+def uwsgi_log_lines(stream, lines, mule=None, sample_key=None):
+    # With a sample key, the lines are kept or dropped together, once
+    sampler = _get_sampler()
+    if sampler is not None and sample_key is not None:
+        if not sampler.keep(stream, sample_key):
+            return
+        sample_key = clog.sampling.ALREADY_SAMPLED
+    for line in lines:
+        uwsgi_log_line(stream, line, mule=mule, sample_key=sample_key)
+
+
+def _log_line_to_mule(stream, line, mule):
     # Explicit 'False' check - see https://github.com/unbit/uwsgi/pull/1482
     # We don't want to double-emit on 'None' response if we have older uwsgi
     if _mule_msg(stream, line, mule=mule) == False:
-        _orig_log_line(stream, line)
+        _get_worker_metrics().mule_fallback(1)
+        _orig_log_line(stream, line, sample_key=clog.sampling.ALREADY_SAMPLED)
+
+
+def _shm_send(stream, line):
+    slot = uwsgi.worker_id() - 1
+    if not 0 <= slot < len(_shm_transport.rings):
+        return False
+    return _shm_transport.send(slot, _stamp_mule_msg(_encode_mule_msg(stream, line)))
+
+
+def uwsgi_setup_shm_transport(slot_capacity=DEFAULT_SHM_SLOT_CAPACITY):
+    """Send the lines of :func:`uwsgi_log_line` through shared memory rings,
+    one per worker, instead of mule messages. This must be called in the
+    master, before the workers and mules are forked, and a mule must run
+    :func:`uwsgi_shm_mule_loop`.
+
+    A line which does not fit in the ring of its worker takes the mule
+    message path, as do all the lines on machines whose stores are not
+    ordered, where the rings are not safe.
+
+    :param slot_capacity: size in bytes of the ring of each worker
+    """
+    global _shm_transport
+    if not stores_are_ordered():
+        logging.warning('Shared memory rings are not supported on %s, using mule messages', platform.machine())
+        return
+    _shm_transport = ShmTransport(uwsgi.numproc, slot_capacity)
+
+
+def uwsgi_shm_mule_loop():
+    """Log the lines the workers write to the shared memory rings, forever.
+    Run it in a single mule, for instance from a mule script."""
+    while True:
+        _drain_shm_transport(SHM_WAIT_TIMEOUT_S)
+
+
+def _drain_shm_transport(timeout):
+    _shm_transport.wait(timeout)
+    for message in _shm_transport.drain():
+        try:
+            decoded = _decode_worker_msg(message)
+        except Exception:
+            _get_mule_metrics().mule_decode_failure()
+            logging.exception('Failed to decode a message from the shared memory rings')
+            continue
+        if decoded is not None:
+            _log_worker_records(*decoded)
+
+
+def _uwsgi_atexit():
+    # uwsgi does not always run the python atexit hooks of workers and mules,
+    # so flush the global loggers from its own exit hook as well
+    try:
+        if _coalescer not in (None, _NOT_CREATED):
+            _coalescer.flush()
+        if _mule_batcher not in (None, _NOT_CREATED):
+            _mule_batcher.flush()
+        clog.global_state.shutdown(clog.config.shutdown_timeout)
+    finally:
+        if _orig_uwsgi_atexit is not None:
+            _orig_uwsgi_atexit()
+
+
+def _uwsgi_after_req_hook():
+    try:
+        if _coalescer not in (None, _NOT_CREATED):
+            _coalescer.flush()
+    finally:
+        if _orig_uwsgi_after_req_hook is not None:
+            _orig_uwsgi_after_req_hook()
 
 
 def uwsgi_patch_global_state():
-    map(
-        lambda x: setattr(x, 'log_line', uwsgi_log_line),
-        (clog, clog.global_state)
-    )
+    for module in (clog, clog.global_state):
+        setattr(module, 'log_line', uwsgi_log_line)
+        setattr(module, 'log_lines', uwsgi_log_lines)
 
 
 # Couple setup tasks at import:
 # 1. Insert 'UwsgiHandler' into the clog.handlers module for seamless usage
-# 2. Store reference to the original global_state.log_line for fallback
+# 2. Store reference to the original global_state.log_line and log_lines for
+#    fallback and mule batching
 # 3. Override the plugin mule_msg_hook call to intercept our messages*
 # 4. Fetch mule_msg_recv_size to calculate send limit
+# 5. Chain the uwsgi exit hook to flush the global loggers at shutdown
+# 6. Chain the uwsgi after request hook to send the lines coalesced by the
+#    worker at the end of each request
 #
 # * By default the uwsgidecorators module installs its own hook to dispatch
 # messages formatted by its decorator objects. We could insert into this dispatch
@@ -100,6 +787,25 @@ def uwsgi_patch_global_state():
 
 setattr(clog.handlers, 'UwsgiHandler', UwsgiHandler)
 _orig_log_line = clog.global_state.log_line
+_orig_log_lines = clog.global_state.log_lines
+# Ids of the messages split in fragments by this process, and the fragments
+# received by this mule
+_fragmented_msg_ids = itertools.count()
+_reassembler = FragmentReassembler()
+# Mule receiving the fragments of the lines sent to the shared queue when
+# config.uwsgi_mules is not set
+DEFAULT_FRAGMENT_MULE = 1
+# The sampler and coalescer of the workers and the batcher of the mules are
+# built from the configuration on first use
+_NOT_CREATED = object()
+_sampler = _NOT_CREATED
+_coalescer = _NOT_CREATED
+_sharder = _NOT_CREATED
+_mule_batcher = _NOT_CREATED
+_mule_metrics = None
+_worker_metrics = None
+# Shared memory rings of uwsgi_setup_shm_transport
+_shm_transport = None
 # It's vital that no other module override this hook after we have done so.
 # This is an unfortunate consequence of the uwsgi_python plugin but the
 # hook implementation isn't naturally exstensible - we're managing here by
@@ -108,3 +814,7 @@ _orig_log_line = clog.global_state.log_line
 uwsgi.mule_msg_hook = _plugin_mule_msg_shim
 # See https://github.com/unbit/uwsgi/pull/1487
 max_recv_size = getattr(uwsgi, 'mule_msg_recv_size', lambda: 65536)()
+_orig_uwsgi_atexit = getattr(uwsgi, 'atexit', None)
+uwsgi.atexit = _uwsgi_atexit
+_orig_uwsgi_after_req_hook = getattr(uwsgi, 'after_req_hook', None)
+uwsgi.after_req_hook = _uwsgi_after_req_hook
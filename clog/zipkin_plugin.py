@@ -10,11 +10,36 @@ try:
 except ImportError:
     pass
 
+# Returns the ZipkinAttrs of the current trace, None outside of a trace
+try:
+    from py_zipkin.storage import get_default_tracer
+
+    def _get_zipkin_attrs():
+        return get_default_tracer().get_zipkin_attrs()
+except ImportError:
+    try:
+        # py_zipkin < 0.13
+        from py_zipkin.thread_local import get_zipkin_attrs as _get_zipkin_attrs
+    except ImportError:
+        _get_zipkin_attrs = None
+
+# maximum number of span names cached by a ZipkinTracing at once
+MAX_CACHED_SPAN_NAMES = 10000
+
 
 def use_zipkin():
     return zipkin_plugin_enabled and config.use_zipkin
 
 
+def _in_sampled_trace():
+    """Whether the current thread is in a sampled Zipkin trace, assumed
+    when py_zipkin cannot tell"""
+    if _get_zipkin_attrs is None:
+        return True
+    zipkin_attrs = _get_zipkin_attrs()
+    return zipkin_attrs is not None and zipkin_attrs.is_sampled
+
+
 class ZipkinTracing(object):
     """Wrapper class to instrument log_line calls with Zipkin.
 
@@ -24,9 +49,16 @@ class ZipkinTracing(object):
         if use_zipkin():
             logger = ZipkinTracing(logger)
 
-    Each call to log_line will add a Zipkin Span and call the underlying
-    log_line, all other method call will only call the corresponding method
-    of the underlying logger object.
+    Inside a sampled Zipkin trace, log_line and log_lines call the underlying
+    method in a span named after the logger, the method and the stream, and
+    flush calls it in a span named after the logger. Outside of a sampled
+    trace no span is opened and the underlying method is called directly;
+    versions of py_zipkin which cannot tell whether the current trace is
+    sampled always get the spans. All other method calls only call the
+    corresponding method of the underlying logger object.
+
+    The flush span never fires from :func:`clog.global_state.shutdown`: it
+    flushes each logger in its own thread, which has no trace context.
 
     :param logger: a logger instance, must have a log_line(stream, line) method
     """
@@ -36,16 +68,48 @@ class ZipkinTracing(object):
 
         self.logger = logger
         self.logger_name = self.logger.__class__.__name__
+        # (method name, stream) -> span name
+        self._span_names = {}
+
+    def _span_name(self, method_name, stream):
+        try:
+            return self._span_names[method_name, stream]
+        except KeyError:
+            if len(self._span_names) >= MAX_CACHED_SPAN_NAMES:
+                self._span_names.clear()
+            span_name = self._span_names[method_name, stream] = '{name}.{method} {stream}'.format(
+                name=self.logger_name,
+                method=method_name,
+                stream=stream,
+            )
+            return span_name
 
     def log_line(self, stream, line):
+        if not _in_sampled_trace():
+            return self.logger.log_line(stream, line)
         with zipkin_span(
             service_name='yelp_clog',
-            span_name='{name}.log_line {stream}'.format(
-                name=self.logger_name,
-                stream=stream,
-            ),
+            span_name=self._span_name('log_line', stream),
         ):
             return self.logger.log_line(stream, line)
 
+    def log_lines(self, stream, lines):
+        if not _in_sampled_trace():
+            return self.logger.log_lines(stream, lines)
+        with zipkin_span(
+            service_name='yelp_clog',
+            span_name=self._span_name('log_lines', stream),
+        ):
+            return self.logger.log_lines(stream, lines)
+
+    def flush(self, timeout=None):
+        if not _in_sampled_trace():
+            return self.logger.flush(timeout)
+        with zipkin_span(
+            service_name='yelp_clog',
+            span_name='{name}.flush'.format(name=self.logger_name),
+        ):
+            return self.logger.flush(timeout)
+
     def __getattr__(self, item):
         return getattr(self.logger, item)
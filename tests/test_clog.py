@@ -30,7 +30,8 @@ from clog import loggers
 from clog.handlers import CLogHandler, DEFAULT_FORMAT
 from clog.handlers import get_scribed_logger
 from clog.loggers import FileLogger, GZipFileLogger, MockLogger, MonkLogger, StdoutLogger
-from clog.utils import scribify
+from clog.priority import PriorityBuffer
+from clog.utils import scribify, StreamPatternMap
 
 
 first_line = 'First Line.'
@@ -122,6 +123,31 @@ class TestFileLogger(object):
 
         assert self._open_and_remove(logger.stream_files[stream].name) == expected_output
 
+    def test_log_lines(self, log_directory):
+        logger = FileLogger()
+        stream = 'file_logger_stream'
+        with mock.patch.object(logger, '_create_file', wraps=logger._create_file):
+            logger.log_lines(stream, ['hello', '☃'])
+            logger.log_lines(stream, [])
+        logger.close()
+
+        assert self._open_and_remove(logger.stream_files[stream].name) == 'hello\n☃\n'
+
+    def test_stats(self, log_directory):
+        logger = FileLogger()
+        logger.log_line('stream1', 'hello')
+        logger.log_lines('stream2', ['a', 'bc'])
+        stats = logger.stats()
+        logger.close()
+        for stream_file in logger.stream_files.values():
+            os.remove(stream_file.name)
+
+        assert stats['open_files'] == 2
+        assert stats['lines_sent'] == 3
+        assert stats['bytes_sent'] == len('hello\na\nbc\n')
+        assert stats['io_seconds'] >= 0
+        assert [entry['stream'] for entry in stats['streams']['streams']] == ['stream1', 'stream2']
+
     def test_cant_open_stream(self, log_directory, capsys):
         log_dir = os.path.join(log_directory, 'non_existent_directory')
         with staticconf.testing.MockConfiguration(log_dir=log_dir, namespace='clog'):
@@ -200,6 +226,25 @@ class TestStdoutLogger(object):
         ])
         assert mock_stdout.flush.call_count == 1
 
+    def test_log_lines(self):
+        with mock.patch('sys.stdout') as mock_stdout:
+            StdoutLogger().log_lines('stream1', [first_line, second_line])
+
+        mock_stdout.write.assert_called_once_with(
+            'stream1:{0}\nstream1:{1}\n'.format(first_line, second_line)
+        )
+
+    def test_stats_without_stream_counts(self):
+        with mock.patch('sys.stdout'):
+            logger = StdoutLogger(count_streams=False)
+            logger.log_line('stream1', first_line)
+            logger.log_lines('stream1', [first_line, second_line])
+        assert logger.stats() == {
+            'lines_sent': 3,
+            'bytes_sent': 2 * len(first_line) + len(second_line),
+            'streams': None,
+        }
+
 
 @pytest.mark.acceptance_suite
 class TestCLogMonkLogger(object):
@@ -248,6 +293,19 @@ class TestCLogMonkLogger(object):
         assert self.producer.send_messages.call_count == 3
         assert len(self.logger.buffer) == 0
 
+    def test_stats(self):
+        self.producer.send_messages.side_effect = ((), Exception())
+        self.logger.log_lines(self.stream, ['line1', 'line2'])
+        self.logger.log_line(self.stream, 'line3')
+        stats = self.logger.stats()
+        assert not stats['connected']
+        assert stats['lines_sent'] == 2
+        assert stats['bytes_sent'] == 10
+        assert stats['failures'] == 1
+        assert stats['buffer_lines'] == 1
+        assert stats['buffer_bytes'] == 5
+        assert stats['streams']['lines'] == 3
+
     def test_memory_bytes(self):
         self.producer.send_messages.return_value = True
 
@@ -274,6 +332,29 @@ class TestCLogMonkLogger(object):
 
         assert len(self.logger.buffer) == 1
 
+    def test_eviction_by_priority(self):
+        self.logger.maximum_buffer_bytes = 10
+        self.logger.buffer = PriorityBuffer(StreamPatternMap([
+            ('billing', 'critical'),
+            ('debug', 'low'),
+        ]))
+        self.logger._add_to_buffer('billing', 'a' * 4)
+        self.logger._add_to_buffer('debug', 'b' * 4)
+        # the low priority line is evicted for the normal one
+        self.logger._add_to_buffer('other', 'c' * 4)
+        assert list(self.logger.buffer) == [('billing', 'a' * 4), ('other', 'c' * 4)]
+        # a line is not buffered at the expense of more important ones
+        self.logger._add_to_buffer('debug', 'd' * 4)
+        assert list(self.logger.buffer) == [('billing', 'a' * 4), ('other', 'c' * 4)]
+        assert self.logger.buffer_bytes == 8
+
+        self.producer.send_messages.return_value = True
+        self.logger._flush_buffer()
+        assert self.producer.send_messages.call_args_list == [
+            mock.call('billing', ['a' * 4], None),
+            mock.call('other', ['c' * 4], None),
+        ]
+
     def test_reenqueue(self):
         self.producer.send_messages.side_effect = Exception()
 
@@ -290,6 +371,36 @@ class TestCLogMonkLogger(object):
         assert len(self.logger.buffer) == 10
         assert self.producer.send_messages.call_count == 2
 
+    def test_log_lines(self):
+        self.logger.log_lines(self.stream, ['content1', 'content2'])
+        self.producer.send_messages.assert_called_once_with(
+            'test_stream', ['content1', 'content2'], None)
+
+    def test_log_lines_buffers_all_lines_on_failure(self):
+        self.producer.send_messages.side_effect = Exception()
+        self.logger.log_lines(self.stream, ['content1', 'content2'])
+        assert list(self.logger.buffer) == [('test_stream', 'content1'), ('test_stream', 'content2')]
+
+    def test_flush(self):
+        self.producer.send_messages.side_effect = Exception()
+        for i in range(3):
+            self.logger.log_line(self.stream, 'content{}'.format(i))
+        assert len(self.logger.buffer) == 3
+
+        # the flush ignores the backoff and stops at the first failure
+        self.producer.send_messages.side_effect = ((), Exception())
+        assert self.logger.flush(timeout=1) == (1, 2)
+        assert list(self.logger.buffer) == [('test_stream', 'content1'), ('test_stream', 'content2')]
+        assert self.logger.buffer_bytes == len('content1') * 2
+
+        self.producer.send_messages.side_effect = None
+        assert self.logger.flush(timeout=1) == (2, 0)
+
+    def test_flush_timeout(self):
+        self.logger._add_to_buffer(self.stream, 'content')
+        assert self.logger.flush(timeout=0) == (0, 1)
+        assert not self.producer.send_messages.called
+
     def test_buffering_disabled(self):
         self.logger.use_buffer = False
         self.logger.timeout_backoff_s = 0
@@ -300,3 +411,26 @@ class TestCLogMonkLogger(object):
 
         assert len(self.logger.buffer) == 0
         assert self.producer.send_messages.call_count == 10
+
+
+class TestStreamPatternMap(object):
+
+    def test_matching_order(self):
+        pattern_map = StreamPatternMap([
+            ('tmp_*', 'short prefix'),
+            ('tmp_foo_*', 'long prefix'),
+            ('*_errors', 'glob'),
+            ('tmp_bar', 'exact'),
+            ('tmp_?oo_[xy]', 'other glob'),
+        ])
+        assert pattern_map.get('tmp_bar') == 'exact'
+        assert pattern_map.get(b'tmp_bar') == 'exact'
+        assert pattern_map.get('tmp_foo_errors') == 'long prefix'
+        assert pattern_map.get('tmp_errors') == 'short prefix'
+        assert pattern_map.get('app_errors') == 'glob'
+        assert pattern_map.get('zoo_x') is None
+        assert pattern_map.get('app', 'default') == 'default'
+
+    def test_empty(self):
+        assert not StreamPatternMap()
+        assert StreamPatternMap([('stream', 1)])
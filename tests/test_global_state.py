@@ -12,14 +12,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import threading
+
 import mock
 import pytest
 import staticconf.testing
 
 import clog
-from clog import config, global_state, loggers
+from clog import config, global_state, loggers, rate_limit
 from clog.global_state import create_preferred_backend_map
 from clog.global_state import check_create_default_loggers
+from clog.rate_limit import StreamRateLimiter
+from clog.sampling import StreamSampler
+from clog.stream_stats import StreamStats
+from clog.utils import StreamPatternMap
 
 SCRIBE_CONFIG = {
     "scribe_disable": False,
@@ -76,6 +82,9 @@ class TestGlobalState(object):
         check_create_default_loggers()
         assert len(global_state.loggers) == 1
         assert isinstance(global_state.loggers[0], loggers.ScribeMonkLogger)
+        # the lines are only counted by the global stream stats
+        assert global_state.loggers[0].scribe_logger.stream_stats is None
+        assert global_state.loggers[0].monk_logger.stream_stats is None
 
     def test_global_state_monk_not_installed(self):
         config.configure_from_dict(SCRIBE_MONK_CONFIG)
@@ -84,3 +93,222 @@ class TestGlobalState(object):
         check_create_default_loggers()
         assert len(global_state.loggers) == 1
         assert isinstance(global_state.loggers[0], loggers.ScribeLogger)
+
+    def _mock_sinks(self, stream_sinks=(), rate_limiter=None, sampler=None):
+        sinks = [(name, loggers.MockLogger()) for name in global_state.SINK_NAMES]
+        stream_routes = global_state.StreamRoutes(
+            sinks, StreamPatternMap(stream_sinks), rate_limiter, sampler)
+        patch = mock.patch.object(global_state, '_stream_routes', stream_routes)
+        return patch, dict(sinks)
+
+    def test_stats(self):
+        patch, sinks = self._mock_sinks(stream_sinks=[('debug', ['file'])])
+        patch.new.stream_stats = StreamStats(capacity=10)
+        with patch, mock.patch.object(global_state, '_stream_stats', patch.new.stream_stats):
+            global_state.log_line('stream', 'line')
+            global_state.log_lines('debug', (line for line in ['a', 'bc']))
+            stats = clog.stats()
+        assert stats['global']['lines'] == 3
+        assert stats['global']['bytes'] == 7
+        assert [entry['stream'] for entry in stats['global']['streams']] == ['stream', 'debug']
+        assert stats['configured']
+        assert stats['sinks'] == {
+            'file': {'lines_sent': 3},
+            'scribe': {'lines_sent': 1},
+            'stdout': {'lines_sent': 1},
+        }
+
+    def test_log_line_dispatches_to_all_loggers(self):
+        patch, sinks = self._mock_sinks()
+        with patch:
+            global_state.log_line('stream', 'line')
+        for logger in sinks.values():
+            assert logger.lines == {'stream': ['line']}
+
+    def test_log_lines(self):
+        patch, sinks = self._mock_sinks()
+        with patch:
+            global_state.log_lines('stream', iter(['line1', 'line2']))
+        for logger in sinks.values():
+            assert logger.lines == {'stream': ['line1', 'line2']}
+
+    def test_stream_sinks_routing(self):
+        patch, sinks = self._mock_sinks([
+            ('debug_*', ['file']),
+            ('debug_heavy', ['scribe']),
+            ('*_audit', ['scribe', 'stdout']),
+            ('dropped', []),
+        ])
+        with patch:
+            for stream in ('debug_foo', 'debug_heavy', 'billing_audit', 'dropped', 'other'):
+                global_state.log_line(stream, 'line')
+            global_state.log_lines('debug_bar', ['line'])
+        assert sorted(sinks['file'].lines) == ['debug_bar', 'debug_foo', 'other']
+        assert sorted(sinks['scribe'].lines) == ['billing_audit', 'debug_heavy', 'other']
+        assert sorted(sinks['stdout'].lines) == ['billing_audit', 'other']
+
+    def test_create_stream_sinks_map(self):
+        config.configure_from_dict({
+            "stream_sinks": [
+                {"debug_*": ["file"]},
+                {"heavy": ["scribe"]},
+            ]
+        })
+        stream_sinks = global_state.create_stream_sinks_map()
+        assert stream_sinks.get('debug_foo') == ['file']
+        assert stream_sinks.get('heavy') == ['scribe']
+        assert stream_sinks.get('other') is None
+
+    def test_create_stream_sinks_map_unknown_sink(self):
+        config.configure_from_dict({"stream_sinks": [{"debug_*": ["files"]}]})
+        with pytest.raises(ValueError):
+            global_state.create_stream_sinks_map()
+
+    def test_create_rate_limiter(self):
+        assert global_state.create_rate_limiter() is None
+        config.configure_from_dict({
+            "stream_rate_limits": [{"debug_*": {"lines_per_second": 5}}],
+            "rate_limit_critical_streams": ["audit_*"],
+        })
+        rate_limiter = global_state.create_rate_limiter()
+        assert rate_limiter.stream_limits.get('debug_foo') == {'lines_per_second': 5}
+        assert rate_limiter.critical_streams.get('audit_billing')
+
+    def test_rate_limited_log_line(self):
+        rate_limiter = mock.Mock(spool=None)
+        rate_limiter.admit.side_effect = lambda stream, line: line != 'shed'
+        patch, sinks = self._mock_sinks(rate_limiter=rate_limiter)
+        with patch:
+            global_state.log_line('stream', 'line')
+            global_state.log_line('stream', 'shed')
+            global_state.log_lines('stream', ['shed', 'line2'])
+        for logger in sinks.values():
+            assert logger.lines == {'stream': ['line', 'line2']}
+
+    def test_rate_limited_spool_is_drained(self):
+        rate_limiter = mock.Mock(spool=True)
+        rate_limiter.drain_spool.return_value = [('other', 'spooled')]
+        patch, sinks = self._mock_sinks([('other', ['file'])], rate_limiter=rate_limiter)
+        with patch:
+            global_state.log_line('stream', 'line')
+        assert sinks['file'].lines == {'stream': ['line'], 'other': ['spooled']}
+        assert sinks['scribe'].lines == {'stream': ['line']}
+
+    def test_create_sampler(self):
+        assert global_state.create_sampler() is None
+        config.configure_from_dict({"stream_sample_rates": [{"debug_*": 0.1}]})
+        assert global_state.create_sampler().rate_for('debug_foo') == 0.1
+
+    def test_create_sampler_invalid_rate(self):
+        config.configure_from_dict({"stream_sample_rates": [{"debug_*": 10}]})
+        with pytest.raises(ValueError):
+            global_state.create_sampler()
+
+    def test_sampled_log_line(self):
+        sampler = StreamSampler(StreamPatternMap([('debug_*', 0.5), ('off', 0)]))
+        patch, sinks = self._mock_sinks(sampler=sampler)
+        keys = ['request-%d' % i for i in range(20)]
+        kept_keys = [key for key in keys if sampler.keep('debug_foo', key)]
+        with patch:
+            for key in keys:
+                global_state.log_line('debug_foo', key, sample_key=key)
+            global_state.log_line('off', 'line')
+            global_state.log_lines('off', ['line1', 'line2'])
+            global_state.log_lines('debug_bar', ['line1', 'line2'], sample_key=kept_keys[0])
+            global_state.log_line('other', 'line')
+        assert sinks['scribe'].lines == {
+            'debug_foo': kept_keys,
+            'debug_bar': ['line1', 'line2'],
+            'other': ['line'],
+        }
+
+    def test_stream_routes_cache_is_bounded(self):
+        patch, _ = self._mock_sinks()
+        with patch, mock.patch.object(global_state, 'MAX_CACHED_STREAM_ROUTES', 2):
+            for stream in ('a', 'b', 'c'):
+                global_state.log_line(stream, 'line')
+            assert list(global_state._stream_routes) == ['c']
+
+    def test_reset_default_loggers(self):
+        config.configure_from_dict(SCRIBE_CONFIG)
+        check_create_default_loggers()
+        scribe_logger = global_state.loggers[0]
+        assert global_state._stream_routes['stream'] == (scribe_logger.log_line,)
+
+        with mock.patch.object(scribe_logger, 'close') as mock_close:
+            global_state.reset_default_loggers()
+        assert mock_close.call_count == 1
+        assert global_state.loggers is None
+        assert global_state._stream_routes is None
+
+    def test_concurrent_creation_creates_loggers_once(self):
+        config.configure_from_dict(SCRIBE_CONFIG)
+        barrier = threading.Event()
+
+        def create():
+            barrier.wait()
+            check_create_default_loggers()
+
+        with mock.patch.object(global_state, 'ScribeLogger', wraps=loggers.ScribeLogger) as mock_logger:
+            threads = [threading.Thread(target=create) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            barrier.set()
+            for thread in threads:
+                thread.join()
+        assert mock_logger.call_count == 1
+        assert len(global_state._stream_routes.all_loggers) == 1
+
+    def test_shutdown(self):
+        patch, sinks = self._mock_sinks()
+        sinks['scribe'].flush = mock.Mock(return_value=(3, 1))
+        with patch:
+            report = global_state.shutdown(timeout=1)
+        assert global_state._stream_routes is None
+        assert report == {
+            'file': {'flushed': 0, 'abandoned': 0, 'timed_out': False},
+            'scribe': {'flushed': 3, 'abandoned': 1, 'timed_out': False},
+            'stdout': {'flushed': 0, 'abandoned': 0, 'timed_out': False},
+        }
+        sinks['scribe'].flush.assert_called_once_with(1)
+
+    def test_shutdown_abandons_spool(self):
+        rate_limiter = StreamRateLimiter(lines_per_second=1, overflow_policy=rate_limit.OVERFLOW_SPOOL)
+        patch, sinks = self._mock_sinks([('debug', ['file'])], rate_limiter=rate_limiter)
+        with patch:
+            global_state.log_line('stream', 'line1')
+            global_state.log_line('stream', 'line2')
+            global_state.log_line('debug', 'line3')
+            report = global_state.shutdown(timeout=1)
+        assert sinks['scribe'].lines == {'stream': ['line1']}
+        assert sinks['file'].lines == {'stream': ['line1']}
+        assert report['file']['abandoned'] == 2
+        assert report['scribe']['abandoned'] == 1
+        assert not rate_limiter.spool
+
+    def test_shutdown_timeout(self):
+        patch, sinks = self._mock_sinks()
+        flush_done = threading.Event()
+        sinks['scribe'].flush = mock.Mock(side_effect=lambda timeout: flush_done.wait())
+        sinks['scribe'].close = mock.Mock()
+        try:
+            with patch:
+                report = global_state.shutdown(timeout=0.05)
+        finally:
+            flush_done.set()
+        assert report['scribe'] == {'flushed': None, 'abandoned': None, 'timed_out': True}
+        assert report['file']['timed_out'] is False
+        assert not sinks['scribe'].close.called
+
+    def test_shutdown_not_created(self):
+        with mock.patch.object(global_state, 'flush_default_reporters') as flush_reporters:
+            assert global_state.shutdown(timeout=1) == {}
+        # the pending summaries of the status reports are sent
+        assert flush_reporters.call_count == 1
+
+    @mock.patch.object(config, 'is_logging_configured', False)
+    def test_not_configured(self):
+        with pytest.raises(global_state.LoggingNotConfiguredError):
+            global_state.log_line('stream', 'line')
+        # the error is only raised once, further lines are dropped
+        global_state.log_line('stream', 'line')
@@ -13,8 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+import os
+import socket
+import sys
+import threading
+import time
+
 import mock
 import pytest
+import simplejson as json
 
 from clog import handlers, loggers
 
@@ -51,6 +58,17 @@ class TestScribeHandler(object):
         with pytest.raises(KeyboardInterrupt):
             self.handler.emit(self.record)
 
+    def test_emit_batch(self):
+        self.handler.logger.log_lines = mock.Mock()
+        self.handler.emit_batch([self.record, self.record])
+        self.handler.logger.log_lines.assert_called_once_with('test_stream', ['oops', 'oops'])
+
+    def test_emit_batch_exception(self):
+        self.handler.logger.log_lines = mock.Mock(side_effect=Exception("Ooops"))
+        with mock.patch.object(self.handler, 'handleError') as handle_error:
+            self.handler.emit_batch([self.record])
+        handle_error.assert_called_once_with(self.record)
+
 
 class TestMonkHandler(object):
 
@@ -110,3 +128,198 @@ class TestCLogHandler(object):
         handler.emit(self.record)
         logger.log_line.assert_called_with(
             self.stream, self.record.exc_text)
+
+
+class TestAsyncScribeHandler(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def setup_handler(self):
+        self.handler = handlers.AsyncScribeHandler('localhost', 4545, 'test_stream', max_queue_size=2)
+        self.handler.logger.log_lines = mock.Mock()
+        self.record = logging.LogRecord(
+            'name', logging.WARN, 'path', 50, 'oops %s', ('arg',), None)
+        yield
+        self.handler.close(timeout=1)
+
+    def test_init(self):
+        assert self.handler.stream == 'test_stream'
+        assert self.handler.logger.__class__ == loggers.ScribeLogger
+        assert self.handler._listener.daemon
+
+    def test_invalid_queue_full_policy(self):
+        with pytest.raises(ValueError):
+            handlers.AsyncScribeHandler('localhost', 4545, 'test_stream', queue_full_policy='wait')
+
+    def test_emit(self):
+        self.handler.handle(self.record)
+        assert self.handler.flush(timeout=1) == (1, 0)
+        self.handler.logger.log_lines.assert_called_once_with('test_stream', ['oops arg'])
+
+    def _block_sending(self):
+        """Make the listener block in log_lines until the returned event is
+        set, and wait for it to take a first record.
+        """
+        sending, sent = threading.Event(), threading.Event()
+
+        def log_lines(stream, lines):
+            sending.set()
+            sent.wait()
+
+        self.handler.logger.log_lines.side_effect = log_lines
+        self.handler.handle(self.record)
+        assert sending.wait(1)
+        return sent
+
+    def test_emit_batches(self):
+        sent = self._block_sending()
+        self.handler.handle(self.record)
+        self.handler.handle(self.record)
+        sent.set()
+        self.handler.flush(timeout=1)
+        sent_lines = [c[0][1] for c in self.handler.logger.log_lines.call_args_list]
+        assert sent_lines == [['oops arg'], ['oops arg', 'oops arg']]
+
+    def test_emit_drops_when_full(self):
+        self.handler.metrics = mock.Mock()
+        sent = self._block_sending()
+        for _ in range(4):
+            self.handler.handle(self.record)
+        # one record is held by the listener, two are in the queue
+        assert self.handler.dropped_records == 2
+        sent.set()
+        assert self.handler.flush(timeout=1) == (3, 0)
+        self.handler.metrics.queue_dropped.assert_called_with(2)
+        self.handler.metrics.queue_depth.assert_called_with(0)
+
+    def test_flush_timeout(self):
+        sent = self._block_sending()
+        assert self.handler.flush(timeout=0.01) == (0, 1)
+        sent.set()
+
+    def test_flush_and_close_share_the_shutdown_timeout(self):
+        sent = self._block_sending()
+        self.handler.handle(self.record)
+        with mock.patch.object(handlers.config, 'shutdown_timeout', 0.5):
+            start = time.time()
+            assert self.handler.flush() == (0, 2)
+            self.handler.close()
+            elapsed = time.time() - start
+        sent.set()
+        # not a timeout for each of them
+        assert 0.5 <= elapsed < 1
+
+    def test_close_after_logging_gets_whole_timeout(self):
+        with mock.patch.object(handlers.config, 'shutdown_timeout', 1):
+            self.handler.flush()
+            self.handler._shutdown_deadline = time.time() - 10
+            self.handler.handle(self.record)
+            self.handler.close()
+        assert not self.handler._listener.is_alive()
+        self.handler.logger.log_lines.assert_called_once_with('test_stream', ['oops arg'])
+
+    def test_close_sends_queued_records(self):
+        self.handler.handle(self.record)
+        self.handler.close(timeout=1)
+        assert not self.handler._listener.is_alive()
+        self.handler.logger.log_lines.assert_called_once_with('test_stream', ['oops arg'])
+
+
+    def test_listener_restarted_after_fork(self):
+        self.handler.handle(self.record)
+        assert self.handler.flush(timeout=1) == (1, 0)
+        parent_listener = self.handler._listener
+        parent_queue = self.handler.queue
+        with mock.patch.object(handlers.os, 'getpid', return_value=os.getpid() + 1):
+            # the listener of the parent does not run in the child
+            assert self.handler.flush(timeout=1) == (0, 0)
+            self.handler.handle(self.record)
+            assert self.handler._listener is not parent_listener
+            assert self.handler.flush(timeout=1) == (1, 0)
+            assert self.handler.sent_records == 1
+            self.handler.close(timeout=1)
+        parent_queue.put(handlers._STOP_LISTENER)
+        parent_listener.join(1)
+        assert self.handler.logger.log_lines.call_count == 2
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+    def test_emit_in_forked_child(self):
+        pid = os.fork()
+        if not pid:
+            sent = False
+            try:
+                self.handler.handle(self.record)
+                sent = self.handler.flush(timeout=1) == (1, 0)
+            finally:
+                os._exit(0 if sent else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+
+
+class TestAsyncMonkHandler(object):
+
+    def test_emit(self):
+        record = logging.LogRecord('name', logging.WARN, 'path', 50, 'oops', None, None)
+        with mock.patch.object(handlers, 'MonkLogger') as logger:
+            handler = handlers.AsyncMonkHandler('test_client', 'test_stream')
+        handler.handle(record)
+        handler.close(timeout=1)
+        logger.return_value.log_lines.assert_called_once_with('test_stream', ['oops'])
+
+
+class TestJsonFormatter(object):
+
+    @pytest.fixture(autouse=True)
+    def setup_record(self):
+        self.record = logging.LogRecord(
+            'name', logging.WARN, 'path', 50, u'oops %s', (u'☃',), None)
+
+    def test_format(self):
+        formatter = handlers.JsonFormatter(static_fields={'service': 'test'})
+        msg = formatter.format(self.record)
+        assert isinstance(msg, bytes)
+        assert json.loads(msg.decode('UTF-8')) == {
+            'service': 'test',
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'created': self.record.created,
+            'levelname': 'WARNING',
+            'name': 'name',
+            'message': u'oops ☃',
+        }
+
+    def test_format_fields(self):
+        formatter = handlers.JsonFormatter(
+            fields=('lineno', 'asctime'), include_host=False, include_pid=False, datefmt='%Y')
+        assert json.loads(formatter.format(self.record)) == {
+            'lineno': 50,
+            'asctime': time.strftime('%Y', time.localtime(self.record.created)),
+        }
+
+    def test_format_only_static_fields(self):
+        formatter = handlers.JsonFormatter(fields=(), include_host=False)
+        assert formatter.format(self.record) == ('{"pid":%d}' % os.getpid()).encode('UTF-8')
+
+    def test_format_no_fields(self):
+        formatter = handlers.JsonFormatter(fields=(), include_host=False, include_pid=False)
+        assert formatter.format(self.record) == b'{}'
+
+    def test_format_exception(self):
+        formatter = handlers.JsonFormatter(fields=('message',), include_host=False, include_pid=False)
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            self.record.exc_info = sys.exc_info()
+        values = json.loads(formatter.format(self.record))
+        assert values['exc_text'].endswith('ValueError: bad')
+
+    def test_static_fields_rebuilt_after_fork(self):
+        formatter = handlers.JsonFormatter(fields=(), include_host=False)
+        formatter.format(self.record)
+        with mock.patch('os.getpid', return_value=12345):
+            assert formatter.format(self.record) == b'{"pid":12345}'
+
+    def test_scribe_handler_sends_bytes(self):
+        handler = handlers.ScribeHandler('localhost', 4545, 'test_stream')
+        handler.setFormatter(handlers.JsonFormatter(fields=('message',), include_host=False, include_pid=False))
+        handler.logger.log_line = mock.Mock()
+        handler.emit(self.record)
+        handler.logger.log_line.assert_called_once_with('test_stream', u'{"message":"oops ☃"}'.encode('UTF-8'))
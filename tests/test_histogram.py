@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+from clog.histogram import LatencyHistogram
+
+
+class TestLatencyHistogram(object):
+
+    def test_buckets_precision(self):
+        histogram = LatencyHistogram(max_value=10 ** 9)
+        for value in [0, 1, 127, 128, 129, 1000, 123456, 10 ** 9]:
+            index = histogram._index(value)
+            highest = histogram._highest_value(index)
+            assert value <= highest <= value * 1.016 + 1
+            assert histogram._index(highest) == index
+            assert histogram._index(highest + 1) == index + 1
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        assert histogram.percentile(50) == pytest.approx(500, rel=0.016)
+        assert histogram.percentile(99) == pytest.approx(990, rel=0.016)
+        assert histogram.percentile(100) == 1000
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 1000
+        assert snapshot['min'] == 1
+        assert snapshot['max'] == 1000
+        assert snapshot['mean'] == 500.5
+        assert snapshot['p999'] == 1000
+
+    def test_max_value_and_reset(self):
+        histogram = LatencyHistogram(max_value=1000)
+        histogram.record(10 ** 6)
+        histogram.record(-1)
+        assert histogram.snapshot()['max'] == 1000
+        assert histogram.snapshot()['min'] == 0
+        histogram.reset()
+        assert histogram.snapshot() == {
+            'count': 0, 'min': None, 'max': None, 'mean': None,
+            'p50': None, 'p99': None, 'p999': None,
+        }
+
+    def test_merge(self):
+        first = LatencyHistogram()
+        second = LatencyHistogram()
+        first.record(10, count=3)
+        second.record(5000)
+        first.merge(second)
+        assert first.total_count == 4
+        assert (first.min, first.max) == (10, 5000)
+        assert first.percentile(75) == 10
+        with pytest.raises(ValueError):
+            first.merge(LatencyHistogram(max_value=1000))
@@ -14,6 +14,7 @@
 # limitations under the License.
 import shutil
 import tempfile
+import time
 
 import mock
 import pytest
@@ -28,6 +29,8 @@ from clog.loggers import MonkLogger
 from clog.loggers import ScribeLogger
 from clog.loggers import WARNING_SCRIBE_LINE_SIZE_IN_BYTES
 from clog.loggers import WHO_CLOG_LARGE_LINE_STREAM
+from clog.rate_limit import OVERFLOW_SPOOL
+from clog.rate_limit import StreamRateLimiter
 from testing.sandbox import find_open_port
 from testing.sandbox import scribed_sandbox
 from testing.sandbox import wait_on_log_data
@@ -119,6 +122,73 @@ class TestCLogScribeLoggerLineSize(object):
         call_2 = mock.call(WHO_CLOG_LARGE_LINE_STREAM, origin_info_line)
         mock_log_line_no_size_limit.assert_has_calls([call_1, call_2])
 
+    @mock.patch('clog.loggers.ScribeLogger._log_lines_no_size_limit')
+    def test_log_lines_single_batch(self, mock_log_lines_no_size_limit):
+        lines = [create_test_line(), u'☃']
+        self.logger.log_lines(self.stream, lines)
+        assert not self.logger.report_status.called
+        mock_log_lines_no_size_limit.assert_called_once_with(
+            self.stream, [lines[0], u'☃'.encode('UTF-8')])
+
+    @mock.patch('clog.loggers.ScribeLogger._log_lines_no_size_limit')
+    def test_log_lines_drops_too_long_lines(self, mock_log_lines_no_size_limit):
+        line = create_test_line()
+        with pytest.raises(LogLineIsTooLongError):
+            self.logger.log_lines(self.stream, [line, create_test_line(MAX_SCRIBE_LINE_SIZE_IN_BYTES), line])
+        mock_log_lines_no_size_limit.assert_called_once_with(self.stream, [line, line])
+        self.logger.report_status.assert_called_once_with(
+            True,
+            '1 log lines are dropped (line size larger than %r bytes)'
+            % MAX_SCRIBE_LINE_SIZE_IN_BYTES
+        )
+
+    @mock.patch('clog.loggers.ScribeLogger._log_lines_no_size_limit')
+    def test_log_lines_splits_batches(self, mock_log_lines_no_size_limit):
+        line = create_test_line(WARNING_SCRIBE_LINE_SIZE_IN_BYTES)
+        self.logger.log_lines(self.stream, [line] * 11)
+        # at most 50 MB per scribe call, then one report for the call site
+        assert [len(c[0][1]) for c in mock_log_lines_no_size_limit.call_args_list] == [9, 2, 1]
+        assert mock_log_lines_no_size_limit.call_args_list[2][0][0] == WHO_CLOG_LARGE_LINE_STREAM
+        assert self.logger.report_status.call_count == 1
+
+    @mock.patch('clog.loggers.ScribeLogger._log_lines_no_size_limit')
+    @mock.patch('clog.loggers.ScribeLogger._log_line_no_size_limit')
+    def test_rate_limiter(self, mock_log_line_no_size_limit, mock_log_lines_no_size_limit):
+        self.logger.rate_limiter = StreamRateLimiter(lines_per_second=2)
+        self.logger.log_line(self.stream, b'line1')
+        self.logger.log_lines(self.stream, [b'line2', b'line3'])
+        self.logger.log_line(self.stream, b'line4')
+        mock_log_line_no_size_limit.assert_called_once_with(self.stream, b'line1')
+        mock_log_lines_no_size_limit.assert_called_once_with(self.stream, [b'line2'])
+        assert self.logger.rate_limiter.shed_lines == {self.stream: 2}
+
+    @mock.patch('clog.loggers.ScribeLogger._log_lines_no_size_limit')
+    @mock.patch('clog.loggers.ScribeLogger._log_line_no_size_limit')
+    def test_rate_limiter_spool(self, mock_log_line_no_size_limit, mock_log_lines_no_size_limit):
+        self.logger.rate_limiter = StreamRateLimiter(lines_per_second=1, overflow_policy=OVERFLOW_SPOOL)
+        self.logger.log_lines(self.stream, [b'line1', b'line2', b'line3'])
+        mock_log_lines_no_size_limit.assert_called_once_with(self.stream, [b'line1'])
+        with mock.patch('clog.rate_limit.time.time', return_value=time.time() + 1):
+            self.logger.log_lines(self.stream, [])
+        mock_log_line_no_size_limit.assert_called_once_with(self.stream, b'line2')
+        assert self.logger.flush() == (0, 1)
+        assert not self.logger.rate_limiter.spool
+
+    def test_log_lines(self):
+        lines = [create_test_line(), create_test_line(10)]
+        self.logger.log_lines(self.stream, lines)
+        wait_on_log_data(self.log_path, b'\n'.join(lines) + b'\n')
+
+    def test_stats(self):
+        lines = [create_test_line(), create_test_line(10)]
+        self.logger.log_lines(self.stream, lines)
+        stats = self.logger.stats()
+        assert stats['connected']
+        assert stats['lines_sent'] == 2
+        assert stats['bytes_sent'] == sum(len(line) for line in lines)
+        assert stats['failures'] == 0
+        assert stats['streams']['lines'] == 2
+
 
 @pytest.mark.acceptance_suite
 class TestCLogMonkLoggerLineSize(object):
@@ -154,3 +224,34 @@ class TestCLogMonkLoggerLineSize(object):
         _, dest_stream, message_report_json = mock_log_line_no_size_limit.mock_calls[0][1]
         assert dest_stream == WHO_CLOG_LARGE_LINE_STREAM
         assert json.loads(message_report_json) == expected_message_report
+
+    @mock.patch('traceback.format_stack', autospec=True)
+    @mock.patch('clog.loggers.MonkLogger._log_lines_no_size_limit', autospec=True)
+    def test_log_lines_max_line_size(self, mock_log_lines_no_size_limit, mock_traceback):
+        line = create_test_line()
+        self.logger.log_lines(self.stream, [line, create_test_line(MAX_MONK_LINE_SIZE_IN_BYTES), line])
+        assert self.logger.report_status.call_count == 1
+        report_call, lines_call = mock_log_lines_no_size_limit.mock_calls
+        assert report_call[1][1] == WHO_CLOG_LARGE_LINE_STREAM
+        assert lines_call == mock.call(mock.ANY, self.stream, [line, line])
+
+    @mock.patch('clog.loggers.MonkLogger._log_line_no_size_limit', autospec=True)
+    def test_oversize_reports_sampled_by_call_site(self, mock_log_line_no_size_limit):
+        line = create_test_line(MAX_MONK_LINE_SIZE_IN_BYTES)
+
+        def log_oversize_line():
+            self.logger.log_line(self.stream, line)
+
+        with mock.patch('time.time', return_value=1000.0) as mock_time:
+            for _ in range(3):
+                log_oversize_line()
+            self.logger.log_line(self.stream, line)
+
+            # a new window reports the lines suppressed in the previous one
+            mock_time.return_value += self.logger.oversize_reporter.window
+            log_oversize_line()
+
+        assert self.logger.report_status.call_count == 3
+        reports = [json.loads(c[0][2]) for c in mock_log_line_no_size_limit.call_args_list]
+        assert [report.get('suppressed_count') for report in reports] == [None, None, 2]
+        assert sorted(self.logger.oversize_reporter.call_site_counts().values()) == [1, 4]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+import time
+
+import mock
+import pytest
+import staticconf.testing
+
+from clog import config
+from clog import metrics_backends
+from clog import metrics_reporter
+from clog.metrics_backends import PrometheusTextfileBackend
+from clog.metrics_backends import StatsdBackend
+
+
+class TestStatsdBackend(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def listener(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        yield
+        self.listener.close()
+
+    def create_backend(self, **kwargs):
+        return StatsdBackend('127.0.0.1', self.listener.getsockname()[1], flush_interval=60, **kwargs)
+
+    def test_aggregated_until_flush(self):
+        backend = self.create_backend()
+        counter = backend.create_counter('log_line.sent', {'backend': 'scribe'})
+        gauge = backend.create_gauge('log_line.queue_depth', {'backend': 'scribe'})
+        timer = backend.create_timer('log_line.latency_microseconds')
+        counter.count(2)
+        counter.count(value=3)
+        gauge.set(7)
+        gauge.set(4)
+        timer.record(value=12.5)
+        timer.record(value=30)
+        backend.flush()
+
+        packet = self.listener.recv(65536)
+        assert sorted(packet.split(b'\n')) == [
+            b'log_line.latency_microseconds:12.5|ms',
+            b'log_line.latency_microseconds:30|ms',
+            b'log_line.queue_depth:4|g|#backend:scribe',
+            b'log_line.sent:5|c|#backend:scribe',
+        ]
+
+        # counters are sent as increments, unchanged ones are not sent
+        counter.count(1)
+        backend.flush()
+        assert sorted(self.listener.recv(65536).split(b'\n')) == [
+            b'log_line.queue_depth:4|g|#backend:scribe',
+            b'log_line.sent:1|c|#backend:scribe',
+        ]
+
+    def test_packets_size(self):
+        backend = self.create_backend(max_packet_size=100)
+        for i in range(10):
+            backend.create_counter('counter%d' % i, {'backend': 'scribe'}).count(1)
+        backend.flush()
+        lines = []
+        while len(lines) < 10:
+            packet = self.listener.recv(65536)
+            assert len(packet) <= 100
+            lines.extend(packet.split(b'\n'))
+        assert sorted(lines) == sorted(
+            ('counter%d:1|c|#backend:scribe' % i).encode('ascii') for i in range(10))
+
+    def test_flush_interval(self):
+        with mock.patch.object(metrics_backends.time, 'time', return_value=100):
+            backend = self.create_backend()
+        counter = backend.create_counter('counter')
+        with mock.patch.object(backend, 'send') as send:
+            with mock.patch.object(metrics_backends.time, 'time', return_value=159):
+                counter.count(1)
+            assert not send.called
+            with mock.patch.object(metrics_backends.time, 'time', return_value=160):
+                counter.count(1)
+            send.assert_called_once_with({('counter', ()): 2}, {}, {})
+
+    def test_flush_decided_under_lock(self):
+        backend = StatsdBackend('localhost', 8125, flush_interval=60)
+        counter = backend.create_counter('counter')
+        with mock.patch.object(backend, 'send') as send:
+            with mock.patch.object(metrics_backends.time, 'time', return_value=backend._next_flush):
+                # another thread flushed between the check and the lock
+                real_lock = backend._lock
+
+                class FlushingLock(object):
+                    def __enter__(self):
+                        real_lock.acquire()
+                        backend._next_flush += 60
+
+                    def __exit__(self, *exc_info):
+                        real_lock.release()
+
+                backend._lock = FlushingLock()
+                backend._maybe_flush()
+                backend._lock = real_lock
+                assert not send.called
+                counter.count(1)
+            assert not send.called
+
+
+class TestPrometheusTextfileBackend(object):
+
+    def test_write(self, tmpdir):
+        path = str(tmpdir.join('clog.prom'))
+        backend = PrometheusTextfileBackend(path, flush_interval=60)
+        backend.create_counter('yelp_clog.total.log_line.sent', {'backend': 'scribe'}).count(3)
+        backend.create_gauge('yelp_clog.log_line.queue_depth', {'backend': 'monk'}).set(2)
+        backend.create_counter('counter').count(1)
+        timer = backend.create_timer('yelp_clog.log_line.latency', {'backend': 'scribe'})
+        timer.record(10)
+        timer.record(20)
+        with mock.patch.object(metrics_backends.os, 'getpid', return_value=42):
+            backend.flush()
+            timer.record(30)
+            backend.flush()
+
+        assert os.listdir(str(tmpdir)) == ['clog.42.prom']
+        with open(str(tmpdir.join('clog.42.prom'))) as prom_file:
+            assert prom_file.read() == (
+                '# TYPE counter counter\n'
+                'counter{pid="42"} 1\n'
+                '# TYPE yelp_clog_total_log_line_sent counter\n'
+                'yelp_clog_total_log_line_sent{backend="scribe",pid="42"} 3\n'
+                '# TYPE yelp_clog_log_line_queue_depth gauge\n'
+                'yelp_clog_log_line_queue_depth{backend="monk",pid="42"} 2\n'
+                '# TYPE yelp_clog_log_line_latency summary\n'
+                'yelp_clog_log_line_latency_count{backend="scribe",pid="42"} 3\n'
+                'yelp_clog_log_line_latency_sum{backend="scribe",pid="42"} 60\n'
+            )
+
+    def test_processes_write_their_own_files(self, tmpdir):
+        path = str(tmpdir.join('clog.prom'))
+        backend = PrometheusTextfileBackend(path, flush_interval=60)
+        counter = backend.create_counter('counter')
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child counts and writes its own file, then waits to be
+            # checked before exiting
+            try:
+                os.close(write_fd)
+                counter.count(2)
+                backend.flush()
+            finally:
+                os.read(read_fd, 1)
+                os._exit(0)
+        os.close(read_fd)
+        try:
+            counter.count(5)
+            backend.flush()
+            child_path = backend.process_path(pid)
+            for _ in range(500):
+                if os.path.exists(child_path):
+                    break
+                time.sleep(0.01)
+            with open(backend.process_path(os.getpid())) as prom_file:
+                assert 'counter{pid="%d"} 5\n' % os.getpid() in prom_file.read()
+            with open(child_path) as prom_file:
+                assert 'counter{pid="%d"} 2\n' % pid in prom_file.read()
+        finally:
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+
+        # the file of the child is removed once it is gone
+        backend.flush()
+        assert os.listdir(str(tmpdir)) == [os.path.basename(backend.process_path(os.getpid()))]
+
+    def test_rename_errors_are_ignored(self, tmpdir):
+        path = str(tmpdir.join('clog.prom'))
+        backend = PrometheusTextfileBackend(path, flush_interval=60)
+        backend.create_counter('counter').count(1)
+        with mock.patch.object(metrics_backends.os, 'rename', side_effect=OSError):
+            backend.flush()
+        assert os.listdir(str(tmpdir)) == []
+
+        backend.flush()
+        assert os.listdir(str(tmpdir)) == [os.path.basename(backend.process_path(os.getpid()))]
+
+    def test_missing_directory(self, tmpdir):
+        backend = PrometheusTextfileBackend(str(tmpdir.join('missing', 'clog.prom')), flush_interval=60)
+        backend.create_counter('counter').count(1)
+        backend.flush()
+        assert os.listdir(str(tmpdir)) == []
+
+
+class TestMetricsBackendConfig(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def setup_config(self):
+        with staticconf.testing.MockConfiguration(namespace=config.namespace):
+            metrics_backends.reset_metrics_backend()
+            yield
+            metrics_backends.reset_metrics_backend()
+
+    def test_meteorite_by_default(self):
+        assert metrics_backends.get_metrics_backend() is None
+
+    def test_statsd(self):
+        config.configure_from_dict({'metrics_backend': 'statsd', 'statsd_port': 9999})
+        backend = metrics_backends.get_metrics_backend()
+        assert isinstance(backend, StatsdBackend)
+        assert backend.address == ('127.0.0.1', 9999)
+        counter = metrics_reporter._create_or_fake_counter('counter', {'backend': 'test'})
+        counter.count(1)
+        assert backend.counters == {('counter', (('backend', 'test'),)): 1}
+
+    def test_prometheus_needs_path(self):
+        config.configure_from_dict({'metrics_backend': 'prometheus'})
+        with pytest.raises(ValueError):
+            metrics_backends.get_metrics_backend()
+
+    def test_unknown_backend(self):
+        config.configure_from_dict({'metrics_backend': 'graphite'})
+        with pytest.raises(ValueError):
+            metrics_backends.get_metrics_backend()
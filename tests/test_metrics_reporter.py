@@ -13,9 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 import pytest
 import mock
+import staticconf.testing
 
+import clog
+import clog.metrics_reporter
+from clog import config
 from clog.metrics_reporter import FakeMetric
 from clog.metrics_reporter import MetricsReporter
 
@@ -79,3 +85,129 @@ class TestMetricsReporter(object):
         assert metrics._sample_log_line_latency.record.call_count == 1
         # time.time() has a resolution of down to half a microsecond, so seeing under that means we're tracking s or ms.
         assert metrics._sample_log_line_latency.record.call_args[1]['value'] > 0.1
+
+    def test_stream_throughput(self):
+        metrics = MetricsReporter(backend="test")
+        with mock.patch('clog.metrics_reporter.MAX_STREAM_METRICS', 2), \
+                mock.patch('clog.metrics_reporter._create_or_fake_counter',
+                           side_effect=lambda *args: mock.Mock()) as create_counter:
+            metrics.stream_throughput(b'stream1', 2, 10)
+            metrics.stream_throughput(b'stream1', 1, 5)
+            metrics.stream_throughput('stream2', 1, 5)
+            metrics.stream_throughput('stream3', 1, 5)
+            metrics.stream_throughput('stream4', 1, 5)
+        dimensions = [c[0][1]['stream'] for c in create_counter.call_args_list]
+        assert dimensions == ['stream1'] * 2 + ['stream2'] * 2 + ['__other__'] * 2
+        lines_counter = metrics._stream_counters[b'stream1'][0]
+        assert lines_counter.count.call_args_list == [mock.call(2), mock.call(1)]
+        assert metrics._stream_counters['__other__'][1].count.call_count == 2
+
+    def test_lines_sampled_per_stream(self):
+        metrics = MetricsReporter(backend="test")
+        with mock.patch('clog.metrics_reporter._create_or_fake_counter',
+                        side_effect=lambda *args: mock.Mock()) as create_counter, \
+                mock.patch('clog.metrics_reporter._create_or_fake_gauge',
+                           side_effect=lambda *args: mock.Mock()):
+            metrics.lines_sampled(b'stream1', 1, 3)
+            metrics.lines_sampled('stream2', 2, 2)
+        assert [c[0][1]['stream'] for c in create_counter.call_args_list] == ['stream1', 'stream2']
+        sampled_out_counter, sample_rate_gauge = metrics._stream_sampling_metrics[b'stream1']
+        sampled_out_counter.count.assert_called_once_with(3)
+        sample_rate_gauge.set.assert_called_once_with(0.25)
+        metrics._stream_sampling_metrics['stream2'][1].set.assert_called_once_with(0.5)
+
+    def test_per_thread_counters(self):
+        metrics = MetricsReporter(backend="test", sample_rate=3)
+        metrics._total_log_line_sent = mock.Mock(FakeMetric())
+        with metrics.sampled_request(2):
+            pass
+
+        def log_in_thread():
+            with metrics.sampled_request(2):
+                assert metrics._sample_counter == 2
+        thread = threading.Thread(target=log_in_thread)
+        thread.start()
+        thread.join()
+        # the lines of the thread are reported when it exits
+        metrics._total_log_line_sent.count.assert_called_once_with(value=2)
+
+        with metrics.sampled_request(2):
+            pass
+        metrics._total_log_line_sent.count.assert_called_with(value=4)
+        assert metrics._sample_counter == 0
+        assert len(metrics._all_thread_counts) == 1
+
+    def test_flush_counts(self):
+        metrics = MetricsReporter(backend="test", sample_rate=10)
+        metrics._total_log_line_sent = mock.Mock(FakeMetric())
+        with metrics.sampled_request(3):
+            pass
+        clog.metrics_reporter.flush_sampled_counts()
+        metrics._total_log_line_sent.count.assert_called_once_with(value=3)
+        assert metrics._sample_counter == 0
+        metrics.flush_counts()
+        assert metrics._total_log_line_sent.count.call_count == 1
+
+    def test_counts_folded_periodically(self):
+        metrics = MetricsReporter(backend="test", sample_rate=2)
+        metrics._total_log_line_sent = mock.Mock(FakeMetric())
+        # the counts of a thread which did not reach the sample rate
+        other_counts = clog.metrics_reporter._ThreadCounts()
+        other_counts.lines = 1
+        metrics._all_thread_counts.add(other_counts)
+        with metrics.sampled_request(2):
+            pass
+        metrics._total_log_line_sent.count.assert_called_once_with(value=2)
+
+        metrics._next_fold = 0
+        with metrics.sampled_request(2):
+            pass
+        assert metrics._total_log_line_sent.count.call_args_list[1:] == [mock.call(value=2), mock.call(value=1)]
+
+    def test_failed_request_not_recorded(self):
+        metrics = MetricsReporter(backend="test", sample_rate=1)
+        metrics._sample_log_line_latency = mock.Mock(FakeMetric())
+        with pytest.raises(ValueError):
+            with metrics.sampled_request():
+                raise ValueError()
+        assert not metrics._sample_log_line_latency.record.called
+        assert metrics._sample_counter == 1
+
+    def test_sample_rates_read_once(self):
+        with staticconf.testing.MockConfiguration(
+            {'metrics_sample_rate': 3, 'latency_histogram_sample_rate': 5}, namespace=config.namespace,
+        ):
+            metrics = MetricsReporter(backend="test", sample_rate=config.metrics_sample_rate)
+        # no configuration proxy on the path of every line
+        assert type(metrics._sample_rate) is int
+        assert type(metrics._histogram_sample_rate) is int
+        assert metrics._request_sample_rate == 3
+
+    def test_sample_rates_read_on_reload(self):
+        with staticconf.testing.MockConfiguration(
+            {'metrics_sample_rate': 3}, namespace=config.namespace,
+        ):
+            metrics = MetricsReporter(backend="test", sample_rate=config.metrics_sample_rate)
+            fixed = MetricsReporter(backend="test", sample_rate=4)
+            staticconf.DictConfiguration({'metrics_sample_rate': 7}, namespace=config.namespace)
+            config.reloader()
+            assert metrics._sample_rate == 7
+            assert metrics._request_sample_rate == 7
+            assert fixed._sample_rate == 4
+
+    def test_latency_snapshot(self):
+        with staticconf.testing.MockConfiguration(
+            {'stream_priorities': [{'audit': 'critical'}]}, namespace=config.namespace,
+        ):
+            metrics = MetricsReporter(backend="snapshot_test", sample_rate=0, histogram_sample_rate=2)
+        for stream in ['audit', 'audit', 'other', 'other', None, None]:
+            with metrics.sampled_request(stream=stream):
+                pass
+        snapshot = clog.latency_snapshot()['snapshot_test']
+        assert snapshot['critical']['count'] == 1
+        assert snapshot['normal']['count'] == 2
+        assert snapshot['low']['count'] == 0
+        assert snapshot['normal']['p99'] is not None
+
+        clog.reset_latency_histograms()
+        assert clog.latency_snapshot()['snapshot_test']['normal']['count'] == 0
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+import staticconf.testing
+
+from clog import config
+from clog import priority
+from clog.priority import PriorityBuffer
+from clog.utils import StreamPatternMap
+
+
+STREAM_PRIORITIES = StreamPatternMap([
+    ('billing', priority.PRIORITY_CRITICAL),
+    ('debug_*', priority.PRIORITY_LOW),
+])
+
+
+class TestPriorityBuffer(object):
+
+    def setup_method(self, method):
+        self.buffer = PriorityBuffer(STREAM_PRIORITIES)
+
+    def test_priority_of(self):
+        assert self.buffer.priority_of('billing') == 0
+        assert self.buffer.priority_of('other') == 2
+        assert self.buffer.priority_of('debug_foo') == 3
+
+    def test_higher_classes_first(self):
+        for item in [('debug_foo', 'a'), ('other', 'b'), ('billing', 'c'), ('other', 'd')]:
+            self.buffer.append(item)
+        assert len(self.buffer) == 4
+        assert self.buffer[0] == ('billing', 'c')
+        assert self.buffer[2] == ('other', 'd')
+        assert list(self.buffer) == [('billing', 'c'), ('other', 'b'), ('other', 'd'), ('debug_foo', 'a')]
+        assert self.buffer.popleft() == ('billing', 'c')
+        assert self.buffer.popleft() == ('other', 'b')
+
+    def test_evict_lowest_class_first(self):
+        for item in [('billing', 'a'), ('debug_foo', 'b'), ('debug_bar', 'c')]:
+            self.buffer.append(item)
+        assert self.buffer.lowest_priority() == 3
+        assert self.buffer.evict() == ('debug_foo', 'b')
+        assert self.buffer.evict() == ('debug_bar', 'c')
+        assert self.buffer.lowest_priority() == 0
+        assert self.buffer.evict() == ('billing', 'a')
+        assert self.buffer.lowest_priority() is None
+        assert not self.buffer
+        with pytest.raises(IndexError):
+            self.buffer.popleft()
+
+    def test_class_max_bytes(self):
+        buffer = PriorityBuffer(STREAM_PRIORITIES, {priority.PRIORITY_LOW: 10})
+        assert buffer.append(('debug_foo', 'a' * 6)) == []
+        assert buffer.append(('other', 'b' * 6)) == []
+        assert buffer.append(('debug_foo', 'c' * 6)) == [('debug_foo', 'a' * 6)]
+        assert list(buffer) == [('other', 'b' * 6), ('debug_foo', 'c' * 6)]
+        assert buffer.queue_bytes == [0, 0, 6, 6]
+
+
+    def test_remove_if(self):
+        for item in [('debug_foo', 'a'), ('other', 'bb'), ('billing', 'c'), ('other', 'dd')]:
+            self.buffer.append(item)
+        seen = []
+
+        def predicate(item):
+            seen.append(item)
+            return item[1] in ('a', 'bb')
+
+        self.buffer.remove_if(predicate)
+        assert seen == [('billing', 'c'), ('other', 'bb'), ('other', 'dd'), ('debug_foo', 'a')]
+        assert list(self.buffer) == [('billing', 'c'), ('other', 'dd')]
+        assert self.buffer.queue_bytes == [1, 0, 2, 0]
+
+
+class TestPriorityConfig(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def setup_config(self):
+        with staticconf.testing.MockConfiguration(namespace=config.namespace):
+            yield
+
+    def test_create_priority_buffer(self):
+        config.configure_from_dict({
+            "stream_priorities": [{"audit_*": "critical"}],
+            "priority_class_max_bytes": [{"low": 1024}],
+        })
+        buffer = priority.create_priority_buffer()
+        assert buffer.priority_of('audit_billing') == 0
+        assert buffer.max_queue_bytes == [None, None, None, 1024]
+
+    def test_unknown_priority_class(self):
+        config.configure_from_dict({"stream_priorities": [{"audit_*": "urgent"}]})
+        with pytest.raises(ValueError):
+            priority.create_stream_priorities_map()
+
+    def test_unknown_max_bytes_class(self):
+        config.configure_from_dict({"priority_class_max_bytes": [{"urgent": 1024}]})
+        with pytest.raises(ValueError):
+            priority.create_class_max_bytes()
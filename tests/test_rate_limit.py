@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import pytest
+
+from clog import rate_limit
+from clog.rate_limit import StreamRateLimiter
+from clog.rate_limit import TokenBucket
+from clog.utils import StreamPatternMap
+
+
+class TestTokenBucket(object):
+
+    def test_refill_is_capped(self):
+        with mock.patch.object(rate_limit.time, 'time', return_value=100.0):
+            bucket = TokenBucket(10)
+        bucket.take(10)
+        bucket.refill(100.5)
+        assert bucket.tokens == 5
+        bucket.refill(110)
+        assert bucket.tokens == 10
+
+    def test_has_reserved(self):
+        bucket = TokenBucket(10)
+        assert bucket.has(8)
+        assert not bucket.has(8, reserved=3)
+
+
+class TestStreamRateLimiter(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def mock_time(self):
+        with mock.patch.object(rate_limit.time, 'time', return_value=100.0) as self.mock_time:
+            yield
+
+    def admitted(self, limiter, stream, count, line='line'):
+        return sum(limiter.admit(stream, line) for _ in range(count))
+
+    def test_unknown_overflow_policy(self):
+        with pytest.raises(ValueError):
+            StreamRateLimiter(overflow_policy='queue')
+
+    def test_global_lines_limit(self):
+        limiter = StreamRateLimiter(lines_per_second=5)
+        assert self.admitted(limiter, 'stream', 10) == 5
+        assert limiter.shed_lines == {'stream': 5}
+
+        self.mock_time.return_value = 100.4
+        assert self.admitted(limiter, 'stream', 10) == 2
+
+    def test_bytes_limit(self):
+        limiter = StreamRateLimiter(bytes_per_second=10)
+        assert limiter.admit('stream', 'x' * 8)
+        assert not limiter.admit('stream', 'x' * 8)
+        assert limiter.admit('stream', 'xx')
+
+    def test_stream_limits(self):
+        limiter = StreamRateLimiter(stream_limits=StreamPatternMap([
+            ('debug_*', {'lines_per_second': 2}),
+        ]))
+        assert self.admitted(limiter, 'debug_foo', 5) == 2
+        assert self.admitted(limiter, 'debug_bar', 5) == 2
+        assert self.admitted(limiter, 'other', 5) == 5
+
+    def test_reserved_share_for_critical_streams(self):
+        limiter = StreamRateLimiter(
+            lines_per_second=10,
+            critical_streams=StreamPatternMap([('audit_*', True)]),
+            reserved_share=0.2,
+        )
+        assert self.admitted(limiter, 'feature', 20) == 8
+        assert self.admitted(limiter, 'audit_billing', 20) == 2
+
+    def test_sample_overflow(self):
+        limiter = StreamRateLimiter(
+            lines_per_second=1, overflow_policy=rate_limit.OVERFLOW_SAMPLE, sample_rate=0.25)
+        assert self.admitted(limiter, 'stream', 9) == 3
+        assert limiter.shed_lines == {'stream': 6}
+
+    def test_spool_overflow(self):
+        limiter = StreamRateLimiter(
+            lines_per_second=1, overflow_policy=rate_limit.OVERFLOW_SPOOL, max_spooled_lines=2)
+        assert limiter.admit('stream', 'line1')
+        assert not limiter.admit('stream', 'line2')
+        assert not limiter.admit('other', 'line3')
+        assert not limiter.admit('stream', 'line4')
+        # the oldest spooled line was evicted
+        assert limiter.shed_lines == {'stream': 1}
+        assert limiter.drain_spool() == []
+
+        self.mock_time.return_value = 101.0
+        assert limiter.drain_spool() == [('other', 'line3')]
+        self.mock_time.return_value = 102.0
+        assert limiter.drain_spool() == [('stream', 'line4')]
+        assert not limiter.spool
+
+    def test_spool_drains_streams_independently(self):
+        limiter = StreamRateLimiter(
+            overflow_policy=rate_limit.OVERFLOW_SPOOL,
+            stream_limits=StreamPatternMap([('slow', {'lines_per_second': 1})]),
+            lines_per_second=3,
+        )
+        assert limiter.admit('slow', 'line1')
+        assert not limiter.admit('slow', 'line2')
+        assert limiter.admit('fast', 'line3')
+        assert limiter.admit('fast', 'line4')
+        assert not limiter.admit('fast', 'line5')
+
+        self.mock_time.return_value = 100.5
+        # the slow stream has no token yet, the fast one is drained anyway
+        assert limiter.drain_spool() == [('fast', 'line5')]
+        self.mock_time.return_value = 101.0
+        assert limiter.drain_spool() == [('slow', 'line2')]
+
+    def test_spool_drain_interval(self):
+        limiter = StreamRateLimiter(lines_per_second=1, overflow_policy=rate_limit.OVERFLOW_SPOOL)
+        limiter.admit('stream', 'line1')
+        limiter.admit('stream', 'line2')
+        assert limiter.drain_spool() == []
+        self.mock_time.return_value = 100.0 + rate_limit.SPOOL_DRAIN_INTERVAL / 2
+        limiter.global_buckets[0].tokens = 1
+        assert limiter.drain_spool() == []
+        assert limiter.drain_spool(force=True) == [('stream', 'line2')]
+
+    def test_spool_sheds_lines_which_never_fit(self):
+        limiter = StreamRateLimiter(
+            bytes_per_second=100,
+            critical_streams=StreamPatternMap([('audit', True)]),
+            reserved_share=0.5,
+            overflow_policy=rate_limit.OVERFLOW_SPOOL,
+        )
+        assert not limiter.admit('stream', 'x' * 60)
+        assert not limiter.admit('audit', 'x' * 101)
+        assert limiter.shed_lines == {'stream': 1, 'audit': 1}
+        assert not limiter.spool
+        assert limiter.admit('audit', 'x' * 60)
+
+    def test_clear_spool(self):
+        limiter = StreamRateLimiter(lines_per_second=1, overflow_policy=rate_limit.OVERFLOW_SPOOL)
+        limiter.admit('stream', 'line1')
+        limiter.admit('stream', 'line2')
+        assert limiter.clear_spool() == [('stream', 'line2')]
+        assert not limiter.spool
+
+    @mock.patch.object(rate_limit, 'MAX_TRACKED_STREAMS', 2)
+    def test_tracked_streams_are_bounded(self):
+        limiter = StreamRateLimiter(lines_per_second=1)
+        for stream in ['a', 'b', 'c', 'd']:
+            limiter.admit(stream, 'line')
+        assert len(limiter._stream_buckets) <= 2
+        assert limiter.shed_lines == {'b': 1, 'c': 1, rate_limit.OTHER_STREAMS: 1}
+
+    def test_spool_by_priority(self):
+        limiter = StreamRateLimiter(
+            lines_per_second=1,
+            overflow_policy=rate_limit.OVERFLOW_SPOOL,
+            max_spooled_lines=2,
+            stream_priorities=StreamPatternMap([('audit', 'critical'), ('debug', 'low')]),
+        )
+        assert limiter.admit('other', 'line0')
+        assert not limiter.admit('debug', 'line1')
+        assert not limiter.admit('other', 'line2')
+        # the low priority line is evicted, then the new one is shed
+        assert not limiter.admit('audit', 'line3')
+        assert not limiter.admit('debug', 'line4')
+        assert limiter.shed_lines == {'debug': 2}
+
+        self.mock_time.return_value = 101.0
+        assert limiter.drain_spool() == [('audit', 'line3')]
+
+    def test_shed_lines_metric(self):
+        limiter = StreamRateLimiter(lines_per_second=1)
+        with mock.patch.object(limiter.metrics, 'lines_shed') as mock_lines_shed:
+            self.admitted(limiter, 'stream', 3)
+        assert mock_lines_shed.call_count == 2
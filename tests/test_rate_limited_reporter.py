@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import pytest
+import staticconf.testing
+
+from clog import config
+from clog import loggers
+from clog.loggers import get_default_reporter
+from clog.loggers import RateLimitedReporter
+
+
+class TestRateLimitedReporter(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def setup_reporter(self):
+        self.wrapped = mock.Mock()
+        with mock.patch('time.time', return_value=1000.0) as self.mock_time, \
+                mock.patch.object(loggers.threading, 'Timer') as self.timer:
+            self.reporter = RateLimitedReporter(self.wrapped, window=10, max_per_second=3)
+            yield
+
+    def test_deduplicates_within_window(self):
+        for _ in range(5):
+            self.reporter(True, 'failed')
+        self.reporter(False, 'info')
+        assert self.wrapped.call_args_list == [mock.call(True, 'failed'), mock.call(False, 'info')]
+
+    def test_summary_at_end_of_window(self):
+        for _ in range(5):
+            self.reporter(True, 'failed')
+        self.reporter(False, 'info')
+
+        self.mock_time.return_value = 1010.0
+        self.reporter(True, 'failed')
+        assert self.wrapped.call_args_list[2:] == [
+            mock.call(True, "5 failures of type 'failed' in last 10s"),
+            mock.call(True, 'failed'),
+        ]
+
+    def test_summary_without_later_report(self):
+        for _ in range(3):
+            self.reporter(True, 'failed')
+        # a single timer, at the end of the window
+        self.timer.assert_called_once_with(10.0, self.reporter._end_window_on_timer)
+        self.mock_time.return_value = 1010.0
+        self.reporter._end_window_on_timer()
+        assert self.wrapped.call_args_list == [
+            mock.call(True, 'failed'),
+            mock.call(True, "3 failures of type 'failed' in last 10s"),
+        ]
+
+    def test_timer_after_window_ended_by_report(self):
+        self.reporter(True, 'failed')
+        self.reporter(True, 'failed')
+        self.mock_time.return_value = 1012.0
+        self.reporter(True, 'failed')
+        self.reporter(True, 'failed')
+        self.timer.return_value.is_alive.return_value = False
+        self.mock_time.return_value = 1015.0
+        self.reporter._end_window_on_timer()
+        # the new window has its own summary pending
+        self.timer.assert_called_with(7.0, self.reporter._end_window_on_timer)
+        assert self.wrapped.call_count == 3
+
+    def test_flush(self):
+        for _ in range(2):
+            self.reporter(True, 'failed')
+        self.mock_time.return_value = 1003.0
+        self.reporter.flush()
+        assert self.wrapped.call_args_list == [
+            mock.call(True, 'failed'),
+            mock.call(True, "2 failures of type 'failed' in last 3s"),
+        ]
+        self.reporter.flush()
+        assert self.wrapped.call_count == 2
+
+    def test_per_second_cap(self):
+        for i in range(5):
+            self.reporter(True, 'failed %d' % i)
+        assert self.wrapped.call_count == 3
+
+        self.mock_time.return_value = 1001.0
+        self.reporter(True, 'failed 5')
+        assert self.wrapped.call_count == 4
+
+        self.mock_time.return_value = 1011.0
+        self.reporter(True, 'failed 6')
+        assert self.wrapped.call_args_list[4:] == [
+            mock.call(True, '2 reports dropped by the rate limit in last 11s'),
+            mock.call(True, 'failed 6'),
+        ]
+
+    def test_max_messages(self):
+        self.reporter.max_messages = 2
+        for i in range(4):
+            self.reporter(True, 'failed %d' % i)
+        assert self.reporter._counts == {
+            (True, 'failed 0'): 1,
+            (True, 'failed 1'): 1,
+            (True, RateLimitedReporter.OTHER_MESSAGES): 2,
+        }
+
+
+class TestGetDefaultReporter(object):
+
+    def test_not_rate_limited(self):
+        with staticconf.testing.MockConfiguration(namespace=config.namespace):
+            assert get_default_reporter(use_syslog=False) is loggers.report_to_stderr
+
+    def test_rate_limited(self):
+        with staticconf.testing.MockConfiguration(
+            report_status_rate_limit=5,
+            namespace=config.namespace,
+        ):
+            reporter = get_default_reporter(use_syslog=False)
+            assert isinstance(reporter, RateLimitedReporter)
+            assert reporter.reporter is loggers.report_to_stderr
+            assert reporter.max_per_second == 5
+            assert reporter.window == 10
+            assert get_default_reporter(use_syslog=False) is reporter
@@ -14,6 +14,9 @@
 # limitations under the License.
 from __future__ import print_function
 import datetime
+import gzip
+import io
+import multiprocessing
 import os.path
 import shutil
 import tempfile
@@ -146,6 +149,152 @@ class TestCLogStreamReaderAcceptance(object):
         assert self.num_expected_lines == num_lines
 
 
+class TestCLogStreamReader(object):
+
+    @pytest.fixture
+    def stream_dir(self, tmpdir):
+        stream_dir = tmpdir.mkdir('stream_name')
+        for chunk in range(6):
+            path = str(stream_dir.join('stream_name-2009-01-01_%05d' % chunk))
+            opener = open
+            if chunk % 2 == 0:
+                opener = gzip.open
+                path += '.gz'
+            with opener(path, 'wb') as chunk_file:
+                for line in range(chunk + 1):
+                    chunk_file.write(('chunk %d line %d\n' % (chunk, line)).encode('ascii'))
+        # another day
+        stream_dir.join('stream_name-2009-01-02_00000').write('other day\n')
+        return str(tmpdir)
+
+    def expected_lines(self):
+        return [
+            'chunk %d line %d\n' % (chunk, line)
+            for chunk in range(6)
+            for line in range(chunk + 1)
+        ]
+
+    def read(self, stream_dir, **kwargs):
+        reader = readers.CLogStreamReader('stream_name', stream_dir, datetime.date(2009, 1, 1), **kwargs)
+        return [
+            line.decode('ascii') if isinstance(line, bytes) else line
+            for line in reader
+        ]
+
+    def test_chunk_filenames(self, stream_dir):
+        reader = readers.CLogStreamReader('stream_name', stream_dir, datetime.date(2009, 1, 1))
+        assert [os.path.basename(name) for name in reader.chunk_filenames()] == [
+            'stream_name-2009-01-01_00000.gz',
+            'stream_name-2009-01-01_00001',
+            'stream_name-2009-01-01_00002.gz',
+            'stream_name-2009-01-01_00003',
+            'stream_name-2009-01-01_00004.gz',
+            'stream_name-2009-01-01_00005',
+        ]
+
+    def test_iter(self, stream_dir):
+        assert self.read(stream_dir) == self.expected_lines()
+
+    @pytest.mark.parametrize('block_size', [1, 7, readers.DEFAULT_BLOCK_SIZE])
+    def test_iter_blocks(self, stream_dir, block_size):
+        assert self.read(stream_dir, block_size=block_size) == self.expected_lines()
+
+    @pytest.mark.parametrize('read_ahead', [None, 1, 10])
+    def test_iter_parallel(self, stream_dir, read_ahead):
+        assert self.read(stream_dir, processes=2, read_ahead=read_ahead, block_size=7) == self.expected_lines()
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_line_nums(self, stream_dir, processes):
+        reader = readers.CLogStreamReader(
+            'stream_name', stream_dir, datetime.date(2009, 1, 1), processes=processes, block_size=7)
+        stream_iter = reader._stream_iterator()
+        assert isinstance(stream_iter, readers.ParallelCLogStreamIterator) == (processes > 1)
+        line_nums = [(stream_iter.line_num, stream_iter.chunk_line_num) for _ in stream_iter]
+        assert line_nums[:4] == [(1, 0), (2, 0), (3, 1), (4, 0)]
+        assert line_nums[-1] == (21, 5)
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_iter_batches(self, stream_dir, processes):
+        reader = readers.CLogStreamReader(
+            'stream_name', stream_dir, datetime.date(2009, 1, 1), processes=processes, block_size=40)
+        stream_iter = reader._stream_iterator()
+        lines = []
+        for batch in stream_iter.iter_batches():
+            lines.extend(batch)
+            last_line = batch[-1]
+            last_line = last_line.decode('ascii') if isinstance(last_line, bytes) else last_line
+            assert last_line == 'chunk %d line %d\n' % (
+                int(last_line.split()[1]), stream_iter.chunk_line_num)
+            assert stream_iter.line_num == len(lines)
+        assert len(lines) == 21
+
+    def test_parallel_iteration_closed_early(self, stream_dir):
+        reader = readers.CLogStreamReader(
+            'stream_name', stream_dir, datetime.date(2009, 1, 1), processes=2, block_size=7)
+        lines = iter(reader)
+        next(lines)
+        assert multiprocessing.active_children()
+        lines.close()
+        assert not multiprocessing.active_children()
+
+        with reader._stream_iterator() as stream_iter:
+            batches = stream_iter.iter_batches()
+            next(batches)
+            assert multiprocessing.active_children()
+        assert not multiprocessing.active_children()
+
+    def test_closed_early(self, stream_dir):
+        reader = readers.CLogStreamReader('stream_name', stream_dir, datetime.date(2009, 1, 1))
+        with reader._stream_iterator() as stream_iter:
+            lines = iter(stream_iter)
+            next(lines)
+            chunk = stream_iter.current_chunk
+        assert chunk.closed
+        assert stream_iter.current_chunk is None
+
+    def test_chunk_compressed_after_listing(self, stream_dir):
+        reader = readers.CLogStreamReader('stream_name', stream_dir, datetime.date(2009, 1, 1))
+        filenames = reader.chunk_filenames()
+        plain_name = filenames[3]
+        with open(plain_name, 'rb') as plain_file:
+            data = plain_file.read()
+        with gzip.open(plain_name + '.gz', 'wb') as gzip_file:
+            gzip_file.write(data)
+        os.remove(plain_name)
+
+        with mock.patch.object(reader, 'chunk_filenames', return_value=filenames):
+            lines = list(readers.ParallelCLogStreamIterator(reader, processes=2, read_ahead=2))
+        assert len(lines) == 21
+        assert lines[6:10] == [b'chunk 3 line %d\n' % line for line in range(4)]
+
+
+class TestReadLineBatches(object):
+
+    def read(self, data, block_size):
+        return list(readers.read_line_batches(io.BytesIO(data), block_size))
+
+    def test_lines_across_blocks(self):
+        assert self.read(b'ab\ncd\nef\n', 4) == [[b'ab\n'], [b'cd\n'], [b'ef\n']]
+        assert self.read(b'ab\ncd\nef\n', 6) == [[b'ab\n', b'cd\n'], [b'ef\n']]
+
+    def test_line_longer_than_blocks(self):
+        assert self.read(b'a' * 10 + b'\nb\n', 3) == [[b'a' * 10 + b'\n'], [b'b\n']]
+
+    def test_no_final_newline(self):
+        assert self.read(b'ab\ncd', 4) == [[b'ab\n'], [b'cd']]
+        assert self.read(b'abcd', 3) == [[b'abcd']]
+
+    def test_empty(self):
+        assert self.read(b'', 4) == []
+
+    def test_only_newlines_split(self):
+        assert self.read(b'a\rb\r\nc\n', 100) == [[b'a\rb\r\n', b'c\n']]
+
+    def test_text(self):
+        text = io.StringIO(u'ab\ncd\ne')
+        assert list(readers.read_line_batches(text, 4)) == [[u'ab\n'], [u'cd\n'], [u'e']]
+
+
 class TestFindTailHost(object):
 
     TEST_HOST = 'fake-host'
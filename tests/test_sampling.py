@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+
+from clog import sampling
+from clog.sampling import ALREADY_SAMPLED
+from clog.sampling import key_hash
+from clog.sampling import StreamSampler
+from clog.utils import StreamPatternMap
+
+
+class TestStreamSampler(object):
+
+    def setup_method(self, method):
+        self.sampler = StreamSampler(StreamPatternMap([
+            ('debug_*', 0.1),
+            ('off', 0),
+        ]))
+
+    def test_rate_for(self):
+        assert self.sampler.rate_for('debug_foo') == 0.1
+        assert self.sampler.rate_for('off') == 0
+        assert self.sampler.rate_for('other') == 1.0
+
+    def test_unsampled_streams_are_kept(self):
+        assert all(self.sampler.keep('other') for _ in range(100))
+        assert not any(self.sampler.keep('off') for _ in range(100))
+
+    def test_keyed_sampling_is_deterministic(self):
+        keys = ['request-%d' % i for i in range(2000)]
+        kept = [key for key in keys if self.sampler.keep('debug_foo', key)]
+        assert 100 < len(kept) < 300
+        # the same keys are kept in every sampled stream with the same rate
+        assert [key for key in keys if self.sampler.keep('debug_bar', key)] == kept
+
+    def test_random_sampling(self):
+        with mock.patch.object(sampling.random, 'random', side_effect=[0.05, 0.5]):
+            assert self.sampler.keep('debug_foo')
+            assert not self.sampler.keep('debug_foo')
+
+    def test_already_sampled(self):
+        assert self.sampler.keep('off', ALREADY_SAMPLED)
+
+    def test_key_hash(self):
+        assert key_hash(u'☃') == key_hash(u'☃'.encode('UTF-8'))
+        assert key_hash(42) == key_hash('42')
+        assert 0 <= key_hash('key') < 2 ** 32
+
+    def test_effective_rate_is_reported(self):
+        with mock.patch.object(sampling, 'REPORT_INTERVAL', 4), \
+                mock.patch.object(self.sampler.metrics, 'lines_sampled') as mock_lines_sampled, \
+                mock.patch.object(sampling.random, 'random', side_effect=[0.0, 0.5, 0.0, 0.5, 0.5, 0.0]):
+            self.sampler.keep('debug_bar')
+            for _ in range(5):
+                self.sampler.keep('debug_foo')
+        # each stream has its own rate
+        mock_lines_sampled.assert_called_once_with('debug_foo', 1, 3)
+        assert self.sampler._counts == {'debug_bar': [1, 0], 'debug_foo': [1, 0]}
+
+    def test_counted_streams_are_bounded(self):
+        with mock.patch.object(sampling, 'MAX_COUNTED_STREAMS', 1), \
+                mock.patch.object(sampling.random, 'random', return_value=0.5):
+            self.sampler.keep('debug_foo')
+            self.sampler.keep('debug_bar')
+            self.sampler.keep('debug_baz')
+        assert self.sampler._counts == {'debug_foo': [0, 1], sampling.OTHER_STREAMS: [0, 2]}
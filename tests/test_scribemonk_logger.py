@@ -80,3 +80,14 @@ class TestScribeMonkLogger(object):
             mock.call('stream3', 'line3'),
             mock.call('stream4', 'line4')
         ])
+
+    @mock.patch('clog.loggers.MonkLogger', autospec=True)
+    @mock.patch('clog.loggers.ScribeLogger', autospec=True)
+    def test_log_lines_dual(self, scribe_logger, monk_logger):
+        config.configure_from_dict({'preferred_backend': 'dual'})
+        logger = ScribeMonkLogger(config, scribe_logger, monk_logger)
+
+        logger.log_lines('stream', iter(['line1', 'line2']))
+
+        monk_logger.log_lines.assert_called_once_with('stream', ['line1', 'line2'])
+        scribe_logger.log_lines.assert_called_once_with('stream', ['line1', 'line2'])
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mmap
+import os
+import sys
+import threading
+import time
+
+import mock
+import pytest
+
+from clog import shm_ring
+from clog.shm_ring import RING_HEADER_SZ
+from clog.shm_ring import ShmRing
+from clog.shm_ring import ShmTransport
+
+
+class TestShmRing(object):
+
+    def setup_method(self, method):
+        self.buf = mmap.mmap(-1, RING_HEADER_SZ + 32)
+        self.ring = ShmRing(self.buf, 0, 32)
+
+    def test_put_and_get_all(self):
+        assert self.ring.put(b'first') is True
+        assert self.ring.put(b'second') is False
+        assert len(self.ring) == 4 + 5 + 4 + 6
+        assert self.ring.get_all() == [b'first', b'second']
+        assert len(self.ring) == 0
+        assert self.ring.get_all() == []
+
+    def test_full(self):
+        assert self.ring.put(b'x' * 20) is True
+        assert self.ring.put(b'y' * 10) is None
+        assert self.ring.put(b'z' * 4) is False
+        assert self.ring.get_all() == [b'x' * 20, b'z' * 4]
+
+    def test_wrap_around(self):
+        for i in range(20):
+            message = ('message %d' % i).encode('ascii')
+            assert self.ring.put(message) is True
+            assert self.ring.get_all() == [message]
+
+
+class TestShmTransport(object):
+
+    @pytest.yield_fixture(autouse=True)
+    def setup_transport(self):
+        self.transport = ShmTransport(num_slots=2, slot_capacity=100)
+        yield
+        self.transport.close()
+
+    def test_send_and_drain(self):
+        assert self.transport.send(0, b'line1')
+        assert self.transport.send(1, b'line2')
+        assert self.transport.send(0, b'line3')
+        assert not self.transport.send(1, b'x' * 100)
+        self.transport.wait(0)
+        assert self.transport.drain() == [b'line1', b'line3', b'line2']
+
+    def test_across_fork(self):
+        pid = os.fork()
+        if not pid:
+            for i in range(200):
+                while not self.transport.send(1, ('line%d' % i).encode('ascii')):
+                    pass
+            os._exit(0)
+
+        messages = []
+        while len(messages) < 200:
+            self.transport.wait(0.1)
+            messages.extend(self.transport.drain())
+        os.waitpid(pid, 0)
+        assert messages == [('line%d' % i).encode('ascii') for i in range(200)]
+
+    def test_threads_share_a_slot(self):
+        num_threads = 4
+        count = 500
+
+        def produce(thread):
+            for i in range(count):
+                while not self.transport.send(0, ('%d %d' % (thread, i)).encode('ascii')):
+                    pass
+
+        threads = [threading.Thread(target=produce, args=(thread,)) for thread in range(num_threads)]
+        for thread in threads:
+            thread.daemon = True
+        # switch threads often, to interleave the sends
+        switch_interval = getattr(sys, 'getswitchinterval', lambda: None)()
+        if switch_interval is not None:
+            sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            messages = []
+            deadline = time.time() + 10
+            while len(messages) < num_threads * count and time.time() < deadline:
+                self.transport.wait(0.01)
+                messages.extend(self.transport.drain())
+            for thread in threads:
+                thread.join(1)
+        finally:
+            if switch_interval is not None:
+                sys.setswitchinterval(switch_interval)
+
+        received = dict((thread, []) for thread in range(num_threads))
+        for message in messages:
+            thread, i = message.decode('ascii').split()
+            received[int(thread)].append(int(i))
+        assert received == dict((thread, list(range(count))) for thread in range(num_threads))
+
+    def test_unordered_stores(self):
+        with mock.patch.object(shm_ring.platform, 'machine', return_value='aarch64'):
+            assert not shm_ring.stores_are_ordered()
+            with pytest.raises(RuntimeError):
+                ShmTransport(num_slots=1, slot_capacity=100)
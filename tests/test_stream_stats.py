@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+import threading
+
+import mock
+import pytest
+
+from clog import stream_stats
+from clog.stream_stats import StreamStats
+from clog.stream_stats import ThreadStreamStats
+
+
+class TestStreamStats(object):
+
+    def test_counts(self):
+        stats = StreamStats(capacity=10)
+        stats.add('a', 1, 10)
+        stats.add('b', 2, 30)
+        stats.add('a', 1, 5)
+        assert stats.snapshot() == {
+            'lines': 4,
+            'bytes': 45,
+            'streams': [
+                {'stream': 'b', 'lines': 2, 'bytes': 30, 'error_lines': 0, 'error_bytes': 0},
+                {'stream': 'a', 'lines': 2, 'bytes': 15, 'error_lines': 0, 'error_bytes': 0},
+            ],
+        }
+        assert [entry['stream'] for entry in stats.top(1)] == ['b']
+
+    def test_heavy_hitters_with_many_streams(self):
+        stats = StreamStats(capacity=5)
+        for i in range(1000):
+            stats.add('flood', 1, 100)
+            stats.add('stream%d' % i, 1, 10)
+        assert len(stats.entries) == 5
+        flood = stats.top(1)[0]
+        assert flood['stream'] == 'flood'
+        assert flood['bytes'] - flood['error_bytes'] <= 100000 <= flood['bytes']
+        assert stats.lines == 2000
+
+    def test_lightest_stream_is_replaced(self):
+        stats = StreamStats(capacity=2)
+        stats.add('a', 1, 10)
+        stats.add('b', 1, 20)
+        stats.add('c', 1, 5)
+        assert stats.top() == [
+            {'stream': 'b', 'lines': 1, 'bytes': 20, 'error_lines': 0, 'error_bytes': 0},
+            {'stream': 'c', 'lines': 2, 'bytes': 15, 'error_lines': 1, 'error_bytes': 10},
+        ]
+
+    def test_replaces_the_lightest_stream_like_a_scan(self):
+        stats = StreamStats(capacity=20)
+        expected = {}
+        rng = random.Random(0)
+        for _ in range(5000):
+            # bytes and text streams cannot be compared on python 3
+            stream = rng.choice([u'stream%d', b'stream%d']) % rng.randint(0, 60)
+            # without ties, the lightest stream is unique
+            size = rng.randint(1, 10 ** 9)
+            if stream not in expected and len(expected) == 20:
+                lightest_stream = min(expected, key=lambda tracked: expected[tracked][1])
+                lines, total = expected.pop(lightest_stream)
+                expected[stream] = [lines, total]
+            entry = expected.setdefault(stream, [0, 0])
+            entry[0] += 1
+            entry[1] += size
+            stats.add(stream, 1, size)
+            assert dict(
+                (stream, entry[:2]) for stream, entry in stats.entries.items()
+            ) == expected
+        assert len(stats._heap) == 20
+
+    def test_invalid_capacity(self):
+        with pytest.raises(ValueError):
+            StreamStats(capacity=0)
+
+    def test_periodic_report(self):
+        with mock.patch.object(stream_stats.time, 'time', return_value=100):
+            stats = StreamStats(capacity=10, report_interval=60)
+        with mock.patch.object(stream_stats, 'MetricsReporter') as reporter:
+            with mock.patch.object(stream_stats.time, 'time', return_value=150):
+                stats.add('a', 1, 10)
+            assert not reporter.called
+            with mock.patch.object(stream_stats.time, 'time', return_value=160):
+                stats.add('a', 2, 20)
+            reporter.return_value.stream_throughput.assert_called_once_with('a', 3, 30)
+        # the counts start over after a report
+        assert stats.snapshot() == {'lines': 0, 'bytes': 0, 'streams': []}
+
+
+class TestThreadStreamStats(object):
+
+    def test_counts_are_folded_when_read(self):
+        stats = ThreadStreamStats(capacity=10)
+        stats.add('a', 1, 10)
+        stats.add('b', 2, 30)
+        stats.add('a', 1, 5)
+        # counted by the thread only
+        assert stats.entries == {}
+        assert stats.snapshot() == {
+            'lines': 4,
+            'bytes': 45,
+            'streams': [
+                {'stream': 'b', 'lines': 2, 'bytes': 30, 'error_lines': 0, 'error_bytes': 0},
+                {'stream': 'a', 'lines': 2, 'bytes': 15, 'error_lines': 0, 'error_bytes': 0},
+            ],
+        }
+        # the folded counts are not counted again
+        stats.add('a', 1, 5)
+        assert stats.top(1) == [
+            {'stream': 'b', 'lines': 2, 'bytes': 30, 'error_lines': 0, 'error_bytes': 0},
+        ]
+        assert stats.snapshot()['lines'] == 5
+
+    def test_counts_of_other_threads(self):
+        stats = ThreadStreamStats(capacity=10)
+        counted = threading.Event()
+        done = threading.Event()
+
+        def count():
+            stats.add('a', 1, 10)
+            counted.set()
+            done.wait(5)
+            stats.add('a', 1, 10)
+
+        thread = threading.Thread(target=count)
+        thread.start()
+        counted.wait(5)
+        assert stats.snapshot()['lines'] == 1
+        done.set()
+        thread.join()
+        # folded when the thread exits
+        assert stats.lines == 2
+        assert stats.snapshot()['streams'][0]['bytes'] == 20
+        assert not stats._all_thread_counts
+
+    def test_thread_counts_are_bounded(self):
+        stats = ThreadStreamStats(capacity=5)
+        for i in range(1000):
+            stats.add('flood', 1, 100)
+            stats.add('stream%d' % i, 1, 10)
+            assert len(stats._thread_counts.counts.streams) <= 5
+        flood = stats.top(1)[0]
+        assert flood['stream'] == 'flood'
+        assert flood['bytes'] - flood['error_bytes'] <= 100000 <= flood['bytes']
+        assert stats.lines == 2000
+
+    def test_reset_and_report(self):
+        stats = ThreadStreamStats(capacity=10, report_interval=60)
+        stats.add('a', 1, 10)
+        stats.reset()
+        assert stats.snapshot() == {'lines': 0, 'bytes': 0, 'streams': []}
+        stats.add('a', 2, 20)
+        with mock.patch.object(stream_stats, 'MetricsReporter') as reporter:
+            stats.report()
+        reporter.return_value.stream_throughput.assert_called_once_with('a', 2, 20)
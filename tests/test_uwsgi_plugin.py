@@ -1,3 +1,4 @@
+import logging
 import mock
 import os
 import pickle
@@ -74,11 +75,97 @@ class TestUwsgiPlugin(object):
             with mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
                 with mock.patch.object(uwsgi_plugin, 'mule_msg_dispatcher') as dispatcher:
                     uwsgi_plugin._plugin_mule_msg_shim(mule_msg_data)
-                    orig_line.assert_called_with(*map(six.b, message))
+                    orig_line.assert_called_with(
+                        *map(six.b, message), sample_key=uwsgi_plugin.clog.sampling.ALREADY_SAMPLED)
                     assert not dispatcher.called
 
         run(target)
 
+    def test_uwsgi_handle_msg_with_mule_batcher(self):
+        def target(uwsgi_plugin):
+            batcher = mock.Mock()
+            mule_msg_data = uwsgi_plugin._encode_mule_msg('stream', 'line')
+            with mock.patch.object(uwsgi_plugin, '_mule_batcher', batcher):
+                with mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
+                    uwsgi_plugin._plugin_mule_msg_shim(mule_msg_data)
+                    batcher.add.assert_called_once_with(b'stream', b'line', None)
+                    assert not orig_line.called
+
+        run(target)
+
+    def test_mule_batcher_size_triggers(self):
+        def target(uwsgi_plugin):
+            log_lines = mock.Mock()
+            batcher = uwsgi_plugin.MuleBatcher(log_lines, max_lines=2, max_bytes=10, max_delay=60)
+            with mock.patch.object(batcher, '_start_flusher'):
+                batcher.add('a', 'line1')
+                batcher.add('b', 'line2')
+                batcher.add('a', 'line3')
+                batcher.add('b', 'x' * 10)
+                assert batcher.pending == {}
+                batcher.add('c', 'line4')
+            already_sampled = uwsgi_plugin.clog.sampling.ALREADY_SAMPLED
+            assert log_lines.call_args_list == [
+                mock.call('a', ['line1', 'line3'], sample_key=already_sampled),
+                mock.call('b', ['line2', 'x' * 10], sample_key=already_sampled),
+            ]
+            batcher.flush()
+            log_lines.assert_called_with('c', ['line4'], sample_key=already_sampled)
+
+        run(target)
+
+    def test_mule_batcher_delay_trigger(self):
+        def target(uwsgi_plugin):
+            log_lines = mock.Mock()
+            batcher = uwsgi_plugin.MuleBatcher(log_lines, max_lines=10, max_bytes=100, max_delay=1)
+            with mock.patch.object(batcher, '_start_flusher'), \
+                    mock.patch.object(uwsgi_plugin.time, 'time', side_effect=[100, 100.5, 101]):
+                batcher.add('a', 'line1')
+                batcher.add('b', 'line2')
+                assert not log_lines.called
+                batcher.add('a', 'line3')
+            assert sorted(c[0] for c in log_lines.call_args_list) == [
+                ('a', ['line1', 'line3']),
+                ('b', ['line2']),
+            ]
+
+        run(target)
+
+    def test_mule_batcher_starts_one_flusher(self):
+        def target(uwsgi_plugin):
+            batcher = uwsgi_plugin.MuleBatcher(mock.Mock(), max_lines=10, max_bytes=100, max_delay=60)
+
+            def start_flusher():
+                # the check and the start are atomic
+                assert batcher._lock.locked()
+                batcher._flusher = mock.Mock()
+
+            with mock.patch.object(batcher, '_start_flusher', side_effect=start_flusher) as start:
+                batcher.add('a', 'line1')
+                batcher.add('a', 'line2')
+            assert start.call_count == 1
+
+        run(target)
+
+    def test_mule_batcher_records_latency(self):
+        def target(uwsgi_plugin):
+            log_lines = mock.Mock()
+            record_latency = mock.Mock()
+            batcher = uwsgi_plugin.MuleBatcher(
+                log_lines, max_lines=3, max_bytes=100, max_delay=60, record_latency=record_latency)
+            with mock.patch.object(batcher, '_start_flusher'), \
+                    mock.patch.object(uwsgi_plugin.time, 'time', return_value=101.0):
+                batcher.add('a', 'line1', 100.0)
+                batcher.add('a', 'line2', 100.0)
+                batcher.add('b', 'line3', 100.5)
+                assert not record_latency.called
+                batcher.add('a', 'line4', 100.75)
+                assert record_latency.call_args_list == [mock.call(1.0), mock.call(0.25)]
+                batcher.flush()
+                record_latency.assert_called_with(0.5)
+
+        run(target)
+
     def test_uwsgi_handle_invalid_msg_pass_thru(self):
         def target(uwsgi_plugin):
             message = ('this is a fake stream', 'this is a fake line!')
@@ -91,10 +178,65 @@ class TestUwsgiPlugin(object):
 
         run(target)
 
-    def test_uwsgi_default_over_max_size(self):
+    def test_uwsgi_over_max_size_is_fragmented(self):
+        def target(uwsgi_plugin):
+            big_string = 's' * 150000
+            with mock.patch('uwsgi.mule_msg') as mm:
+                assert uwsgi_plugin._mule_msg('blah', big_string) == True
+            fragments = [c[0][0] for c in mm.call_args_list]
+            assert len(fragments) == 3
+            assert all(len(fragment) <= 65536 for fragment in fragments)
+            # the fragments of the shared queue all go to the same mule
+            assert set(c[0][1] for c in mm.call_args_list) == set([1])
+
+            with mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
+                for fragment in reversed(fragments):
+                    uwsgi_plugin._plugin_mule_msg_shim(fragment)
+                orig_line.assert_called_once_with(
+                    b'blah', six.b(big_string), sample_key=uwsgi_plugin.clog.sampling.ALREADY_SAMPLED)
+            assert not uwsgi_plugin._reassembler.pending
+
+        run(target)
+
+    def test_fragments_spread_by_the_sharder(self):
+        def target(uwsgi_plugin):
+            sharder = uwsgi_plugin.MuleSharder([1, 2, 3])
+            big_string = 's' * 150000
+            streams = ['stream%d' % i for i in range(10)]
+            with mock.patch.object(uwsgi_plugin, '_sharder', sharder), mock.patch('uwsgi.mule_msg') as mm:
+                for stream in streams:
+                    uwsgi_plugin._mule_msg(stream, big_string)
+            mules = [c[0][1] for c in mm.call_args_list]
+            # the fragments of a line stay on the mule of its stream
+            assert mules == [sharder._hash_mule(stream) for stream in streams for _ in range(3)]
+            assert len(set(mules)) > 1
+
+        run(target)
+
+    def test_uwsgi_over_max_size_ipc_failure(self):
+        def target(uwsgi_plugin):
+            with mock.patch('uwsgi.mule_msg', side_effect=[None, False]):
+                assert uwsgi_plugin._mule_msg('blah', 's' * 150000) == False
+
+        run(target)
+
+    def test_fragment_reassembler_limits(self):
         def target(uwsgi_plugin):
-            big_string = 's' * 65536
-            assert uwsgi_plugin._mule_msg('blah', big_string) == False
+            reassembler = uwsgi_plugin.FragmentReassembler(max_msgs=2, max_bytes=10 ** 6, timeout=10)
+            messages = [uwsgi_plugin._encode_fragments(b'x' * 100, 80) for _ in range(4)]
+            with mock.patch.object(uwsgi_plugin.time, 'time', return_value=100):
+                for fragments in messages[:3]:
+                    assert reassembler.add(fragments[0]) is None
+                assert len(reassembler.pending) == 2
+                assert reassembler.dropped_msgs == 1
+                assert reassembler.add(messages[0][1]) is None
+                assert reassembler.add(messages[2][1]) == b'x' * 100
+            with mock.patch.object(uwsgi_plugin.time, 'time', return_value=111):
+                assert reassembler.add(messages[3][0]) is None
+                assert reassembler.dropped_msgs == 3
+                assert reassembler.pending_bytes == 80 - uwsgi_plugin.FRAGMENT_HEADER_SZ
+                with pytest.raises(ValueError):
+                    reassembler.add(messages[3][0])
 
         run(target)
 
@@ -103,7 +245,53 @@ class TestUwsgiPlugin(object):
             with mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
                 with mock.patch.object(uwsgi_plugin, '_mule_msg', return_value=False):
                     uwsgi_plugin.uwsgi_log_line('blah', 'test_message')
-                    orig_line.assert_called_with('blah', 'test_message')
+                    orig_line.assert_called_with(
+                        'blah', 'test_message', sample_key=uwsgi_plugin.clog.sampling.ALREADY_SAMPLED)
+
+        run(target)
+
+    def test_uwsgi_log_line_samples_in_worker(self):
+        def target(uwsgi_plugin):
+            sampler = uwsgi_plugin.clog.sampling.StreamSampler(
+                uwsgi_plugin.clog.utils.StreamPatternMap([('debug_*', 0.0)]))
+            with mock.patch.object(uwsgi_plugin, '_sampler', sampler):
+                with mock.patch.object(uwsgi_plugin, '_mule_msg') as mule_msg:
+                    uwsgi_plugin.uwsgi_log_line('debug_foo', 'line', sample_key='request')
+                    uwsgi_plugin.uwsgi_log_line('other', 'line')
+                    mule_msg.assert_called_once_with('other', 'line', mule=None)
+
+        run(target)
+
+    def test_uwsgi_log_lines_samples_together(self):
+        def target(uwsgi_plugin):
+            sampler = uwsgi_plugin.clog.sampling.StreamSampler(
+                uwsgi_plugin.clog.utils.StreamPatternMap([('debug_*', 0.5)]))
+            with mock.patch.object(uwsgi_plugin, '_sampler', sampler):
+                with mock.patch.object(uwsgi_plugin, '_mule_msg') as mule_msg, \
+                        mock.patch.object(sampler, 'keep', wraps=sampler.keep) as keep:
+                    uwsgi_plugin.uwsgi_log_lines('debug_foo', ['line1', 'line2'], sample_key='request')
+                    # the lines are kept or dropped together
+                    assert mule_msg.call_count in (0, 2)
+                    assert keep.call_args_list[0] == mock.call('debug_foo', 'request')
+                    assert sum(sum(counts) for counts in sampler._counts.values()) == 1
+                    uwsgi_plugin.uwsgi_log_lines('other', iter(['line1', 'line2']))
+                    assert mule_msg.call_args_list[-2:] == [
+                        mock.call('other', 'line1', mule=None),
+                        mock.call('other', 'line2', mule=None),
+                    ]
+
+        run(target)
+
+    def test_uwsgi_patch_global_state(self):
+        def target(uwsgi_plugin):
+            clog = uwsgi_plugin.clog
+            with mock.patch.object(clog, 'log_line'), mock.patch.object(clog, 'log_lines'), \
+                    mock.patch.object(clog.global_state, 'log_line'), \
+                    mock.patch.object(clog.global_state, 'log_lines'):
+                uwsgi_plugin.uwsgi_patch_global_state()
+                for module in (clog, clog.global_state):
+                    assert module.log_line is uwsgi_plugin.uwsgi_log_line
+                    assert module.log_lines is uwsgi_plugin.uwsgi_log_lines
 
         run(target)
 
@@ -111,8 +299,9 @@ class TestUwsgiPlugin(object):
         def target(uwsgi_plugin):
             args = ('test_stream', 'test_line')
             kwargs = {}
-            expected_serialized = uwsgi_plugin._encode_mule_msg(*args)
-            with mock.patch('uwsgi.mule_msg') as mm:
+            expected_serialized = uwsgi_plugin._stamp_mule_msg(uwsgi_plugin._encode_mule_msg(*args), 100)
+            with mock.patch('uwsgi.mule_msg') as mm, \
+                    mock.patch.object(uwsgi_plugin.time, 'time', return_value=100):
                 uwsgi_plugin._mule_msg(*args, **kwargs)
                 mm.assert_called_with(expected_serialized)
 
@@ -122,8 +311,9 @@ class TestUwsgiPlugin(object):
         def target(uwsgi_plugin):
             args = ('test_stream', 'test_line')
             kwargs = {'mule': 1}
-            expected_serialized = uwsgi_plugin._encode_mule_msg(*args)
-            with mock.patch('uwsgi.mule_msg') as mm:
+            expected_serialized = uwsgi_plugin._stamp_mule_msg(uwsgi_plugin._encode_mule_msg(*args), 100)
+            with mock.patch('uwsgi.mule_msg') as mm, \
+                    mock.patch.object(uwsgi_plugin.time, 'time', return_value=100):
                 uwsgi_plugin._mule_msg(*args, **kwargs)
                 mm.assert_called_with(expected_serialized, 1)
 
@@ -148,3 +338,331 @@ class TestUwsgiPlugin(object):
                 uwsgi_plugin._decode_mule_msg(msg)
 
         run(target)
+
+    def test_multi_mule_msg_round_trip(self):
+        def target(uwsgi_plugin):
+            records = [(b'stream1', b'line1'), (b'stream2', u'☃'.encode('UTF-8'))]
+            msg = uwsgi_plugin._encode_multi_mule_msg(
+                [uwsgi_plugin._encode_record(*record) for record in records])
+            assert uwsgi_plugin._decode_mule_msgs(msg) == records
+            # single record messages are still understood
+            single = uwsgi_plugin._encode_mule_msg('stream', 'line')
+            assert uwsgi_plugin._decode_mule_msgs(single) == [(b'stream', b'line')]
+            with pytest.raises(ValueError):
+                uwsgi_plugin._decode_mule_msgs(msg[:-1])
+
+        run(target)
+
+    def test_multi_mule_msg_version_error(self):
+        def target(uwsgi_plugin):
+            msg = struct.pack(uwsgi_plugin.MULTI_ENCODE_FMT, uwsgi_plugin.MULTI_HEADER_TAG, 2, 0)
+            with pytest.raises(ValueError):
+                uwsgi_plugin._decode_mule_msgs(msg)
+
+        run(target)
+
+    def test_uwsgi_handle_multi_msg(self):
+        def target(uwsgi_plugin):
+            msg = uwsgi_plugin._encode_multi_mule_msg([
+                uwsgi_plugin._encode_record('stream1', 'line1'),
+                uwsgi_plugin._encode_record('stream2', 'line2'),
+            ])
+            with mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
+                uwsgi_plugin._plugin_mule_msg_shim(msg)
+                already_sampled = uwsgi_plugin.clog.sampling.ALREADY_SAMPLED
+                assert orig_line.call_args_list == [
+                    mock.call(b'stream1', b'line1', sample_key=already_sampled),
+                    mock.call(b'stream2', b'line2', sample_key=already_sampled),
+                ]
+
+        run(target)
+
+    def test_worker_coalescer(self):
+        def target(uwsgi_plugin):
+            record_size = len(uwsgi_plugin._encode_record('stream', 'line'))
+            max_size = uwsgi_plugin.TIMESTAMP_HEADER_SZ + uwsgi_plugin.MULTI_HEADER_SZ + 2 * record_size
+            coalescer = uwsgi_plugin.WorkerCoalescer(max_size, max_delay=60)
+            with mock.patch.object(coalescer, '_start_flusher'), \
+                    mock.patch('uwsgi.mule_msg') as mule_msg:
+                for _ in range(3):
+                    coalescer.add('stream', 'line')
+                coalescer.add('stream', 'line', mule=2)
+                assert mule_msg.call_count == 1
+                msg = mule_msg.call_args[0][0]
+                assert len(msg) == max_size
+                _, msg = uwsgi_plugin._unstamp_mule_msg(msg)
+                assert uwsgi_plugin._decode_mule_msgs(msg) == [(b'stream', b'line')] * 2
+
+                # the end of the request sends the pending lines
+                import uwsgi
+                uwsgi.after_req_hook()
+                assert mule_msg.call_count == 1
+                with mock.patch.object(uwsgi_plugin, '_coalescer', coalescer):
+                    uwsgi.after_req_hook()
+                assert mule_msg.call_count == 3
+                assert sorted(len(c[0]) for c in mule_msg.call_args_list[1:]) == [1, 2]
+
+        run(target)
+
+    def test_worker_coalescer_after_fork(self):
+        def target(uwsgi_plugin):
+            coalescer = uwsgi_plugin.WorkerCoalescer(max_size=1000, max_delay=60)
+
+            def check_locked():
+                assert coalescer._lock.locked()
+
+            with mock.patch.object(coalescer, '_start_flusher', side_effect=check_locked) as start_flusher, \
+                    mock.patch.object(uwsgi_plugin, '_send_mule_msg') as send:
+                coalescer.add('a', 'master line', mule=1)
+                # the master started a flusher, which does not run in its workers
+                coalescer._flusher = mock.Mock()
+                with mock.patch.object(uwsgi_plugin.os, 'getpid', return_value=os.getpid() + 1):
+                    coalescer.flush()
+                    assert not send.called
+                    coalescer.add('a', 'worker line', mule=1)
+                    assert start_flusher.call_count == 2
+                    coalescer.flush()
+                records = uwsgi_plugin._decode_mule_msgs(uwsgi_plugin._unstamp_mule_msg(send.call_args[0][0])[1])
+                assert list(records) == [(b'a', b'worker line')]
+
+        run(target)
+
+    def test_worker_coalescer_fallback(self):
+        def target(uwsgi_plugin):
+            coalescer = uwsgi_plugin.WorkerCoalescer(65536, max_delay=60)
+            with mock.patch.object(coalescer, '_start_flusher'), \
+                    mock.patch('uwsgi.mule_msg', return_value=False), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
+                coalescer.add('stream', 'line1')
+                coalescer.add('stream', 's' * 65536)
+                coalescer.flush()
+                already_sampled = uwsgi_plugin.clog.sampling.ALREADY_SAMPLED
+                # the pending line is sent before the one too large to be packed
+                assert orig_line.call_args_list == [
+                    mock.call(b'stream', b'line1', sample_key=already_sampled),
+                    mock.call('stream', 's' * 65536, sample_key=already_sampled),
+                ]
+
+        run(target)
+
+    def test_worker_coalescer_keeps_order_of_large_records(self):
+        def target(uwsgi_plugin):
+            coalescer = uwsgi_plugin.WorkerCoalescer(65536, max_delay=60)
+            with mock.patch.object(coalescer, '_start_flusher'), \
+                    mock.patch('uwsgi.mule_msg') as mule_msg:
+                coalescer.add('stream', 'line1', mule=1)
+                coalescer.add('other', 'line2', mule=2)
+                coalescer.add('stream', 's' * 65536, mule=1)
+                # the pending line, then the fragments of the large one
+                assert mule_msg.call_count > 2
+                assert set(c[0][1] for c in mule_msg.call_args_list) == {1}
+                _, msg = uwsgi_plugin._unstamp_mule_msg(mule_msg.call_args_list[0][0][0])
+                assert uwsgi_plugin._decode_mule_msgs(msg) == [(b'stream', b'line1')]
+                assert list(coalescer.pending) == [2]
+
+        run(target)
+
+    def test_uwsgi_log_line_with_coalescer(self):
+        def target(uwsgi_plugin):
+            coalescer = mock.Mock()
+            with mock.patch.object(uwsgi_plugin, '_coalescer', coalescer), \
+                    mock.patch.object(uwsgi_plugin, '_mule_msg') as mule_msg:
+                uwsgi_plugin.uwsgi_log_line('stream', 'line')
+                coalescer.add.assert_called_once_with('stream', 'line', None)
+                assert not mule_msg.called
+
+        run(target)
+
+    def test_mule_sharder_hash(self):
+        def target(uwsgi_plugin):
+            sharder = uwsgi_plugin.MuleSharder([1, 2, 3, 4])
+            streams = ['stream%d' % i for i in range(100)]
+            mules = dict((stream, sharder.mule_for(stream)) for stream in streams)
+            assert set(mules.values()) == set([1, 2, 3, 4])
+            assert all(sharder.mule_for(stream) == mules[stream] for stream in streams)
+            assert sum(sharder.sent_lines.values()) == 200
+            # evenly
+            assert all(20 <= lines <= 80 for lines in sharder.sent_lines.values())
+            assert len(set(sharder.mule_for('stream%d' % i) for i in range(10))) > 1
+
+            # removing a mule only moves its streams
+            smaller_sharder = uwsgi_plugin.MuleSharder([1, 2, 3])
+            for stream in streams:
+                if mules[stream] != 4:
+                    assert smaller_sharder.mule_for(stream) == mules[stream]
+
+        run(target)
+
+    def test_mule_sharder_round_robin(self):
+        def target(uwsgi_plugin):
+            sharder = uwsgi_plugin.MuleSharder([1, 2], uwsgi_plugin.SHARDING_ROUND_ROBIN)
+            assert [sharder.mule_for('stream') for _ in range(4)] == [1, 2, 1, 2]
+            assert sharder.sent_lines == {1: 2, 2: 2}
+            with pytest.raises(ValueError):
+                uwsgi_plugin.MuleSharder([1, 2], 'random')
+            with pytest.raises(ValueError):
+                uwsgi_plugin.MuleSharder([])
+
+        run(target)
+
+    def test_uwsgi_log_line_with_sharder(self):
+        def target(uwsgi_plugin):
+            sharder = uwsgi_plugin.MuleSharder([3, 4], uwsgi_plugin.SHARDING_ROUND_ROBIN)
+            with mock.patch.object(uwsgi_plugin, '_sharder', sharder), \
+                    mock.patch.object(uwsgi_plugin, '_mule_msg') as mule_msg:
+                uwsgi_plugin.uwsgi_log_line('stream', 'line1')
+                uwsgi_plugin.uwsgi_log_line('stream', 'line2')
+                uwsgi_plugin.uwsgi_log_line('stream', 'line3', mule=1)
+                handler = uwsgi_plugin.UwsgiHandler('stream', mule=None)
+                handler.emit(logging.makeLogRecord({'msg': 'line4'}))
+                assert mule_msg.call_args_list == [
+                    mock.call('stream', 'line1', mule=3),
+                    mock.call('stream', 'line2', mule=4),
+                    mock.call('stream', 'line3', mule=1),
+                    mock.call('stream', 'line4', mule=3),
+                ]
+
+        run(target)
+
+    def test_mule_metrics(self):
+        def target(uwsgi_plugin):
+            msg = uwsgi_plugin._encode_multi_mule_msg([
+                uwsgi_plugin._encode_record('stream', 'line1'),
+                uwsgi_plugin._encode_record('stream', 'line2'),
+            ])
+            metrics = mock.MagicMock()
+            with mock.patch.object(uwsgi_plugin, '_mule_metrics', metrics), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line'):
+                uwsgi_plugin._plugin_mule_msg_shim(msg)
+            metrics.sampled_request.assert_called_once_with(2)
+
+        run(target)
+
+    def test_mule_latency_and_throughput_metrics(self):
+        def target(uwsgi_plugin):
+            msg = uwsgi_plugin._stamp_mule_msg(uwsgi_plugin._encode_multi_mule_msg([
+                uwsgi_plugin._encode_record('stream1', 'line1'),
+                uwsgi_plugin._encode_record('stream2', 'line22'),
+                uwsgi_plugin._encode_record('stream1', 'line333'),
+            ]), 100)
+            assert uwsgi_plugin._unstamp_mule_msg(msg)[0] == 100
+            metrics = mock.MagicMock()
+            with mock.patch.object(uwsgi_plugin, '_mule_metrics', metrics), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line'), \
+                    mock.patch.object(uwsgi_plugin.time, 'time', return_value=100.25):
+                uwsgi_plugin._plugin_mule_msg_shim(msg)
+                # messages of older workers have no enqueue time
+                uwsgi_plugin._plugin_mule_msg_shim(uwsgi_plugin._encode_mule_msg('stream1', 'line'))
+            metrics.mule_latency.assert_called_once_with(0.25)
+            assert sorted(metrics.stream_throughput.call_args_list) == [
+                mock.call(b'stream1', 1, 4),
+                mock.call(b'stream1', 2, 12),
+                mock.call(b'stream2', 1, 6),
+            ]
+
+        run(target)
+
+    def test_mule_latency_after_write(self):
+        def target(uwsgi_plugin):
+            msg = uwsgi_plugin._stamp_mule_msg(uwsgi_plugin._encode_mule_msg('stream', 'line'), 100)
+            metrics = mock.MagicMock()
+            written = []
+
+            def orig_log_line(stream, line, sample_key):
+                written.append(line)
+                assert not metrics.mule_latency.called
+
+            with mock.patch.object(uwsgi_plugin, '_mule_metrics', metrics), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line', side_effect=orig_log_line), \
+                    mock.patch.object(uwsgi_plugin.time, 'time', return_value=100.5):
+                uwsgi_plugin._plugin_mule_msg_shim(msg)
+            assert written == [b'line']
+            metrics.mule_latency.assert_called_once_with(0.5)
+
+        run(target)
+
+    def test_logging_errors_are_not_decode_failures(self):
+        def target(uwsgi_plugin):
+            msg = uwsgi_plugin._encode_multi_mule_msg([
+                uwsgi_plugin._encode_record('stream1', 'line1'),
+                uwsgi_plugin._encode_record('stream2', 'line2'),
+            ])
+            metrics = mock.MagicMock()
+            orig_line = mock.Mock(side_effect=[uwsgi_plugin.clog.loggers.LogLineIsTooLongError('too long'), None])
+            with mock.patch.object(uwsgi_plugin, '_mule_metrics', metrics), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line', orig_line), \
+                    mock.patch.object(uwsgi_plugin, 'mule_msg_dispatcher') as dispatcher, \
+                    mock.patch.object(uwsgi_plugin.logging, 'exception') as log_exception:
+                uwsgi_plugin._plugin_mule_msg_shim(msg)
+            # the second record is still logged
+            assert [c[0][:2] for c in orig_line.call_args_list] == [(b'stream1', b'line1'), (b'stream2', b'line2')]
+            assert log_exception.call_count == 1
+            assert not dispatcher.called
+            assert not metrics.mule_decode_failure.called
+
+        run(target)
+
+    def test_mule_decode_failure_metric(self):
+        def target(uwsgi_plugin):
+            metrics = mock.MagicMock()
+            msg = uwsgi_plugin._encode_mule_msg('stream', 'line')
+            with mock.patch.object(uwsgi_plugin, '_mule_metrics', metrics), \
+                    mock.patch.object(uwsgi_plugin, 'mule_msg_dispatcher') as dispatcher:
+                uwsgi_plugin._plugin_mule_msg_shim(msg[:-1])
+                dispatcher.assert_called_once_with(msg[:-1])
+                # not a message of the plugin
+                uwsgi_plugin._plugin_mule_msg_shim(pickle.dumps('message'))
+            assert metrics.mule_decode_failure.call_count == 1
+
+        run(target)
+
+    def test_worker_fallback_metric(self):
+        def target(uwsgi_plugin):
+            metrics = mock.MagicMock()
+            coalescer = uwsgi_plugin.WorkerCoalescer(65536, max_delay=60)
+            with mock.patch.object(uwsgi_plugin, '_worker_metrics', metrics), \
+                    mock.patch.object(coalescer, '_start_flusher'), \
+                    mock.patch('uwsgi.mule_msg', return_value=False), \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line'):
+                uwsgi_plugin.uwsgi_log_line('stream', 'line')
+                coalescer.add('stream', 'line1')
+                coalescer.add('stream', 'line2')
+                coalescer.flush()
+            assert metrics.mule_fallback.call_args_list == [mock.call(1), mock.call(2)]
+
+        run(target)
+
+    def test_shm_transport(self):
+        def target(uwsgi_plugin):
+            import uwsgi
+            with mock.patch.object(uwsgi, 'numproc', 2, create=True), \
+                    mock.patch.object(uwsgi, 'worker_id', return_value=2, create=True), \
+                    mock.patch.object(uwsgi_plugin, '_shm_transport'), \
+                    mock.patch.object(uwsgi_plugin, '_mule_msg') as mule_msg, \
+                    mock.patch.object(uwsgi_plugin, '_orig_log_line') as orig_line:
+                uwsgi_plugin.uwsgi_setup_shm_transport(slot_capacity=100)
+                uwsgi_plugin.uwsgi_log_line('stream', 'line')
+                # too large for the ring, sent as a mule message
+                uwsgi_plugin.uwsgi_log_line('stream', 's' * 100)
+                mule_msg.assert_called_once_with('stream', 's' * 100, mule=None)
+
+                uwsgi_plugin._drain_shm_transport(0)
+                orig_line.assert_called_once_with(
+                    b'stream', b'line', sample_key=uwsgi_plugin.clog.sampling.ALREADY_SAMPLED)
+                assert uwsgi_plugin._shm_transport.rings[1].get_all() == []
+
+        run(target)
+
+    def test_uwsgi_atexit_shuts_down_global_state(self):
+        def target(uwsgi_plugin):
+            import uwsgi
+            batcher = mock.Mock()
+            with mock.patch.object(uwsgi_plugin, '_orig_uwsgi_atexit') as orig_atexit, \
+                    mock.patch.object(uwsgi_plugin, '_mule_batcher', batcher), \
+                    mock.patch.object(uwsgi_plugin.clog.global_state, 'shutdown') as shutdown:
+                uwsgi.atexit()
+                assert batcher.flush.call_count == 1
+                assert shutdown.call_count == 1
+                assert orig_atexit.call_count == 1
+
+        run(target)
@@ -24,6 +24,13 @@ def use_zipkin(zipkin_plugin):
     yield
 
 
+@pytest.fixture
+def sampled_trace(zipkin_plugin):
+    zipkin_attrs = mock.Mock(is_sampled=True)
+    with mock.patch.object(zipkin_plugin, '_get_zipkin_attrs', return_value=zipkin_attrs):
+        yield zipkin_attrs
+
+
 @pytest.fixture
 def no_use_zipkin(zipkin_plugin):
     zipkin_plugin.zipkin_plugin_enabled = False
@@ -42,7 +49,7 @@ class TestZipkinPlugin(object):
         with pytest.raises(AssertionError):
             zipkin_plugin.ZipkinTracing(MockLogger())
 
-    def test_log_line(self, zipkin_plugin, use_zipkin):
+    def test_log_line(self, zipkin_plugin, use_zipkin, sampled_trace):
         with mock.patch.object(zipkin_plugin, 'zipkin_span') as zipkin_span:
             logger = zipkin_plugin.ZipkinTracing(MockLogger())
             logger.log_line('stream', 'line')
@@ -54,6 +61,40 @@ class TestZipkinPlugin(object):
             span_name='MockLogger.log_line stream',
         )
 
+    def test_log_lines_and_flush(self, zipkin_plugin, use_zipkin, sampled_trace):
+        with mock.patch.object(zipkin_plugin, 'zipkin_span') as zipkin_span:
+            logger = zipkin_plugin.ZipkinTracing(MockLogger())
+            logger.log_lines('stream', ['line1', 'line2'])
+            assert logger.flush() == (0, 0)
+
+        assert logger.logger.lines == {'stream': ['line1', 'line2']}
+        assert zipkin_span.call_args_list == [
+            mock.call(service_name='yelp_clog', span_name='MockLogger.log_lines stream'),
+            mock.call(service_name='yelp_clog', span_name='MockLogger.flush'),
+        ]
+
+    @pytest.mark.parametrize('zipkin_attrs', [None, mock.Mock(is_sampled=False)])
+    def test_no_span_outside_of_sampled_trace(self, zipkin_plugin, use_zipkin, zipkin_attrs):
+        with mock.patch.object(zipkin_plugin, 'zipkin_span') as zipkin_span, \
+                mock.patch.object(zipkin_plugin, '_get_zipkin_attrs', return_value=zipkin_attrs):
+            logger = zipkin_plugin.ZipkinTracing(MockLogger())
+            logger.log_line('stream', 'line1')
+            logger.log_lines('stream', ['line2'])
+
+        assert logger.logger.lines == {'stream': ['line1', 'line2']}
+        assert zipkin_span.call_count == 0
+
+    def test_span_names_cached(self, zipkin_plugin, use_zipkin, sampled_trace):
+        with mock.patch.object(zipkin_plugin, 'zipkin_span'), \
+                mock.patch.object(zipkin_plugin, 'MAX_CACHED_SPAN_NAMES', 2):
+            logger = zipkin_plugin.ZipkinTracing(MockLogger())
+            logger.log_line('stream1', 'line')
+            logger.log_line('stream1', 'line')
+            logger.log_line('stream2', 'line')
+            assert len(logger._span_names) == 2
+            logger.log_line('stream3', 'line')
+            assert logger._span_names == {('log_line', 'stream3'): 'MockLogger.log_line stream3'}
+
     def test_other(self, zipkin_plugin, use_zipkin):
         with mock.patch.object(zipkin_plugin, 'zipkin_span') as zipkin_span:
             logger = zipkin_plugin.ZipkinTracing(MockLogger())